@@ -0,0 +1,44 @@
+import re
+
+# Arabic text as typed by staff and as read by OCR varies in ways that don't
+# change the meaning: hamza forms of alef, taa marbuta vs haa, alef maqsura vs
+# yaa, diacritics, tatweel and Arabic-Indic digits. Normalized text compares
+# equal across those variants (used for patient search and matching).
+
+_DIACRITICS = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed]")
+_TATWEEL = "\u0640"
+_LETTERS = str.maketrans(
+    {
+        "أ": "ا",
+        "إ": "ا",
+        "آ": "ا",
+        "ٱ": "ا",
+        "ى": "ي",
+        "ئ": "ي",
+        "ؤ": "و",
+        "ة": "ه",
+    }
+)
+_DIGITS = str.maketrans("٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹", "01234567890123456789")
+_NOT_WORD = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+
+
+def to_ascii_digits(text: str) -> str:
+    """Arabic-Indic (and Persian) digits to 0-9."""
+    return (text or "").translate(_DIGITS)
+
+
+def normalize_arabic(text: str) -> str:
+    """Search form of a name or phrase: normalized letters, no punctuation, single spaces."""
+    if not text:
+        return ""
+    text = _DIACRITICS.sub("", text).replace(_TATWEEL, "")
+    text = to_ascii_digits(text.translate(_LETTERS)).lower()
+    text = _NOT_WORD.sub(" ", text)
+    return _SPACES.sub(" ", text).strip()
+
+
+def name_tokens(text: str) -> list:
+    """Words of a normalized name."""
+    return normalize_arabic(text).split()
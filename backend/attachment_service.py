@@ -0,0 +1,322 @@
+import os
+import uuid
+import hashlib
+import mimetypes
+from datetime import datetime, timedelta
+from fastapi import UploadFile
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+import cloudinary
+import cloudinary.uploader
+from . import models, database, crud, thumbnail_service, static_files, upload_guard
+
+# Local storage, served under /uploads
+UPLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads")
+
+# Request bodies are copied in chunks of this size, off the event loop
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Cloudinary push retry queue (the queue is the attachments table itself:
+# rows in "uploading" state with a due next_attempt_at)
+CLOUDINARY_MAX_ATTEMPTS = int(os.getenv("CLOUDINARY_MAX_ATTEMPTS", "6"))
+CLOUDINARY_RETRY_BASE_SECONDS = 30
+# A push in progress holds the row for this long, so the retry job does not
+# pick it up concurrently
+CLOUDINARY_CLAIM_SECONDS = 600
+
+
+def cloudinary_enabled():
+    return bool(os.getenv("CLOUDINARY_URL"))
+
+
+def local_path(file_path: str):
+    # Attachment file_path is stored relative, e.g. /uploads/<name>
+    return os.path.join(UPLOAD_DIR, os.path.basename(file_path))
+
+
+def is_local(file_path: str):
+    return file_path.startswith("/uploads/")
+
+
+async def receive_upload(file: UploadFile):
+    """
+    Streams the uploaded file into a temporary file in local storage, hashing
+    it on the way, without blocking the event loop. The type is detected from
+    the first bytes (upload_guard.UploadRejected if not allowed).
+    Returns (temp_path, sha256, size, mime_type).
+    """
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    temp_path = os.path.join(UPLOAD_DIR, f".incoming-{uuid.uuid4()}")
+    digest = hashlib.sha256()
+    size = 0
+    mime_type = None
+
+    out = await run_in_threadpool(open, temp_path, "wb")
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if mime_type is None:
+                mime_type = upload_guard.check_file_type(chunk, "attachment")
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+            await run_in_threadpool(out.write, chunk)
+    except Exception:
+        out.close()
+        os.remove(temp_path)
+        raise
+    await run_in_threadpool(out.close)
+
+    return temp_path, digest.hexdigest(), size, mime_type
+
+
+def file_extension(filename: str, mime_type: str):
+    """The client's extension if it fits the detected type, else the type's own."""
+    ext = os.path.splitext(filename or "")[1].lower()
+    if ext in mimetypes.guess_all_extensions(mime_type):
+        return ext
+    return mimetypes.guess_extension(mime_type) or ext
+
+
+def store_upload(db, temp_path: str, content_hash: str, size: int, ext: str):
+    """
+    Files the received upload under its content hash (/uploads/<sha256><ext>).
+    If that content is already stored, the temp file is dropped and the
+    existing blob gains a reference instead.
+    Returns (blob, is_new).
+    """
+    blob = crud.get_blob(db, content_hash)
+    if blob:
+        crud.add_blob_reference(db, content_hash)
+        os.remove(temp_path)
+        return blob, False
+
+    filename = f"{content_hash}{ext.lower()}"
+    final_path = os.path.join(UPLOAD_DIR, filename)
+    os.replace(temp_path, final_path)
+    try:
+        return crud.create_blob(db, content_hash, size, f"/uploads/{filename}"), True
+    except IntegrityError:
+        # Same content uploaded concurrently, the other request created it
+        db.rollback()
+        crud.add_blob_reference(db, content_hash)
+        blob = crud.get_blob(db, content_hash)
+        if blob.file_path != f"/uploads/{filename}" and os.path.exists(final_path):
+            os.remove(final_path)
+        return blob, False
+
+
+def delete_stored_file(file_path: str):
+    """Removes a stored file, on Cloudinary or in local storage."""
+    if "cloudinary.com" in file_path:
+        # It's a cloudinary url
+        if cloudinary_enabled():
+            public_id = cloudinary_public_id(file_path)
+            if public_id:
+                cloudinary.uploader.destroy(public_id)
+    else:
+        # Local file deletion
+        # Note: file_path here is relative /uploads/filename.ext
+        remove_local(file_path)
+
+
+def discard_stored_file(file_path: str):
+    """Background task: delete_stored_file, failures are left to the storage GC."""
+    try:
+        delete_stored_file(file_path)
+    except Exception as e:
+        print(f"Error deleting file {file_path}: {e}")
+
+
+def discard_blob_file(sha256: str, file_path: str):
+    """
+    Background task: discard_stored_file for a released blob, unless its
+    content is in use again by then (re-uploaded since the release, or
+    attachments the count missed).
+    """
+    db = database.SessionLocal()
+    try:
+        if crud.blob_in_use(db, sha256):
+            print(f"Kept {file_path}: content {sha256[:12]} is still referenced")
+            return
+    finally:
+        db.close()
+    discard_stored_file(file_path)
+
+
+def remove_local(file_path: str):
+    """Removes a local original with its precompressed copies and derivatives."""
+    full_path = local_path(file_path)
+    for suffix in ("",) + tuple(s for _, s in static_files.PRECOMPRESSED):
+        if os.path.exists(full_path + suffix):
+            os.remove(full_path + suffix)
+    thumbnail_service.remove_derivatives(file_path)
+
+
+def cloudinary_public_id(url: str):
+    # URL is like: https://res.cloudinary.com/demo/image/upload/v1570979139/clinic_uploads/sample.jpg
+    # We need 'clinic_uploads/sample'
+    parts = url.split("/")
+    if "upload" not in parts:
+        return None
+    idx = parts.index("upload")
+    folder_file = "/".join(parts[idx + 2 :])  # skip 'v123...'
+    return os.path.splitext(folder_file)[0]
+
+
+def _claim(db, attachment_id: int, now: datetime):
+    """Atomically takes the row for one push attempt. False if someone else has it."""
+    claimed = (
+        db.query(models.Attachment)
+        .filter(
+            models.Attachment.id == attachment_id,
+            models.Attachment.status == "uploading",
+            or_(
+                models.Attachment.next_attempt_at.is_(None),
+                models.Attachment.next_attempt_at <= now,
+            ),
+        )
+        .update(
+            {
+                models.Attachment.next_attempt_at: now
+                + timedelta(seconds=CLOUDINARY_CLAIM_SECONDS)
+            },
+            synchronize_session=False,
+        )
+    )
+    db.commit()
+    return claimed == 1
+
+
+def defer_push(db, attachment: models.Attachment):
+    """
+    Parks an attachment whose content is already being pushed by another
+    attachment: that push flips it, the retry job picks it up otherwise.
+    """
+    attachment.next_attempt_at = datetime.utcnow() + timedelta(
+        seconds=CLOUDINARY_CLAIM_SECONDS
+    )
+    db.commit()
+
+
+def push_to_cloudinary(attachment_id: int):
+    """
+    Background worker: moves a locally stored attachment to Cloudinary and
+    flips its file_path to the final URL. Failures are retried with
+    exponential backoff by retry_pending_uploads; after the last attempt the
+    attachment simply stays on local storage.
+    """
+    db = database.SessionLocal()
+    try:
+        now = datetime.utcnow()
+        if not _claim(db, attachment_id, now):
+            return
+
+        attachment = (
+            db.query(models.Attachment)
+            .filter(models.Attachment.id == attachment_id)
+            .first()
+        )
+        blob = crud.get_blob(db, attachment.content_hash) if attachment.content_hash else None
+        stored_path = blob.file_path if blob else attachment.file_path
+
+        if not is_local(stored_path):
+            # Same content was already pushed for another attachment
+            _mark_pushed(db, attachment, blob, stored_path)
+            return
+
+        path = local_path(stored_path)
+        try:
+            result = cloudinary.uploader.upload(
+                path,
+                folder="clinic_uploads",
+                # Content-addressed: the same file always maps to the same asset
+                public_id=attachment.content_hash,
+                resource_type="auto",
+            )
+        except Exception as e:
+            attachment.upload_attempts = (attachment.upload_attempts or 0) + 1
+            if attachment.upload_attempts >= CLOUDINARY_MAX_ATTEMPTS:
+                print(f"Cloudinary upload gave up for attachment {attachment_id}: {e}")
+                attachment.status = "ready"  # Keep serving the local copy
+                attachment.next_attempt_at = None
+            else:
+                delay = CLOUDINARY_RETRY_BASE_SECONDS * 2 ** (
+                    attachment.upload_attempts - 1
+                )
+                print(
+                    f"Cloudinary upload failed for attachment {attachment_id} "
+                    f"(attempt {attachment.upload_attempts}), retry in {delay}s: {e}"
+                )
+                attachment.next_attempt_at = now + timedelta(seconds=delay)
+            db.commit()
+            return
+
+        url = result.get("secure_url")
+        _mark_pushed(db, attachment, blob, url)
+        print(f"Cloudinary Success for attachment {attachment_id}: {url}")
+
+        remove_local(stored_path)
+    finally:
+        db.close()
+
+
+def _mark_pushed(db, attachment, blob, url: str):
+    # Cloudinary serves thumbnails/previews of images as URL transformations
+    thumbnail_url = preview_url = None
+    if thumbnail_service.is_image(attachment):
+        thumbnail_url = thumbnail_service.cloudinary_variant(
+            url, thumbnail_service.THUMBNAIL_WIDTH
+        )
+        preview_url = thumbnail_service.cloudinary_variant(
+            url, thumbnail_service.PREVIEW_WIDTH
+        )
+
+    if blob:
+        # Every attachment sharing this content now points at Cloudinary
+        blob.file_path = url
+        db.query(models.Attachment).filter(
+            models.Attachment.content_hash == blob.sha256
+        ).update(
+            {
+                models.Attachment.file_path: url,
+                models.Attachment.status: "ready",
+                models.Attachment.next_attempt_at: None,
+                models.Attachment.thumbnail_url: thumbnail_url,
+                models.Attachment.preview_url: preview_url,
+            },
+            synchronize_session=False,
+        )
+    else:
+        attachment.file_path = url
+        attachment.status = "ready"
+        attachment.next_attempt_at = None
+        attachment.thumbnail_url = thumbnail_url
+        attachment.preview_url = preview_url
+    db.commit()
+
+
+def retry_pending_uploads():
+    """Scheduler job: pushes every attachment whose retry is due."""
+    if not cloudinary_enabled():
+        return
+    db = database.SessionLocal()
+    try:
+        due = (
+            db.query(models.Attachment.id)
+            .filter(
+                models.Attachment.status == "uploading",
+                or_(
+                    models.Attachment.next_attempt_at.is_(None),
+                    models.Attachment.next_attempt_at <= datetime.utcnow(),
+                ),
+            )
+            .all()
+        )
+    finally:
+        db.close()
+
+    for (attachment_id,) in due:
+        push_to_cloudinary(attachment_id)
@@ -2,6 +2,9 @@ from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 import bcrypt
+import hmac
+import hashlib
+import time
 
 import os
 
@@ -10,6 +13,11 @@ SECRET_KEY = os.getenv("SECRET_KEY", "eslam_emara_clinic_secret_key_change_me")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24 * 60  # 60 days
 
+# Signed /uploads URLs. Expiry is rounded up to a fixed window, so the same
+# file gets the same URL for a whole window and stays cacheable in the browser.
+# A URL is valid for between one and two windows.
+SIGNED_URL_WINDOW_SECONDS = int(os.getenv("SIGNED_URL_WINDOW_SECONDS", "3600"))
+
 
 def verify_password(plain_password, hashed_password):
     # bcrypt.checkpw requires bytes
@@ -32,3 +40,27 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
+
+
+def _upload_signature(path: str, exp: int):
+    message = f"{path}:{exp}".encode("utf-8")
+    return hmac.new(SECRET_KEY.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+def sign_upload_url(path: str):
+    """Adds exp/sig to a local /uploads/... path. Other URLs are returned as is."""
+    if not path or not path.startswith("/uploads/") or "?" in path:
+        return path
+    window = SIGNED_URL_WINDOW_SECONDS
+    exp = (int(time.time()) // window + 2) * window
+    return f"{path}?exp={exp}&sig={_upload_signature(path, exp)}"
+
+
+def verify_upload_signature(path: str, exp: str, sig: str):
+    try:
+        exp = int(exp)
+    except (TypeError, ValueError):
+        return False
+    if exp < time.time():
+        return False
+    return hmac.compare_digest(_upload_signature(path, exp), sig or "")
@@ -0,0 +1,90 @@
+import re
+from datetime import datetime
+
+# Only files the backup jobs wrote for the tenant are candidates for pruning:
+# backup_<tenant>_<YYYYmmdd_HHMM>.json (scheduled) and manual_backup_... .
+# Destinations can be shared (two clinics linked to one Google account use
+# the same backups folder), so the tenant's name must match exactly.
+_UNSAFE_FILENAME_CHARS = re.compile(r"[\\/:*?\"<>|\s]+")
+
+DEFAULT_KEEP_DAILY = 7
+DEFAULT_KEEP_WEEKLY = 4
+DEFAULT_KEEP_MONTHLY = 12
+
+
+def safe_filename(name: str) -> str:
+    # Tenant names end up in file names: keep them path- and key-safe
+    return _UNSAFE_FILENAME_CHARS.sub("_", name)
+
+
+def backup_name_pattern(tenant_name: str):
+    """Names of the tenant's backup files (as written, or made path-safe)."""
+    name = re.escape(safe_filename(tenant_name))
+    return re.compile(rf"^(manual_)?backup_{name}_\d{{8}}_\d{{4}}\.json$")
+
+
+def parse_created_time(value: str) -> datetime:
+    # Drive returns RFC 3339 in UTC, e.g. 2024-01-31T10:15:00.000Z
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _day(ts: datetime):
+    return ts.date()
+
+
+def _week(ts: datetime):
+    iso = ts.isocalendar()
+    return (iso[0], iso[1])
+
+
+def _month(ts: datetime):
+    return (ts.year, ts.month)
+
+
+def select_backups_to_prune(
+    files: list,
+    tenant_name: str,
+    keep_daily: int = DEFAULT_KEEP_DAILY,
+    keep_weekly: int = DEFAULT_KEEP_WEEKLY,
+    keep_monthly: int = DEFAULT_KEEP_MONTHLY,
+):
+    """
+    Grandfather-father-son retention.
+
+    `files` are dicts with "id", "name" and "createdTime"; only the backups
+    of `tenant_name` among them are considered. Keeps the newest
+    backup of each of the `keep_daily` most recent days that have a backup,
+    likewise for `keep_weekly` ISO weeks and `keep_monthly` months, plus the
+    newest backup overall. Returns the files that may be deleted.
+
+    A policy of all zeros disables pruning.
+    """
+    if not (keep_daily or keep_weekly or keep_monthly):
+        return []
+
+    pattern = backup_name_pattern(tenant_name)
+    backups = [
+        f for f in files if pattern.match(safe_filename(f.get("name") or ""))
+    ]
+    backups.sort(key=lambda f: parse_created_time(f["createdTime"]), reverse=True)
+    if not backups:
+        return []
+
+    keep = {backups[0]["id"]}
+    for count, period_of in (
+        (keep_daily, _day),
+        (keep_weekly, _week),
+        (keep_monthly, _month),
+    ):
+        seen_periods = set()
+        for f in backups:
+            if len(seen_periods) >= (count or 0):
+                break
+            period = period_of(parse_created_time(f["createdTime"]))
+            if period in seen_periods:
+                continue
+            # Newest file of this period (list is newest first)
+            seen_periods.add(period)
+            keep.add(f["id"])
+
+    return [f for f in backups if f["id"] not in keep]
@@ -1,11 +1,13 @@
 import sqlite3
 import json
+import hashlib
 import os
 import shutil
 from sqlalchemy.orm import Session
-from sqlalchemy import DateTime, Date
+from sqlalchemy import DateTime, Date, text
 from datetime import datetime, date
-from . import models
+from . import models, crud, reports, backup_targets, backup_retention
+from .arabic import normalize_arabic
 
 # Map table name to Model
 TABLE_MODEL_MAP = {
@@ -57,7 +59,7 @@ def parse_value(model, key, value):
     return value
 
 
-def import_from_sqlite(db: Session, sqlite_path: str):
+def import_from_sqlite(db: Session, sqlite_path: str, tenant_id: int):
     conn = sqlite3.connect(sqlite_path)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
@@ -65,46 +67,80 @@ def import_from_sqlite(db: Session, sqlite_path: str):
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
     existing_tables = [r[0] for r in cursor.fetchall()]
 
-    stats = {t: {"restored": 0, "errors": 0} for t in ORDERED_TABLES}
-
+    # Read the legacy DB into the same shape as a JSON dump so both formats
+    # go through the same tenant-scoped restore path.
+    json_data = {}
     for table_name in ORDERED_TABLES:
         if table_name not in existing_tables:
             continue
-
-        model = TABLE_MODEL_MAP[table_name]
         try:
             rows = cursor.execute(f"SELECT * FROM {table_name}").fetchall()
-            for row in rows:
-                try:
-                    data = dict(row)
-                    valid_cols = [c.name for c in model.__table__.columns]
-                    data = {k: v for k, v in data.items() if k in valid_cols}
-
-                    for k, v in data.items():
-                        data[k] = parse_value(model, k, v)
-
-                    existing = db.query(model).filter(model.id == data["id"]).first()
-                    if existing:
-                        for k, v in data.items():
-                            setattr(existing, k, v)
-                    else:
-                        db.add(model(**data))
-                    stats[table_name]["restored"] += 1
-                except Exception as row_err:
-                    print(f"Row error in {table_name}: {row_err}")
-                    stats[table_name]["errors"] += 1
-
-            db.flush()
+            json_data[table_name] = [dict(row) for row in rows]
         except Exception as e:
             print(f"Table error {table_name}: {e}")
 
-    db.commit()
     conn.close()
-    return stats
+    return import_from_json(db, json_data, tenant_id)
+
+
+# Rows are written in batches, each batch committed on its own. A restore only
+# ever holds locks on the rows of the batch it is writing, and a bad batch is
+# rolled back without losing the batches (or tables) restored before it.
+RESTORE_BATCH_SIZE = 500
+
+# SQLite limits the number of bound parameters per statement
+ID_LOOKUP_CHUNK_SIZE = 900
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def _unique_columns(model):
+    return [c.name for c in model.__table__.columns if c.unique and not c.primary_key]
 
 
-def import_from_json(db: Session, json_data: dict):
+def _owner_query(db: Session, model, *columns):
+    """
+    Query `columns` of `model` together with the tenant that owns each row,
+    either directly (tenant_id column) or through the patient.
+    """
+    if hasattr(model, "tenant_id"):
+        return db.query(*columns, model.tenant_id)
+    return db.query(*columns, models.Patient.tenant_id).join(
+        models.Patient, model.patient_id == models.Patient.id
+    )
+
+
+def _sync_pk_sequence(db: Session, model):
+    # Rows restored with their original IDs do not advance the Postgres
+    # sequence, so the next normal insert would collide with them.
+    if db.bind.dialect.name != "postgresql":
+        return
+    table = model.__tablename__
+    db.execute(
+        text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM {table}), 1))"
+        )
+    )
+    db.commit()
+
+
+def import_from_json(db: Session, json_data: dict, tenant_id: int):
+    """
+    Restore a backup into `tenant_id` only.
+
+    - Every restored row is re-owned by the caller's tenant (tenant_id column,
+      or the remapped patient_id for patient-owned tables).
+    - Rows whose ID already belongs to another tenant are inserted under a new
+      ID, and references to them (patient_id) are remapped accordingly.
+    - Rows of other tenants are never updated.
+    """
     stats = {t: {"restored": 0, "errors": 0} for t in ORDERED_TABLES}
+    # old patient id (from the backup) -> patient id in this database
+    patient_id_map = {}
 
     for table_name in ORDERED_TABLES:
         if table_name not in json_data:
@@ -115,7 +151,26 @@ def import_from_json(db: Session, json_data: dict):
         if not raw_records:
             continue
 
-        # 1. Pre-process all records (Validation & Parsing)
+        # Children may point at patients that were not part of this backup but
+        # already belong to the tenant; those keep their ID.
+        if hasattr(model, "patient_id") and table_name != "patients":
+            unmapped = list(
+                {r.get("patient_id") for r in raw_records}
+                - set(patient_id_map)
+                - {None}
+            )
+            for chunk in _chunks(unmapped, ID_LOOKUP_CHUNK_SIZE):
+                owned = (
+                    db.query(models.Patient.id)
+                    .filter(
+                        models.Patient.id.in_(chunk),
+                        models.Patient.tenant_id == tenant_id,
+                    )
+                    .all()
+                )
+                patient_id_map.update({p[0]: p[0] for p in owned})
+
+        # 1. Pre-process all records (Validation, Parsing & Re-owning)
         clean_records = []
         valid_cols = set(c.name for c in model.__table__.columns)
 
@@ -126,61 +181,142 @@ def import_from_json(db: Session, json_data: dict):
                 # Parse Dates/Types
                 for k, v in d.items():
                     d[k] = parse_value(model, k, v)
+
+                if hasattr(model, "tenant_id"):
+                    d["tenant_id"] = tenant_id
+                if table_name == "patients":
+                    # Bulk writes skip the model's name validator
+                    d["search_name"] = normalize_arabic(d.get("name"))
+                if table_name == "users" and d.get("role") == "super_admin":
+                    # A tenant backup must never be able to mint a super admin
+                    raise ValueError("super_admin rows are not restorable")
+                if hasattr(model, "patient_id") and table_name != "patients":
+                    if d.get("patient_id") not in patient_id_map:
+                        # Orphan, or a patient that was not restored
+                        raise ValueError(f"unknown patient {d.get('patient_id')}")
+                    d["patient_id"] = patient_id_map[d["patient_id"]]
                 clean_records.append(d)
             except Exception:
                 stats[table_name]["errors"] += 1
 
-        if not clean_records:
-            continue
-
-        # 2. Identify Existing IDs (Bulk lookup)
-        # This prevents N queries. We fetch all IDs involved in this batch or all IDs in table.
-        # Fetching all IDs in table is O(Total_Rows), fetching IDs in batch is O(Batch_Size).
-        # We'll use "Fetch all IDs" for simplicity as SaaS tables aren't massive yet.
-        # Optimization: Filter only IDs present in dataset.
-        incoming_ids = [rec["id"] for rec in clean_records if "id" in rec]
-        existing_ids_set = set()
-
-        if incoming_ids:
-            # Query in chunks if needed, but for now direct 'in_'
-            # Using chunks of 900 for SQLite limits
-            chunk_size = 900
-            for i in range(0, len(incoming_ids), chunk_size):
-                chunk = incoming_ids[i : i + chunk_size]
-                found = db.query(model.id).filter(model.id.in_(chunk)).all()
-                existing_ids_set.update(f[0] for f in found)
-
-        # 3. Segregate Insert vs Update
-        to_insert = []
-        to_update = []
-
-        for rec in clean_records:
-            # If ID is missing, treat as new insert (DB will auto-increment)
-            if rec.get("id") in existing_ids_set:
-                to_update.append(rec)
-            else:
-                to_insert.append(rec)
-
-        # 4. Execute Bulk Operations
+        # 2. Restore in batches, one transaction per batch
+        for batch in _chunks(clean_records, RESTORE_BATCH_SIZE):
+            try:
+                id_map, restored, rejected = _restore_batch(
+                    db, model, batch, tenant_id
+                )
+                db.commit()
+                stats[table_name]["restored"] += restored
+                stats[table_name]["errors"] += rejected
+                if table_name == "patients":
+                    patient_id_map.update(id_map)
+            except Exception as e:
+                print(f"Batch Error in {table_name}: {e}")
+                db.rollback()  # Only this batch is lost, each row counted once
+                stats[table_name]["errors"] += len(batch)
+
+        _sync_pk_sequence(db, model)
+
+    # Restored attachments were bulk-written past their blobs' reference
+    # counts; an undercount would let one delete remove a shared file
+    restored_hashes = {
+        r.get("content_hash") for r in json_data.get("attachments") or []
+    } - {None}
+    if restored_hashes:
         try:
-            if to_insert:
-                db.bulk_insert_mappings(model, to_insert)
-                stats[table_name]["restored"] += len(to_insert)
-
-            if to_update:
-                db.bulk_update_mappings(model, to_update)
-                stats[table_name]["restored"] += len(to_update)
-
-            db.flush()
+            crud.sync_blob_references(db, restored_hashes)
         except Exception as e:
-            print(f"Bulk Error in {table_name}: {e}")
-            stats[table_name]["errors"] += len(clean_records)
-            db.rollback()  # Rollback this table, try next
+            db.rollback()
+            print(f"Blob reference sync after restore failed: {e}")
+
+    # Treatments and payments were bulk-written, past the running balances
+    try:
+        crud.recompute_patient_balances(db, tenant_id)
+    except Exception as e:
+        db.rollback()
+        print(f"Balance recompute after restore failed: {e}")
+    reports.invalidate(tenant_id)
 
-    db.commit()
     return stats
 
 
+def _restore_batch(db: Session, model, batch: list, tenant_id: int):
+    """
+    Write one batch inside the current transaction. Returns the
+    {backup_id: db_id} mapping, the number of rows written and the number
+    rejected (unique value owned by another tenant).
+    """
+    id_map = {}
+    rejected = 0
+
+    # 1. Identify owners of the incoming IDs (Bulk lookup)
+    incoming_ids = [rec["id"] for rec in batch if rec.get("id") is not None]
+    owner_by_id = {}
+    for chunk in _chunks(incoming_ids, ID_LOOKUP_CHUNK_SIZE):
+        found = _owner_query(db, model, model.id).filter(model.id.in_(chunk)).all()
+        owner_by_id.update({row_id: owner for row_id, owner in found})
+
+    # 2. Rows matching a unique column (e.g. username, procedure name) that
+    # already exists are merged into this tenant's row, or rejected if the
+    # value is taken by another tenant.
+    unique_owner = {}
+    for col_name in _unique_columns(model):
+        col = getattr(model, col_name)
+        values = [rec[col_name] for rec in batch if rec.get(col_name) is not None]
+        for chunk in _chunks(values, ID_LOOKUP_CHUNK_SIZE):
+            found = _owner_query(db, model, col, model.id).filter(col.in_(chunk)).all()
+            for value, row_id, owner in found:
+                unique_owner[(col_name, value)] = (row_id, owner)
+
+    # 3. Segregate Insert (original ID) vs Insert (remapped) vs Update
+    to_insert = []
+    to_remap = []
+    to_update = []
+
+    for rec in batch:
+        old_id = rec.get("id")
+        conflict = None
+        for col_name in _unique_columns(model):
+            hit = unique_owner.get((col_name, rec.get(col_name)))
+            if hit:
+                conflict = hit
+                break
+
+        if conflict:
+            row_id, owner = conflict
+            if owner != tenant_id:
+                rejected += 1
+                continue
+            rec["id"] = row_id
+            to_update.append(rec)
+        elif old_id is not None and old_id in owner_by_id:
+            if owner_by_id[old_id] == tenant_id:
+                to_update.append(rec)
+            else:
+                # ID belongs to another tenant, insert as a new row
+                rec.pop("id")
+                to_remap.append((old_id, rec))
+        else:
+            to_insert.append(rec)
+
+        if rec.get("id") is not None and old_id is not None:
+            id_map[old_id] = rec["id"]
+
+    # 4. Execute Bulk Operations
+    if to_insert:
+        db.bulk_insert_mappings(model, to_insert)
+    if to_update:
+        db.bulk_update_mappings(model, to_update)
+    # ORM objects so the new IDs come back from the (batched) flush
+    remapped = [(old_id, model(**rec)) for old_id, rec in to_remap]
+    db.add_all([obj for _, obj in remapped])
+    db.flush()
+    for old_id, obj in remapped:
+        id_map[old_id] = obj.id
+
+    return id_map, len(to_insert) + len(to_update) + len(remapped), rejected
+
+
 def create_json_dump(db: Session, tenant_id: int = None):
     dump_data = {}
     for table_name in ORDERED_TABLES:
@@ -217,7 +353,8 @@ def create_json_dump(db: Session, tenant_id: int = None):
                     models.Patient.tenant_id == tenant_id
                 )
 
-        records = query.all()
+        # Stable row order so identical data always serializes identically
+        records = query.order_by(model.id).all()
         list_data = []
         for r in records:
             d = {c.name: getattr(r, c.name) for c in r.__table__.columns}
@@ -227,3 +364,153 @@ def create_json_dump(db: Session, tenant_id: int = None):
             list_data.append(d)
         dump_data[table_name] = list_data
     return dump_data
+
+
+# Rows fetched per round-trip while streaming a dump
+DUMP_FETCH_SIZE = 500
+
+
+def iter_json_dump(db: Session, tenant_id: int):
+    """
+    Streams the tenant's dump as canonical JSON (sorted keys, rows ordered by
+    id, so identical data always hashes the same) without holding it in
+    memory: one table and `DUMP_FETCH_SIZE` rows at a time.
+    """
+    yield b"{"
+    for i, table_name in enumerate(sorted(ORDERED_TABLES)):
+        model = TABLE_MODEL_MAP[table_name]
+        query = db.query(model)
+        if hasattr(model, "tenant_id"):
+            query = query.filter(model.tenant_id == tenant_id)
+        elif hasattr(model, "patient_id"):
+            query = query.join(models.Patient).filter(
+                models.Patient.tenant_id == tenant_id
+            )
+
+        prefix = ", " if i else ""
+        yield f"{prefix}{json.dumps(table_name)}: [".encode("utf-8")
+        first = True
+        for r in query.order_by(model.id).yield_per(DUMP_FETCH_SIZE):
+            d = {c.name: getattr(r, c.name) for c in r.__table__.columns}
+            for k, v in d.items():
+                if isinstance(v, (datetime, date)):
+                    d[k] = v.isoformat()
+            row = json.dumps(d, sort_keys=True)
+            yield (row if first else ", " + row).encode("utf-8")
+            first = False
+        yield b"]"
+    yield b"}"
+
+
+class HashingStream:
+    """Passes chunks through while computing their SHA-256."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.digest = hashlib.sha256()
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.digest.update(chunk)
+            yield chunk
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+def hash_chunks(chunks) -> str:
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def run_tenant_backup(
+    db: Session, tenant: models.Tenant, filename: str, skip_unchanged: bool = True
+):
+    """
+    Writes a backup of the tenant to its configured target.
+
+    With skip_unchanged, the dump is first only hashed; if it matches the last
+    backup nothing is written and backup_verified_at is recorded instead.
+    Returns "uploaded" or "unchanged".
+    """
+    target = backup_targets.get_backup_target(db, tenant)
+    if target is None:
+        raise Exception("No backup destination configured")
+
+    now = datetime.utcnow()
+    if skip_unchanged:
+        content_hash = hash_chunks(iter_json_dump(db, tenant.id))
+        if content_hash == tenant.last_backup_hash:
+            tenant.backup_verified_at = now
+            db.commit()
+            return "unchanged"
+
+    # Single pass: database -> target, hashing what is actually written
+    stream = HashingStream(iter_json_dump(db, tenant.id))
+    target.write(filename, stream)
+
+    tenant.last_backup_at = now
+    tenant.last_backup_hash = stream.hexdigest()
+    db.commit()
+
+    try:
+        enforce_retention(tenant, target)
+    except Exception as e:
+        # Pruning is housekeeping, it must never fail a backup
+        print(f"Retention failed for {tenant.name}: {e}")
+
+    return "uploaded"
+
+
+def reset_backup_state(tenant: models.Tenant):
+    """
+    Forgets what was written where: the next backup is written in full
+    even if the data is unchanged, and an interrupted upload to the old
+    destination is not resumed. Call when the target or account changes.
+    """
+    tenant.last_backup_hash = None
+    tenant.pending_backup = None
+
+
+def resume_pending_backup(db: Session, tenant: models.Tenant):
+    """
+    Finish a write that was interrupted (e.g. by a worker restart) from where
+    it stopped, without dumping the database again.
+    Returns True if a pending write was completed.
+    """
+    target = backup_targets.get_backup_target(db, tenant)
+    pending = target.resume_pending() if target else None
+    if not pending:
+        return False
+
+    # The backup holds the data as of the dump, which may be days old
+    taken_at = pending.get("taken_at")
+    tenant.last_backup_at = (
+        datetime.fromisoformat(taken_at) if taken_at else datetime.utcnow()
+    )
+    if pending.get("hash"):
+        tenant.last_backup_hash = pending["hash"]
+    db.commit()
+    return True
+
+
+def enforce_retention(tenant: models.Tenant, target):
+    """
+    Deletes the tenant's backups that fall outside its daily/weekly/monthly
+    retention policy. Returns the number of files deleted.
+    """
+    to_prune = backup_retention.select_backups_to_prune(
+        target.list_backups(),
+        tenant.name,
+        keep_daily=tenant.backup_keep_daily,
+        keep_weekly=tenant.backup_keep_weekly,
+        keep_monthly=tenant.backup_keep_monthly,
+    )
+    if not to_prune:
+        return 0
+
+    deleted = target.delete([f["id"] for f in to_prune])
+    print(f"Pruned {len(deleted)} old backups for {tenant.name}")
+    return len(deleted)
@@ -0,0 +1,368 @@
+import os
+import json
+import hashlib
+from datetime import datetime
+from sqlalchemy.orm import Session
+from googleapiclient.errors import HttpError
+import httplib2
+from google.auth.exceptions import RefreshError
+from . import models, google_drive_client
+from .backup_retention import safe_filename
+
+TARGET_KINDS = ("drive", "local", "s3")
+
+# Local directory target
+BACKUP_LOCAL_DIR = os.getenv("BACKUP_LOCAL_DIR", "backups")
+
+# S3-compatible target (AWS, MinIO, R2, ...)
+S3_ENDPOINT_URL = os.getenv("BACKUP_S3_ENDPOINT")  # None = AWS
+S3_BUCKET = os.getenv("BACKUP_S3_BUCKET")
+S3_REGION = os.getenv("BACKUP_S3_REGION", "us-east-1")
+S3_PART_SIZE = 8 * 1024 * 1024  # S3 needs >= 5 MiB for every part but the last
+
+# Drive uploads are spooled here (see DriveTarget.write). Dumps include
+# password hashes, so the directory is private to the app user and does not
+# depend on the working directory.
+BACKUP_SPOOL_DIR = os.getenv(
+    "BACKUP_SPOOL_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "backup_spool"),
+)
+# Failed resumes of one interrupted upload before it is dropped for a fresh dump
+RESUME_ATTEMPTS = int(os.getenv("BACKUP_RESUME_ATTEMPTS", "3"))
+
+
+class BackupTarget:
+    """
+    Destination for a tenant's backup files.
+
+    write() consumes an iterable of bytes chunks (e.g. backup_service.iter_json_dump)
+    so a dump can flow straight from the database into the destination.
+    list_backups() returns dicts with "id", "name" and "createdTime" (RFC 3339),
+    the shape backup_retention expects.
+    """
+
+    kind = None
+
+    def write(self, filename: str, chunks) -> str:
+        raise NotImplementedError
+
+    def list_backups(self) -> list:
+        raise NotImplementedError
+
+    def delete(self, ids: list) -> list:
+        raise NotImplementedError
+
+    def resume_pending(self):
+        """Finish an interrupted write. Returns its pending record, or None."""
+        return None
+
+
+class LocalDirectoryTarget(BackupTarget):
+    kind = "local"
+
+    def __init__(self, tenant: models.Tenant, root: str = None):
+        self.directory = os.path.join(root or BACKUP_LOCAL_DIR, f"tenant_{tenant.id}")
+
+    def write(self, filename, chunks):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, safe_filename(filename))
+        # Write under a temporary name so a crash never leaves a truncated
+        # file that looks like a finished backup
+        with open(path + ".part", "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(path + ".part", path)
+        return os.path.basename(path)
+
+    def list_backups(self):
+        if not os.path.isdir(self.directory):
+            return []
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".part"):
+                created = datetime.utcfromtimestamp(entry.stat().st_mtime)
+                files.append(
+                    {
+                        "id": entry.name,
+                        "name": entry.name,
+                        "createdTime": created.isoformat() + "Z",
+                    }
+                )
+        return files
+
+    def delete(self, ids):
+        deleted = []
+        for name in ids:
+            try:
+                os.remove(os.path.join(self.directory, name))
+                deleted.append(name)
+            except OSError as e:
+                print(f"Local backup delete failed for {name}: {e}")
+        return deleted
+
+
+class S3Target(BackupTarget):
+    kind = "s3"
+
+    def __init__(self, tenant: models.Tenant, client=None, bucket: str = None):
+        self.bucket = bucket or S3_BUCKET
+        if not self.bucket:
+            raise Exception("BACKUP_S3_BUCKET is not configured")
+        self.prefix = f"tenant_{tenant.id}/"
+        self.client = client or self._make_client()
+
+    @staticmethod
+    def _make_client():
+        try:
+            import boto3
+        except ImportError:
+            raise Exception(
+                "Missing dependency 'boto3' on server. Please run 'pip install boto3'."
+            )
+        return boto3.client(
+            "s3",
+            endpoint_url=S3_ENDPOINT_URL,
+            region_name=S3_REGION,
+            aws_access_key_id=os.getenv("BACKUP_S3_ACCESS_KEY"),
+            aws_secret_access_key=os.getenv("BACKUP_S3_SECRET_KEY"),
+        )
+
+    def write(self, filename, chunks):
+        key = self.prefix + safe_filename(filename)
+        upload = self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=key, ContentType="application/json"
+        )
+        upload_id = upload["UploadId"]
+        parts = []
+        buffer = bytearray()
+
+        def flush_part():
+            part_number = len(parts) + 1
+            resp = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=bytes(buffer),
+            )
+            parts.append({"ETag": resp["ETag"], "PartNumber": part_number})
+            buffer.clear()
+
+        try:
+            for chunk in chunks:
+                buffer.extend(chunk)
+                if len(buffer) >= S3_PART_SIZE:
+                    flush_part()
+            if buffer or not parts:
+                flush_part()
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id
+            )
+            raise
+        return key
+
+    def list_backups(self):
+        files = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                files.append(
+                    {
+                        "id": obj["Key"],
+                        "name": obj["Key"][len(self.prefix) :],
+                        "createdTime": obj["LastModified"].isoformat(),
+                    }
+                )
+        return files
+
+    def delete(self, ids):
+        deleted = []
+        # delete_objects takes up to 1000 keys per call
+        for i in range(0, len(ids), 1000):
+            resp = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": k} for k in ids[i : i + 1000]]},
+            )
+            deleted.extend(d["Key"] for d in resp.get("Deleted", []))
+            for err in resp.get("Errors", []):
+                print(f"S3 backup delete failed for {err.get('Key')}: {err}")
+        return deleted
+
+
+class DriveTarget(BackupTarget):
+    """
+    Google Drive folder of the tenant. The folder ID is resolved once and kept
+    on the tenant, so a normal upload is one API call.
+
+    Drive's resumable protocol re-sends from arbitrary offsets, so the dump is
+    spooled to a file once. While the upload runs, that file and the Drive
+    session URI are kept in tenant.pending_backup, which lets resume_pending
+    continue the upload after a worker restart.
+    """
+
+    kind = "drive"
+
+    def __init__(self, db: Session, tenant: models.Tenant):
+        self.db = db
+        self.tenant = tenant
+        self.client = google_drive_client.GoogleDriveClient
+
+    @property
+    def token(self):
+        return self.tenant.google_refresh_token
+
+    def get_pending(self):
+        if not self.tenant.pending_backup:
+            return None
+        try:
+            return json.loads(self.tenant.pending_backup)
+        except ValueError:
+            return None
+
+    def write(self, filename, chunks):
+        os.makedirs(BACKUP_SPOOL_DIR, mode=0o700, exist_ok=True)
+        path = os.path.join(BACKUP_SPOOL_DIR, safe_filename(filename))
+        digest = hashlib.sha256()
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                digest.update(chunk)
+                f.write(chunk)
+
+        file_id = self.upload(path, filename, digest.hexdigest())
+        os.remove(path)
+        return file_id
+
+    def upload(self, file_path: str, filename: str, content_hash: str = None):
+        tenant = self.tenant
+        pending = self.get_pending()
+        if not pending or pending.get("path") != file_path:
+            pending = {
+                "path": file_path,
+                "name": filename,
+                "hash": content_hash,
+                # When the data was dumped, not when the upload finishes
+                "taken_at": datetime.utcnow().isoformat(),
+            }
+
+        def save_session(uri):
+            pending["uri"] = uri
+            tenant.pending_backup = json.dumps(pending)
+            self.db.commit()
+
+        tenant.pending_backup = json.dumps(pending)
+        if not tenant.google_folder_id:
+            tenant.google_folder_id = self.client.find_or_create_backup_folder(
+                self.token
+            )
+        self.db.commit()
+
+        def upload():
+            return self.client.upload_file(
+                self.token,
+                file_path,
+                filename,
+                folder_id=tenant.google_folder_id,
+                resume_uri=pending.get("uri"),
+                on_session=save_session,
+            )
+
+        try:
+            file_id = upload()
+        except HttpError as e:
+            if e.resp.status != 404 or pending.get("uri"):
+                raise
+            # The folder was deleted on Drive since we cached it: look it up again
+            print(f"Backup folder {tenant.google_folder_id} missing, resolving again")
+            tenant.google_folder_id = self.client.find_or_create_backup_folder(
+                self.token
+            )
+            self.db.commit()
+            file_id = upload()
+        except RefreshError:
+            self.client.forget_service(self.token)
+            raise
+
+        tenant.pending_backup = None
+        self.db.commit()
+        return file_id
+
+    def resume_pending(self):
+        pending = self.get_pending()
+        if not pending:
+            return None
+        if not os.path.exists(pending["path"]):
+            # Nothing left to resume, the next scheduled run makes a fresh dump
+            self.tenant.pending_backup = None
+            self.db.commit()
+            return None
+
+        print(f"Resuming interrupted backup {pending['name']} for {self.tenant.name}")
+        try:
+            with open(pending["path"], "rb"):
+                pass
+            modified = os.path.getmtime(pending["path"])
+        except OSError as e:
+            print(f"Dropping interrupted backup {pending['name']}: {e}")
+            self.discard_pending(pending)
+            return None
+
+        pending["attempts"] = pending.get("attempts", 0) + 1
+        if not pending.get("taken_at"):
+            # Recorded before taken_at existed: the spool file's age is close
+            pending["taken_at"] = datetime.utcfromtimestamp(modified).isoformat()
+        self.tenant.pending_backup = json.dumps(pending)
+        self.db.commit()
+
+        try:
+            self.upload(pending["path"], pending["name"], pending.get("hash"))
+        except Exception as e:
+            if _is_transient(e) and pending["attempts"] < RESUME_ATTEMPTS:
+                raise
+            # Permanent failure, or out of attempts: drop it so a fresh dump can run
+            print(f"Dropping interrupted backup {pending['name']}: {e}")
+            self.db.rollback()
+            self.discard_pending(pending)
+            return None
+        os.remove(pending["path"])
+        return pending
+
+    def discard_pending(self, pending: dict):
+        try:
+            os.remove(pending["path"])
+        except OSError:
+            pass
+        self.tenant.pending_backup = None
+        self.db.commit()
+
+    def list_backups(self):
+        return self.client.list_folder_files(self.token, self.tenant.google_folder_id)
+
+    def delete(self, ids):
+        return self.client.delete_files(self.token, ids)
+
+
+def _is_transient(error: Exception) -> bool:
+    """Network trouble or a Drive-side hiccup, worth trying again later."""
+    if isinstance(error, HttpError):
+        return error.resp.status in google_drive_client.RETRYABLE_STATUSES
+    return isinstance(error, (OSError, httplib2.HttpLib2Error))
+
+
+def get_backup_target(db: Session, tenant: models.Tenant):
+    """The tenant's configured destination, or None if it is not set up."""
+    kind = tenant.backup_target or "drive"
+    if kind == "local":
+        return LocalDirectoryTarget(tenant)
+    if kind == "s3":
+        return S3Target(tenant)
+    if tenant.google_refresh_token:
+        return DriveTarget(db, tenant)
+    return None
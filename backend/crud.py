@@ -1,6 +1,8 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import func, or_
-from . import models, schemas
+from datetime import date
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import func, or_, case
+from . import models, schemas, reports, tenant_time
+from .arabic import normalize_arabic, name_tokens, to_ascii_digits
 
 
 # --- Tenant CRUD ---
@@ -29,33 +31,231 @@ def get_patient(db: Session, patient_id: int, tenant_id: int):
     )
 
 
-def get_patients(db: Session, tenant_id: int, skip: int = 0, limit: int = 100):
+def get_patient_bundle(db: Session, patient_id: int, tenant_id: int):
+    """
+    The patient with chart, treatments, payments, attachments and
+    prescriptions eager-loaded (one query per collection), or None.
+    """
     return (
         db.query(models.Patient)
-        .filter(models.Patient.tenant_id == tenant_id)
-        .offset(skip)
-        .limit(limit)
-        .all()
+        .options(
+            selectinload(models.Patient.tooth_statuses),
+            selectinload(models.Patient.treatments),
+            selectinload(models.Patient.payments),
+            selectinload(models.Patient.attachments),
+            selectinload(models.Patient.prescriptions),
+        )
+        .filter(models.Patient.id == patient_id, models.Patient.tenant_id == tenant_id)
+        .first()
     )
 
 
+def patient_balance(patient: models.Patient, treatments: list) -> dict:
+    """
+    The patient's balance from the running totals kept on the row
+    (adjust_patient_balance); only the cost/discount split is summed from
+    the already loaded treatments.
+    """
+    return {
+        "total_cost": sum(t.cost or 0 for t in treatments),
+        "total_discount": sum(t.discount or 0 for t in treatments),
+        "total_due": patient.total_due or 0.0,
+        "total_paid": patient.total_paid or 0.0,
+        "balance": patient.balance or 0.0,
+    }
+
+
+def get_patients(
+    db: Session,
+    tenant_id: int,
+    skip: int = 0,
+    limit: int = 100,
+    has_balance: bool = False,
+):
+    query = db.query(models.Patient).filter(models.Patient.tenant_id == tenant_id)
+    if has_balance:
+        # Debtors, largest debt first (ix_patients_tenant_balance)
+        query = query.filter(models.Patient.balance > 0).order_by(
+            models.Patient.balance.desc(), models.Patient.id
+        )
+    return query.offset(skip).limit(limit).all()
+
+
+def adjust_patient_balance(db: Session, patient_id: int, due: float = 0.0, paid: float = 0.0):
+    """
+    Adds to a patient's running totals inside the caller's transaction (the
+    caller commits). A single UPDATE, so concurrent changes don't overwrite
+    each other.
+    """
+    due, paid = due or 0.0, paid or 0.0
+    if not due and not paid:
+        return
+    db.query(models.Patient).filter(models.Patient.id == patient_id).update(
+        {
+            models.Patient.total_due: func.coalesce(models.Patient.total_due, 0) + due,
+            models.Patient.total_paid: func.coalesce(models.Patient.total_paid, 0) + paid,
+            models.Patient.balance: func.coalesce(models.Patient.balance, 0) + due - paid,
+        },
+        synchronize_session=False,
+    )
+
+
+def recompute_patient_balances(db: Session, tenant_id: int = None):
+    """Sets the running totals from the treatments and payments. Returns the number of patients."""
+    due = (
+        db.query(
+            func.coalesce(
+                func.sum(
+                    func.coalesce(models.Treatment.cost, 0)
+                    - func.coalesce(models.Treatment.discount, 0)
+                ),
+                0,
+            )
+        )
+        .filter(models.Treatment.patient_id == models.Patient.id)
+        .scalar_subquery()
+    )
+    paid = (
+        db.query(func.coalesce(func.sum(models.Payment.amount), 0))
+        .filter(models.Payment.patient_id == models.Patient.id)
+        .scalar_subquery()
+    )
+    query = db.query(models.Patient)
+    if tenant_id is not None:
+        query = query.filter(models.Patient.tenant_id == tenant_id)
+    updated = query.update(
+        {
+            models.Patient.total_due: due,
+            models.Patient.total_paid: paid,
+            models.Patient.balance: due - paid,
+        },
+        synchronize_session=False,
+    )
+    db.commit()
+    return updated
+
+
 def search_patients(db: Session, query: str, tenant_id: int):
     search = f"%{query}%"
+    conditions = [
+        models.Patient.name.ilike(search),
+        models.Patient.phone.ilike(search),
+        models.Patient.address.ilike(search),
+    ]
+    # "احمد" finds "أحمد", "فاطمة" finds "فاطمه", ٠١٠ finds 010
+    normalized = normalize_arabic(query)
+    if normalized:
+        conditions.append(models.Patient.search_name.ilike(f"%{normalized}%"))
+        conditions.append(models.Patient.phone.ilike(f"%{normalized}%"))
     return (
         db.query(models.Patient)
-        .filter(
-            models.Patient.tenant_id == tenant_id,
-            or_(
-                models.Patient.name.ilike(search),
-                models.Patient.phone.ilike(search),
-                models.Patient.address.ilike(search),
-            ),
-        )
+        .filter(models.Patient.tenant_id == tenant_id, or_(*conditions))
         .limit(5)
         .all()
     )
 
 
+def fill_patient_search_names(db: Session, batch_size: int = 500):
+    """Sets search_name where it is missing. Returns the number of patients updated."""
+    filled = 0
+    while True:
+        patients = (
+            db.query(models.Patient)
+            .filter(models.Patient.search_name.is_(None))
+            .limit(batch_size)
+            .all()
+        )
+        if not patients:
+            return filled
+        for patient in patients:
+            patient.search_name = normalize_arabic(patient.name)
+        db.commit()
+        filled += len(patients)
+
+
+def _phone_digits(phone: str) -> str:
+    return "".join(ch for ch in to_ascii_digits(phone or "") if ch.isdigit())
+
+
+def _phone_key(phone: str):
+    """
+    National number of a phone, for matching regardless of how it was typed:
+    digits only, without the 0020/+20 country code or the leading 0.
+    None if too short to identify anyone.
+    """
+    digits = _phone_digits(phone)
+    for prefix in ("0020", "20", "0"):
+        if digits.startswith(prefix) and len(digits) - len(prefix) >= 10:
+            digits = digits[len(prefix) :]
+            break
+    return digits[-10:] if len(digits) >= 10 else None
+
+
+def _stored_phone_digits():
+    # Patient.phone without the separators people type (spaces, +, -, brackets)
+    column = models.Patient.phone
+    for separator in (" ", "+", "-", "(", ")"):
+        column = func.replace(column, separator, "")
+    return column
+
+
+def find_patient_candidates(
+    db: Session, tenant_id: int, name: str = "", phone: str = "", limit: int = 5
+):
+    """
+    Existing patients who may be the one on a scanned card, best first, as
+    (patient, score 0..1, matched_on) tuples. Matches on the phone's national
+    number and on normalized name words.
+    """
+    phone_key = _phone_key(phone)
+    tokens = [token for token in name_tokens(name) if len(token) > 1]
+
+    # 1. Phone matches, queried on their own so that patients sharing a
+    # common first name can't crowd them out of the name lookup's limit
+    rows = {}
+    if phone_key:
+        for patient in (
+            db.query(models.Patient)
+            .filter(
+                models.Patient.tenant_id == tenant_id,
+                _stored_phone_digits().contains(phone_key),
+            )
+            .limit(limit)
+        ):
+            rows[patient.id] = patient
+
+    # 2. Name matches
+    if tokens:
+        conditions = [
+            models.Patient.search_name.ilike(f"%{token}%") for token in tokens[:4]
+        ]
+        for patient in (
+            db.query(models.Patient)
+            .filter(models.Patient.tenant_id == tenant_id, or_(*conditions))
+            .limit(50)
+        ):
+            rows.setdefault(patient.id, patient)
+
+    candidates = []
+    for patient in rows.values():
+        matched_on = []
+        score = 0.0
+        if phone_key and phone_key in _phone_digits(patient.phone):
+            matched_on.append("phone")
+            score += 0.5
+        patient_tokens = set(name_tokens(patient.name))
+        if tokens and patient_tokens:
+            common = len(set(tokens) & patient_tokens)
+            if common:
+                matched_on.append("name")
+                score += 0.5 * common / max(len(set(tokens)), len(patient_tokens))
+        if score >= 0.2:
+            candidates.append((patient, round(score, 2), matched_on))
+
+    candidates.sort(key=lambda candidate: -candidate[1])
+    return candidates[:limit]
+
+
 def create_patient(db: Session, patient: schemas.PatientCreate, tenant_id: int):
     db_patient = models.Patient(**patient.dict(), tenant_id=tenant_id)
     db.add(db_patient)
@@ -81,6 +281,8 @@ def delete_patient(db: Session, patient_id: int, tenant_id: int):
     if db_patient:
         db.delete(db_patient)
         db.commit()
+        # Their treatments and payments may be in any period
+        reports.invalidate(tenant_id)
     return db_patient
 
 
@@ -97,8 +299,78 @@ def get_appointments(db: Session, tenant_id: int, skip: int = 0, limit: int = 10
     )
 
 
-def create_appointment(db: Session, appointment: schemas.AppointmentCreate):
-    db_appointment = models.Appointment(**appointment.dict())
+def get_appointment_calendar(db: Session, tenant_id: int, start, end):
+    """
+    Appointments with date_time in [start, end), oldest first, as compact
+    rows with the patient's name. Uses the (tenant_id, date_time) index.
+    """
+    return (
+        db.query(
+            models.Appointment.id,
+            models.Appointment.patient_id,
+            models.Appointment.date_time,
+            models.Appointment.status,
+            models.Appointment.notes,
+            models.Patient.name.label("patient_name"),
+        )
+        .join(models.Patient, models.Appointment.patient_id == models.Patient.id)
+        .filter(
+            models.Appointment.tenant_id == tenant_id,
+            models.Appointment.date_time >= start,
+            models.Appointment.date_time < end,
+        )
+        .order_by(models.Appointment.date_time, models.Appointment.id)
+        .all()
+    )
+
+
+def get_appointment_day_counts(db: Session, tenant_id: int, start, end):
+    """Per-day appointment counts in [start, end) as (date, total, cancelled) rows."""
+    day = reports.bucket_expression(db, models.Appointment.date_time, "day")
+    cancelled = func.sum(
+        case(
+            (models.Appointment.status.in_(("Cancelled", "No Show")), 1),
+            else_=0,
+        )
+    )
+    rows = (
+        db.query(day, func.count(models.Appointment.id), cancelled)
+        .filter(
+            models.Appointment.tenant_id == tenant_id,
+            models.Appointment.date_time >= start,
+            models.Appointment.date_time < end,
+        )
+        .group_by(day)
+        .order_by(day)
+        .all()
+    )
+    # SQLite returns the day as text, Postgres as a timestamp
+    return [
+        (date.fromisoformat(str(value)[:10]), total, cancelled or 0)
+        for value, total, cancelled in rows
+    ]
+
+
+def fill_appointment_tenants(db: Session):
+    """Sets tenant_id from the patient where it is missing. Returns the number of appointments updated."""
+    owner = (
+        db.query(models.Patient.tenant_id)
+        .filter(models.Patient.id == models.Appointment.patient_id)
+        .scalar_subquery()
+    )
+    updated = (
+        db.query(models.Appointment)
+        .filter(models.Appointment.tenant_id.is_(None))
+        .update({models.Appointment.tenant_id: owner}, synchronize_session=False)
+    )
+    db.commit()
+    return updated
+
+
+def create_appointment(
+    db: Session, appointment: schemas.AppointmentCreate, tenant_id: int
+):
+    db_appointment = models.Appointment(**appointment.dict(), tenant_id=tenant_id)
     db.add(db_appointment)
     db.commit()
     db.refresh(db_appointment)
@@ -163,9 +435,14 @@ def update_tooth_status(db: Session, status: schemas.ToothStatusCreate, tenant_i
 
 
 # --- Treatment CRUD ---
+def _treatment_due(treatment) -> float:
+    return (treatment.cost or 0.0) - (treatment.discount or 0.0)
+
+
 def create_treatment(db: Session, treatment: schemas.TreatmentCreate):
     db_treatment = models.Treatment(**treatment.dict())
     db.add(db_treatment)
+    adjust_patient_balance(db, treatment.patient_id, due=_treatment_due(treatment))
     db.commit()
     db.refresh(db_treatment)
     return db_treatment
@@ -193,8 +470,10 @@ def delete_treatment(db: Session, treatment_id: int, tenant_id: int):
         .first()
     )
     if db_obj:
+        adjust_patient_balance(db, db_obj.patient_id, due=-_treatment_due(db_obj))
         db.delete(db_obj)
         db.commit()
+        reports.invalidate(tenant_id, db_obj.date)
     return db_obj
 
 
@@ -210,10 +489,20 @@ def update_treatment(
         .first()
     )
     if db_treatment:
+        old_date = db_treatment.date
+        adjust_patient_balance(
+            db, db_treatment.patient_id, due=-_treatment_due(db_treatment)
+        )
         for key, value in treatment.dict().items():
             setattr(db_treatment, key, value)
+        adjust_patient_balance(
+            db, db_treatment.patient_id, due=_treatment_due(db_treatment)
+        )
         db.commit()
         db.refresh(db_treatment)
+        # Moved to another period: both lose their cached figures
+        reports.invalidate(tenant_id, old_date)
+        reports.invalidate(tenant_id, db_treatment.date)
     return db_treatment
 
 
@@ -227,8 +516,10 @@ def create_payment(db: Session, payment: schemas.PaymentCreate, tenant_id: int):
         return None  # Or raise error
     db_payment = models.Payment(**payment.dict())
     db.add(db_payment)
+    adjust_patient_balance(db, payment.patient_id, paid=payment.amount)
     db.commit()
     db.refresh(db_payment)
+    reports.invalidate(tenant_id, db_payment.date)
     return db_payment
 
 
@@ -271,12 +562,14 @@ def delete_payment(db: Session, payment_id: int, tenant_id: int):
         .first()
     )
     if db_obj:
+        adjust_patient_balance(db, db_obj.patient_id, paid=-db_obj.amount)
         db.delete(db_obj)
         db.commit()
+        reports.invalidate(tenant_id, db_obj.date)
     return db_obj
 
 
-def get_financial_stats(db: Session, tenant_id: int):
+def get_financial_stats(db: Session, tenant_id: int, today=None):
     # Filter payments by tenant via patient
     total_received = (
         db.query(func.sum(models.Payment.amount))
@@ -314,39 +607,33 @@ def get_financial_stats(db: Session, tenant_id: int):
     )
     net_profit = total_received - total_expenses
 
-    # Daily Stats (Today)
-    from datetime import datetime, date
-
-    # Simple date filtering for daily stats
-    today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    # Daily Stats (the clinic's today, see tenant_time)
+    today = today or tenant_time.tenant_today(db, tenant_id)
 
     today_received = (
         db.query(func.sum(models.Payment.amount))
         .join(models.Patient)
         .filter(
-            models.Patient.tenant_id == tenant_id, models.Payment.date >= today_start
+            models.Patient.tenant_id == tenant_id,
+            models.Payment.date >= today.utc_start,
+            models.Payment.date < today.utc_end,
         )
         .scalar()
         or 0.0
     )
 
-    today_treat_total = (
-        db.query(func.sum(models.Treatment.cost))
-        .join(models.Patient)
-        .filter(
-            models.Patient.tenant_id == tenant_id, models.Treatment.date >= today_start
+    today_treat_total, today_disc_total = (
+        db.query(
+            func.coalesce(func.sum(models.Treatment.cost), 0.0),
+            func.coalesce(func.sum(models.Treatment.discount), 0.0),
         )
-        .scalar()
-        or 0.0
-    )
-    today_disc_total = (
-        db.query(func.sum(models.Treatment.discount))
         .join(models.Patient)
         .filter(
-            models.Patient.tenant_id == tenant_id, models.Treatment.date >= today_start
+            models.Patient.tenant_id == tenant_id,
+            models.Treatment.date >= today.utc_start,
+            models.Treatment.date < today.utc_end,
         )
-        .scalar()
-        or 0.0
+        .one()
     )
     today_revenue = today_treat_total - today_disc_total
 
@@ -357,7 +644,7 @@ def get_financial_stats(db: Session, tenant_id: int):
     today_expenses = (
         db.query(func.sum(models.Expense.cost))
         .filter(
-            models.Expense.tenant_id == tenant_id, models.Expense.date == date.today()
+            models.Expense.tenant_id == tenant_id, models.Expense.date == today.day
         )
         .scalar()
         or 0.0
@@ -378,8 +665,9 @@ def get_financial_stats(db: Session, tenant_id: int):
 
 
 def get_dashboard_stats(db: Session, tenant_id: int):
-    # Reuse financial stats logic
-    fin_stats = get_financial_stats(db, tenant_id)
+    # Reuse financial stats logic, with the same day bounds
+    today = tenant_time.tenant_today(db, tenant_id)
+    fin_stats = get_financial_stats(db, tenant_id, today)
 
     # 1. Total Patients Count (O(1) with optimized count)
     total_patients = (
@@ -388,17 +676,13 @@ def get_dashboard_stats(db: Session, tenant_id: int):
         .scalar()
     )
 
-    # 2. Today's Appointments Count
-    from datetime import datetime
-
-    today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-
+    # 2. Today's Appointments Count (date_time is the clinic's wall-clock time)
     total_appointments_today = (
         db.query(func.count(models.Appointment.id))
-        .join(models.Patient)
         .filter(
-            models.Patient.tenant_id == tenant_id,
-            func.date(models.Appointment.date_time) == func.date(today_start),
+            models.Appointment.tenant_id == tenant_id,
+            models.Appointment.date_time >= today.local_start,
+            models.Appointment.date_time < today.local_end,
         )
         .scalar()
     )
@@ -528,6 +812,18 @@ def get_patient_attachments(db: Session, patient_id: int, tenant_id: int):
     )
 
 
+def get_attachment(db: Session, attachment_id: int, tenant_id: int):
+    return (
+        db.query(models.Attachment)
+        .join(models.Patient)
+        .filter(
+            models.Attachment.id == attachment_id,
+            models.Patient.tenant_id == tenant_id,
+        )
+        .first()
+    )
+
+
 def delete_attachment(db: Session, attachment_id: int, tenant_id: int):
     attachment = (
         db.query(models.Attachment)
@@ -543,11 +839,103 @@ def delete_attachment(db: Session, attachment_id: int, tenant_id: int):
     return attachment
 
 
+# --- Blob CRUD (content-addressed attachment storage) ---
+def get_blob(db: Session, sha256: str):
+    return db.query(models.Blob).filter(models.Blob.sha256 == sha256).first()
+
+
+def create_blob(db: Session, sha256: str, size: int, file_path: str):
+    db_blob = models.Blob(sha256=sha256, size=size, file_path=file_path, ref_count=1)
+    db.add(db_blob)
+    db.commit()
+    db.refresh(db_blob)
+    return db_blob
+
+
+def add_blob_reference(db: Session, sha256: str):
+    # Atomic increment, concurrent uploads of the same file can't lose a count
+    db.query(models.Blob).filter(models.Blob.sha256 == sha256).update(
+        {models.Blob.ref_count: models.Blob.ref_count + 1},
+        synchronize_session=False,
+    )
+    db.commit()
+
+
+def release_blob(db: Session, sha256: str, attachment_id: int = None):
+    """
+    Drops one reference (of attachment `attachment_id`, about to be deleted).
+    Returns the blob if that was the last one (the row is deleted and its
+    stored file can go), otherwise None. A count that drifted below the
+    attachments actually using the blob is corrected instead.
+    """
+    db.query(models.Blob).filter(models.Blob.sha256 == sha256).update(
+        {models.Blob.ref_count: models.Blob.ref_count - 1},
+        synchronize_session=False,
+    )
+    db_blob = (
+        db.query(models.Blob)
+        .filter(models.Blob.sha256 == sha256, models.Blob.ref_count <= 0)
+        .first()
+    )
+    if db_blob:
+        others = db.query(func.count(models.Attachment.id)).filter(
+            models.Attachment.content_hash == sha256
+        )
+        if attachment_id is not None:
+            others = others.filter(models.Attachment.id != attachment_id)
+        others = others.scalar()
+        if others:
+            db_blob.ref_count = others
+            db_blob = None
+        else:
+            db.delete(db_blob)
+    db.commit()
+    return db_blob
+
+
+def blob_in_use(db: Session, sha256: str) -> bool:
+    """True if the content has a blob row or any attachment pointing at it."""
+    return bool(
+        db.query(models.Blob.sha256).filter(models.Blob.sha256 == sha256).first()
+        or db.query(models.Attachment.id)
+        .filter(models.Attachment.content_hash == sha256)
+        .first()
+    )
+
+
+def sync_blob_references(db: Session, hashes: list, chunk_size: int = 500):
+    """Sets ref_count of the given blobs to the number of attachments using them."""
+    used = (
+        db.query(func.count(models.Attachment.id))
+        .filter(models.Attachment.content_hash == models.Blob.sha256)
+        .scalar_subquery()
+    )
+    hashes = list(hashes)
+    for start in range(0, len(hashes), chunk_size):
+        db.query(models.Blob).filter(
+            models.Blob.sha256.in_(hashes[start : start + chunk_size])
+        ).update({models.Blob.ref_count: used}, synchronize_session=False)
+    db.commit()
+
+
+def find_tenant_attachment_by_hash(db: Session, sha256: str, tenant_id: int):
+    return (
+        db.query(models.Attachment)
+        .join(models.Patient)
+        .filter(
+            models.Attachment.content_hash == sha256,
+            models.Patient.tenant_id == tenant_id,
+        )
+        .first()
+    )
+
+
 def create_expense(db: Session, expense: schemas.ExpenseCreate, tenant_id: int):
     db_expense = models.Expense(**expense.dict(), tenant_id=tenant_id)
     db.add(db_expense)
     db.commit()
     db.refresh(db_expense)
+    reports.invalidate(tenant_id, db_expense.date)
     return db_expense
 
 
@@ -571,6 +959,8 @@ def delete_expense(db: Session, expense_id: int, tenant_id: int):
     if expense:
         db.delete(expense)
     db.commit()
+    if expense:
+        reports.invalidate(tenant_id, expense.date)
     return expense
 
 
@@ -2,12 +2,16 @@ import os
 import json
 import sched
 import time
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
+import httplib2
 
 # SCOPES needed
 SCOPES = ["https://www.googleapis.com/auth/drive.file"]
@@ -32,6 +36,36 @@ CLIENT_CONFIG = {
 }
 
 
+# Upload tuning. Drive requires chunks in multiples of 256 KiB.
+UPLOAD_CHUNK_SIZE = int(os.getenv("DRIVE_UPLOAD_CHUNK_SIZE", 5 * 1024 * 1024))
+UPLOAD_RETRIES = int(os.getenv("DRIVE_UPLOAD_RETRIES", "5"))
+UPLOAD_BACKOFF_SECONDS = float(os.getenv("DRIVE_UPLOAD_BACKOFF_SECONDS", "1"))
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+DELETE_BATCH_SIZE = 100  # Drive's limit of calls per batch request
+
+BACKUP_FOLDER_NAME = "DentalSaaS Backups"
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+
+class _CachedService:
+    def __init__(self, creds, service):
+        self.creds = creds
+        self.service = service
+        self.lock = threading.Lock()
+
+
+# One Credentials + built service per refresh token (i.e. per tenant), so
+# steady-state uploads skip the discovery build and reuse the access token
+# until it expires.
+_service_cache = {}
+_cache_lock = threading.Lock()
+
+
+def build_service(creds):
+    # Module-level so a local fake Drive can be swapped in for testing
+    return build("drive", "v3", credentials=creds, cache_discovery=False)
+
+
 class GoogleDriveClient:
     def __init__(self, redirect_uri: str):
         self.flow = Flow.from_client_config(
@@ -66,48 +100,199 @@ class GoogleDriveClient:
         }
 
     @staticmethod
-    def upload_file(refresh_token: str, file_path: str, filename: str):
+    @contextmanager
+    def drive_service(refresh_token: str):
         """
-        Uploads a file using the user's refresh token.
+        Yields the cached Drive service for this refresh token, refreshing the
+        access token only when it is missing or expired.
         """
         if not refresh_token:
             raise Exception("No refresh token provided")
 
-        creds = Credentials(
-            None,  # access_token (will be refreshed)
-            refresh_token=refresh_token,
-            token_uri=CLIENT_CONFIG["web"]["token_uri"],
-            client_id=CLIENT_CONFIG["web"]["client_id"],
-            client_secret=CLIENT_CONFIG["web"]["client_secret"],
-            scopes=SCOPES,
-        )
+        with _cache_lock:
+            entry = _service_cache.get(refresh_token)
+            if entry is None:
+                creds = Credentials(
+                    None,  # access_token (will be refreshed)
+                    refresh_token=refresh_token,
+                    token_uri=CLIENT_CONFIG["web"]["token_uri"],
+                    client_id=CLIENT_CONFIG["web"]["client_id"],
+                    client_secret=CLIENT_CONFIG["web"]["client_secret"],
+                    scopes=SCOPES,
+                )
+                entry = _CachedService(creds, build_service(creds))
+                _service_cache[refresh_token] = entry
+
+        # The underlying http object is not thread-safe: one user per tenant
+        with entry.lock:
+            if not entry.creds.valid:
+                entry.creds.refresh(Request())
+            yield entry.service
 
-        service = build("drive", "v3", credentials=creds)
+    @staticmethod
+    def forget_service(refresh_token: str):
+        # Called when the token is revoked/replaced so a stale entry is not reused
+        with _cache_lock:
+            _service_cache.pop(refresh_token, None)
+
+    @staticmethod
+    def find_or_create_backup_folder(refresh_token: str):
+        with GoogleDriveClient.drive_service(refresh_token) as service:
+            query = f"name='{BACKUP_FOLDER_NAME}' and mimeType='{FOLDER_MIME_TYPE}' and trashed=false"
+            results = service.files().list(q=query, fields="files(id)").execute()
+            files = results.get("files", [])
 
-        # 1. Search for "DentalSaaS Backups" folder
-        folder_id = None
-        query = "name='DentalSaaS Backups' and mimeType='application/vnd.google-apps.folder' and trashed=false"
-        results = service.files().list(q=query, fields="files(id)").execute()
-        files = results.get("files", [])
+            if files:
+                return files[0]["id"]
 
-        if not files:
-            # Create folder
-            folder_metadata = {
-                "name": "DentalSaaS Backups",
-                "mimeType": "application/vnd.google-apps.folder",
-            }
+            folder_metadata = {"name": BACKUP_FOLDER_NAME, "mimeType": FOLDER_MIME_TYPE}
             folder = service.files().create(body=folder_metadata, fields="id").execute()
-            folder_id = folder.get("id")
-        else:
-            folder_id = files[0]["id"]
-
-        # 2. Upload File
-        file_metadata = {"name": filename, "parents": [folder_id]}
-        media = MediaFileUpload(file_path, mimetype="application/json", resumable=True)
-
-        file = (
-            service.files()
-            .create(body=file_metadata, media_body=media, fields="id")
-            .execute()
-        )
-        return file.get("id")
+            return folder.get("id")
+
+    @staticmethod
+    def list_folder_files(refresh_token: str, folder_id: str):
+        """Lists all (non-trashed) files in the folder, following pagination."""
+        files = []
+        page_token = None
+        with GoogleDriveClient.drive_service(refresh_token) as service:
+            while True:
+                results = (
+                    service.files()
+                    .list(
+                        q=f"'{folder_id}' in parents and trashed=false",
+                        fields="nextPageToken, files(id, name, createdTime)",
+                        pageSize=1000,
+                        pageToken=page_token,
+                    )
+                    .execute()
+                )
+                files.extend(results.get("files", []))
+                page_token = results.get("nextPageToken")
+                if not page_token:
+                    return files
+
+    @staticmethod
+    def delete_files(refresh_token: str, file_ids: list):
+        """
+        Deletes files using batch requests (up to 100 deletes per HTTP call).
+        Returns the IDs that were deleted.
+        """
+        deleted = []
+
+        def on_delete(request_id, response, exception):
+            if exception is not None:
+                print(f"Drive delete failed for {request_id}: {exception}")
+            else:
+                deleted.append(request_id)
+
+        with GoogleDriveClient.drive_service(refresh_token) as service:
+            for i in range(0, len(file_ids), DELETE_BATCH_SIZE):
+                batch = service.new_batch_http_request(callback=on_delete)
+                for file_id in file_ids[i : i + DELETE_BATCH_SIZE]:
+                    batch.add(service.files().delete(fileId=file_id), request_id=file_id)
+                batch.execute()
+        return deleted
+
+    @staticmethod
+    def upload_file(
+        refresh_token: str,
+        file_path: str,
+        filename: str,
+        folder_id: str = None,
+        resume_uri: str = None,
+        on_session=None,
+    ):
+        """
+        Uploads a file using the user's refresh token.
+        Pass the tenant's known folder_id to skip the folder lookup.
+
+        The upload is chunked and resumable: transient failures are retried
+        with exponential backoff from the last byte Drive acknowledged.
+        `on_session(uri)` is called once the upload session exists, so the
+        caller can persist it and pass it back as `resume_uri` after a crash.
+        """
+        if not folder_id:
+            folder_id = GoogleDriveClient.find_or_create_backup_folder(refresh_token)
+
+        with GoogleDriveClient.drive_service(refresh_token) as service:
+            file_metadata = {"name": filename, "parents": [folder_id]}
+            media = MediaFileUpload(
+                file_path,
+                mimetype="application/json",
+                chunksize=UPLOAD_CHUNK_SIZE,
+                resumable=True,
+            )
+            request = service.files().create(
+                body=file_metadata, media_body=media, fields="id"
+            )
+
+            if resume_uri:
+                request.resumable_uri = resume_uri
+
+            response = None
+            attempt = 0
+            announced_uri = resume_uri
+            # After a crash or a failed chunk our local offset may be ahead of
+            # or behind what Drive kept, so ask before sending more bytes.
+            sync_offset = bool(resume_uri)
+            while response is None:
+                try:
+                    if sync_offset:
+                        response = _sync_upload_offset(request)
+                        sync_offset = False
+                        if response is not None:
+                            break
+                    _, response = request.next_chunk(num_retries=UPLOAD_RETRIES)
+                    attempt = 0
+                except HttpError as e:
+                    status = e.resp.status
+                    if resume_uri and status in (404, 410):
+                        # Session expired (they last about a week): start over
+                        print(f"Upload session for {filename} expired, restarting")
+                        resume_uri = None
+                        sync_offset = False
+                        request.resumable_uri = None
+                        request.resumable_progress = 0
+                        continue
+                    if status not in RETRYABLE_STATUSES:
+                        raise
+                    attempt = _backoff(attempt, e)
+                    sync_offset = bool(request.resumable_uri)
+                except (OSError, httplib2.HttpLib2Error) as e:
+                    attempt = _backoff(attempt, e)
+                    sync_offset = bool(request.resumable_uri)
+
+                if on_session and request.resumable_uri != announced_uri:
+                    announced_uri = request.resumable_uri
+                    on_session(announced_uri)
+
+            return response.get("id")
+
+
+def _sync_upload_offset(request):
+    """
+    Asks Drive how many bytes of the resumable session it has committed and
+    moves the request there. Returns the file resource if the upload had
+    already completed, else None.
+    """
+    size = request.resumable.size()
+    headers = {"Content-Range": f"bytes */{size}", "Content-Length": "0"}
+    resp, content = request.http.request(request.resumable_uri, "PUT", headers=headers)
+    if resp.status in (200, 201):
+        return request.postproc(resp, content)
+    if resp.status != 308:
+        raise HttpError(resp, content, uri=request.resumable_uri)
+    # No Range header means Drive has nothing yet; "bytes=0-N" means N is the last byte kept
+    committed = resp.get("range")
+    request.resumable_progress = int(committed.split("-")[1]) + 1 if committed else 0
+    return None
+
+
+def _backoff(attempt: int, error: Exception):
+    attempt += 1
+    if attempt > UPLOAD_RETRIES:
+        raise error
+    delay = min(UPLOAD_BACKOFF_SECONDS * 2 ** (attempt - 1), 60)
+    print(f"Drive upload error ({error}), retry {attempt} in {delay}s")
+    time.sleep(delay)
+    return attempt
@@ -7,16 +7,25 @@ from fastapi import (
     UploadFile,
     Form,
     BackgroundTasks,
+    Request,
+    Query,
+)
+from fastapi.responses import (
+    JSONResponse,
+    RedirectResponse,
+    StreamingResponse,
 )
-from fastapi.responses import JSONResponse, FileResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from .static_files import SignedStaticFiles
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 import shutil
 import os
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
+from urllib.parse import quote
 import json
 
 # Clean Environment Variables (Crucial for Cloudinary/DB stability)
@@ -36,10 +45,25 @@ if os.environ.get("CLOUDINARY_URL"):
     else:
         os.environ["CLOUDINARY_URL"] = val
 
-from . import models, schemas, crud, database, auth, backup_service, google_drive_client
-import cloudinary
-import cloudinary.uploader
-import cloudinary.api
+from . import (
+    models,
+    schemas,
+    crud,
+    database,
+    auth,
+    backup_service,
+    backup_targets,
+    google_drive_client,
+    attachment_service,
+    thumbnail_service,
+    storage_gc,
+    upload_guard,
+    ocr_service,
+    ocr_cache,
+    patient_card,
+    reports,
+    tenant_time,
+)
 from apscheduler.schedulers.background import BackgroundScheduler
 import pytz
 
@@ -63,24 +87,73 @@ def check_and_migrate_tables():
                 conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {col_def}"))
                 conn.commit()
                 print(f"Added column {col_def} to {table}")
+                return True
         except Exception as e:
             # Ignore error if column likely exists, but log it just in case
             print(f"Migration skipped for {table}.{col_def}: {e}")
-            pass
+            return False
+
+    def run_safe(statement):
+        try:
+            with database.engine.connect() as conn:
+                conn.execute(text(statement))
+                conn.commit()
+        except Exception as e:
+            print(f"Migration step skipped ({statement}): {e}")
+
+    def create_index_safe(name, table, columns):
+        try:
+            with database.engine.connect() as conn:
+                conn.execute(
+                    text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+                )
+                conn.commit()
+        except Exception as e:
+            print(f"Index skipped {name}: {e}")
 
     # Treatments
     add_column_safe("treatments", "canal_count INTEGER")
     add_column_safe("treatments", "canal_lengths VARCHAR")
     add_column_safe("treatments", "sessions TEXT")
     add_column_safe("treatments", "complications TEXT")
+    create_index_safe("ix_treatments_patient_date", "treatments", "patient_id, date")
+
+    # Date ranges of the reports
+    create_index_safe("ix_treatments_date", "treatments", "date")
+    create_index_safe("ix_payments_date", "payments", "date")
+    create_index_safe("ix_expenses_tenant_date", "expenses", "tenant_id, date")
 
     # Attachments
     add_column_safe("attachments", "filename VARCHAR")
     add_column_safe("attachments", "file_type VARCHAR")
+    add_column_safe("attachments", "status VARCHAR DEFAULT 'ready'")
+    add_column_safe("attachments", "upload_attempts INTEGER DEFAULT 0")
+    add_column_safe("attachments", "next_attempt_at TIMESTAMP")
+    add_column_safe("attachments", "content_hash VARCHAR")
+    add_column_safe("attachments", "thumbnail_url VARCHAR")
+    add_column_safe("attachments", "preview_url VARCHAR")
+    add_column_safe("attachments", "thumbnail_error VARCHAR")
 
     # Multi-tenancy
     add_column_safe("patients", "tenant_id INTEGER REFERENCES tenants(id)")
+    add_column_safe("patients", "search_name VARCHAR")
+    # search_name is matched with %word%: a btree index can't serve that, a
+    # trigram index can (Postgres, needs the pg_trgm extension)
+    run_safe("DROP INDEX IF EXISTS ix_patients_search_name")
+    if database.engine.dialect.name == "postgresql":
+        run_safe("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        run_safe(
+            "CREATE INDEX IF NOT EXISTS ix_patients_search_name_trgm "
+            "ON patients USING gin (search_name gin_trgm_ops)"
+        )
+    balances_added = add_column_safe("patients", "total_due FLOAT DEFAULT 0")
+    add_column_safe("patients", "total_paid FLOAT DEFAULT 0")
+    add_column_safe("patients", "balance FLOAT DEFAULT 0")
+    create_index_safe("ix_patients_tenant_balance", "patients", "tenant_id, balance")
     add_column_safe("appointments", "tenant_id INTEGER REFERENCES tenants(id)")
+    create_index_safe(
+        "ix_appointments_tenant_date", "appointments", "tenant_id, date_time"
+    )
     add_column_safe("users", "tenant_id INTEGER REFERENCES tenants(id)")
     add_column_safe("users", "role VARCHAR DEFAULT 'doctor'")
     add_column_safe("tenants", "logo VARCHAR")
@@ -88,8 +161,50 @@ def check_and_migrate_tables():
     add_column_safe("tenants", "plan VARCHAR DEFAULT 'trial'")
     add_column_safe("tenants", "is_active BOOLEAN DEFAULT TRUE")
     add_column_safe("tenants", "backup_frequency VARCHAR DEFAULT 'off'")
+    add_column_safe("tenants", "backup_target VARCHAR DEFAULT 'drive'")
     add_column_safe("tenants", "google_refresh_token VARCHAR")
+    add_column_safe("tenants", "google_folder_id VARCHAR")
     add_column_safe("tenants", "last_backup_at TIMESTAMP")
+    add_column_safe("tenants", "last_backup_hash VARCHAR")
+    add_column_safe("tenants", "backup_verified_at TIMESTAMP")
+    add_column_safe("tenants", "pending_backup TEXT")
+    add_column_safe("tenants", "backup_keep_daily INTEGER DEFAULT 7")
+    add_column_safe("tenants", "backup_keep_weekly INTEGER DEFAULT 4")
+    add_column_safe("tenants", "backup_keep_monthly INTEGER DEFAULT 12")
+    add_column_safe("tenants", "max_upload_mb INTEGER")
+    add_column_safe("tenants", "timezone VARCHAR DEFAULT 'Africa/Cairo'")
+
+    # Patients from before search_name (and restores of older backups)
+    db = database.SessionLocal()
+    try:
+        filled = crud.fill_patient_search_names(db)
+        if filled:
+            print(f"Filled search_name for {filled} patients")
+    except Exception as e:
+        print(f"search_name backfill skipped: {e}")
+    finally:
+        db.close()
+
+    # Appointments from before they carried tenant_id (the calendar filters on it)
+    db = database.SessionLocal()
+    try:
+        filled = crud.fill_appointment_tenants(db)
+        if filled:
+            print(f"Filled tenant_id for {filled} appointments")
+    except Exception as e:
+        print(f"Appointment tenant backfill skipped: {e}")
+    finally:
+        db.close()
+
+    # Balances of existing patients, once, when the columns are new
+    if balances_added:
+        db = database.SessionLocal()
+        try:
+            print(f"Computed balances for {crud.recompute_patient_balances(db)} patients")
+        except Exception as e:
+            print(f"Balance backfill skipped: {e}")
+        finally:
+            db.close()
 
     print("Schema migration steps completed.")
 
@@ -190,6 +305,17 @@ create_first_admin()
 
 app = FastAPI(title="EslamEmara Clinic API")
 
+
+@app.on_event("startup")
+async def start_ocr_client():
+    await ocr_service.start()
+
+
+@app.on_event("shutdown")
+async def stop_ocr_client():
+    await ocr_service.stop()
+
+
 # --- Google Drive & Scheduler ---
 drive_client = google_drive_client.GoogleDriveClient(
     redirect_uri="http://localhost:8001/settings/backup/callback"
@@ -209,12 +335,31 @@ def run_scheduled_backups():
             .all()
         )
         for tenant in tenants:
-            if not tenant.google_refresh_token:
+            try:
+                if backup_targets.get_backup_target(db, tenant) is None:
+                    continue
+            except Exception as e:
+                # e.g. S3 chosen but not configured on the server: skip only
+                # this tenant
+                print(f"Backup skipped for {tenant.name}: {e}")
+                continue
+
+            try:
+                # A write cut short by a restart is finished first, as is
+                if backup_service.resume_pending_backup(db, tenant):
+                    print(f"Backup resumed for {tenant.name}")
+                    continue
+            except Exception as e:
+                print(f"Backup Resume Failed for {tenant.name}: {e}")
                 continue
 
             should_run = False
             now = datetime.utcnow()
-            last = tenant.last_backup_at or datetime.min
+            # An unchanged-data check counts as a backup for scheduling purposes
+            last = max(
+                tenant.last_backup_at or datetime.min,
+                tenant.backup_verified_at or datetime.min,
+            )
 
             if tenant.backup_frequency == "daily":
                 if (now - last).days >= 1:
@@ -229,41 +374,42 @@ def run_scheduled_backups():
             if should_run:
                 print(f"Backing up Tenant: {tenant.name}")
                 try:
-                    # 1. Create Filtered Dump
-                    # We need to implement filtered dump in backup_service first.
-                    # For now, we will just dump everything (Temporary, user asked for tenant specific).
-                    # TODO: Filter by tenant_id
-                    data = backup_service.create_json_dump(db, tenant_id=tenant.id)
-
-                    # Save to file
                     filename = (
                         f"backup_{tenant.name}_{now.strftime('%Y%m%d_%H%M')}.json"
                     )
-                    file_path = f"uploads/{filename}"
-                    with open(file_path, "w") as f:
-                        json.dump(data, f)
-
-                    # 2. Upload to Drive
-                    google_drive_client.GoogleDriveClient.upload_file(
-                        tenant.google_refresh_token, file_path, filename
-                    )
-
-                    # 3. Update Status
-                    tenant.last_backup_at = now
-                    db.commit()
-
-                    # Cleanup
-                    os.remove(file_path)
-                    print(f"Backup success for {tenant.name}")
+                    # Unchanged data is only hashed, not written again
+                    result = backup_service.run_tenant_backup(db, tenant, filename)
+                    if result == "unchanged":
+                        print(f"Backup unchanged for {tenant.name}, upload skipped")
+                    else:
+                        print(f"Backup success for {tenant.name}")
 
                 except Exception as e:
+                    db.rollback()
                     print(f"Backup Failed for {tenant.name}: {e}")
 
     finally:
         db.close()
 
 
+def reconcile_patient_balances():
+    """Recomputes stored balances from scratch, correcting any drift (e.g. bulk imports)."""
+    db = database.SessionLocal()
+    try:
+        updated = crud.recompute_patient_balances(db)
+        print(f"[{datetime.utcnow()}] Reconciled balances of {updated} patients")
+    except Exception as e:
+        db.rollback()
+        print(f"Balance reconciliation failed: {e}")
+    finally:
+        db.close()
+
+
 scheduler.add_job(run_scheduled_backups, "interval", minutes=60)
+scheduler.add_job(attachment_service.retry_pending_uploads, "interval", minutes=1)
+scheduler.add_job(storage_gc.scheduled_collect_garbage, "interval", hours=24)
+scheduler.add_job(ocr_cache.purge_expired, "interval", hours=24)
+scheduler.add_job(reconcile_patient_balances, "interval", hours=24)
 scheduler.start()
 
 
@@ -279,6 +425,10 @@ origins = [
     "http://127.0.0.1:3000",
 ]
 
+# Size and type checks on upload bodies, while they stream in. Added before
+# CORS so its rejections still carry the CORS headers.
+app.add_middleware(upload_guard.UploadGuardMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -289,12 +439,13 @@ app.add_middleware(
 )
 
 # Create uploads directory if not exists
-base_dir = os.path.dirname(os.path.abspath(__file__))
-upload_dir = os.path.join(base_dir, "uploads")
+upload_dir = attachment_service.UPLOAD_DIR
 os.makedirs(upload_dir, exist_ok=True)
 
-# Mount static files
-app.mount("/uploads", StaticFiles(directory=upload_dir), name="uploads")
+# Mount static files. Uploads are patient files: they are only served with a
+# signed URL (see schemas.Attachment.url) or through /attachments/{id}/file
+uploads_files = SignedStaticFiles(directory=upload_dir, mount_path="/uploads")
+app.mount("/uploads", uploads_files, name="uploads")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
@@ -509,7 +660,15 @@ def google_auth_callback(
             raise Exception("Tenant not found")
 
         if refresh_token:
+            if tenant.google_refresh_token:
+                google_drive_client.GoogleDriveClient.forget_service(
+                    tenant.google_refresh_token
+                )
             tenant.google_refresh_token = refresh_token
+            # Possibly a different Google account: find the folder again and
+            # write the next backup there even if nothing changed
+            tenant.google_folder_id = None
+            backup_service.reset_backup_state(tenant)
 
         db.commit()
 
@@ -554,6 +713,73 @@ def update_backup_schedule(
     return {"message": f"Backup schedule set to {frequency}"}
 
 
+@app.put("/settings/backup/target")
+def update_backup_target(
+    target: str = Form(...),  # drive, local, s3
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    if target not in backup_targets.TARGET_KINDS:
+        raise HTTPException(status_code=400, detail="Unknown backup target")
+
+    tenant = (
+        db.query(models.Tenant)
+        .filter(models.Tenant.id == current_user.tenant_id)
+        .first()
+    )
+    if tenant.backup_target != target:
+        # The new destination has none of the earlier backups
+        backup_service.reset_backup_state(tenant)
+    tenant.backup_target = target
+    db.commit()
+    return {"message": f"Backup target set to {target}"}
+
+
+@app.put("/settings/backup/retention")
+def update_backup_retention(
+    keep_daily: int = Form(...),
+    keep_weekly: int = Form(...),
+    keep_monthly: int = Form(...),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    if min(keep_daily, keep_weekly, keep_monthly) < 0:
+        raise HTTPException(status_code=400, detail="Retention counts must be >= 0")
+
+    tenant = (
+        db.query(models.Tenant)
+        .filter(models.Tenant.id == current_user.tenant_id)
+        .first()
+    )
+    tenant.backup_keep_daily = keep_daily
+    tenant.backup_keep_weekly = keep_weekly
+    tenant.backup_keep_monthly = keep_monthly
+    db.commit()
+    return {
+        "message": f"Keeping {keep_daily} daily, {keep_weekly} weekly and {keep_monthly} monthly backups"
+    }
+
+
+@app.put("/settings/timezone")
+def update_timezone(
+    timezone: str = Form(...),  # IANA name, e.g. Africa/Cairo
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    if not tenant_time.valid_timezone(timezone):
+        raise HTTPException(status_code=400, detail="Unknown timezone")
+
+    tenant = (
+        db.query(models.Tenant)
+        .filter(models.Tenant.id == current_user.tenant_id)
+        .first()
+    )
+    tenant.timezone = timezone
+    db.commit()
+    tenant_time.forget_tenant(tenant.id)
+    return {"message": f"Timezone set to {timezone}"}
+
+
 @app.post("/settings/backup/now")
 def trigger_backup_now(
     db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)
@@ -563,41 +789,25 @@ def trigger_backup_now(
         .filter(models.Tenant.id == current_user.tenant_id)
         .first()
     )
-    if not tenant.google_refresh_token:
+    try:
+        target = backup_targets.get_backup_target(db, tenant)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if target is None:
         raise HTTPException(status_code=400, detail="Google Drive not connected")
 
     # Trigger logic manually
     try:
-        # Filtered Dump
         print(f"Starting Backup for Tenant: {tenant.id} ({tenant.name})")
-        try:
-            data = backup_service.create_json_dump(db, tenant_id=tenant.id)
-        except Exception as e:
-            print(f"Backup Dump Generation Failed: {e}")
-            import traceback
-
-            traceback.print_exc()
-            raise Exception(f"Database Export Failed: {str(e)}")
-
         filename = f"manual_backup_{tenant.name}_{datetime.utcnow().strftime('%Y%m%d_%H%M')}.json"
 
-        # Ensure uploads dir exists
-        os.makedirs("uploads", exist_ok=True)
-        file_path = f"uploads/{filename}"
-
-        with open(file_path, "w") as f:
-            json.dump(data, f)
-
-        print(
-            f"Dump saved to {file_path}, Size: {os.path.getsize(file_path)} bytes. Uploading..."
-        )
-
         try:
-            google_drive_client.GoogleDriveClient.upload_file(
-                tenant.google_refresh_token, file_path, filename
+            # Streams the dump straight into the tenant's backup target
+            backup_service.run_tenant_backup(
+                db, tenant, filename, skip_unchanged=False
             )
         except Exception as e:
-            print(f"Google Drive Upload Failed: {e}")
+            print(f"Backup Upload Failed: {e}")
             import traceback
 
             traceback.print_exc()
@@ -606,14 +816,7 @@ def trigger_backup_now(
                 raise Exception(
                     "Google Drive Token Expired. Please Reconnect in Settings."
                 )
-            raise Exception(f"Google Drive Upload Failed: {str(e)}")
-
-        tenant.last_backup_at = datetime.utcnow()
-        db.commit()
-
-        # Cleanup
-        if os.path.exists(file_path):
-            os.remove(file_path)
+            raise Exception(f"Backup Upload Failed: {str(e)}")
 
         return {"message": "Backup uploaded successfully"}
     except Exception as e:
@@ -637,6 +840,17 @@ def register_clinic(
     if crud.get_user(db, admin_username):
         raise HTTPException(status_code=400, detail="Username already taken")
 
+    # The logo must really be an image (checked on its content, not its name)
+    logo_type = None
+    if logo:
+        try:
+            logo_type = upload_guard.check_file_type(
+                logo.file.read(upload_guard.SNIFF_BYTES), "logo"
+            )
+        except upload_guard.UploadRejected as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        logo.file.seek(0)
+
     try:
         # Handle Logo Upload
         logo_path = None
@@ -644,8 +858,8 @@ def register_clinic(
             # Create static/logos directory if not exists
             os.makedirs("static/logos", exist_ok=True)
             # Generate unique filename
-            ext = logo.filename.split(".")[-1]
-            filename = f"{uuid.uuid4()}.{ext}"
+            ext = attachment_service.file_extension(logo.filename, logo_type)
+            filename = f"{uuid.uuid4()}{ext}"
             logo_path = f"static/logos/{filename}"
 
             with open(logo_path, "wb") as buffer:
@@ -722,12 +936,31 @@ def update_tenant(
         tenant.is_active = tenant_update.is_active
     if tenant_update.subscription_end_date is not None:
         tenant.subscription_end_date = tenant_update.subscription_end_date
+    if tenant_update.max_upload_mb is not None:
+        # 0 = back to the server default
+        tenant.max_upload_mb = tenant_update.max_upload_mb or None
+        upload_guard.forget_tenant_limit(tenant.id)
+    if tenant_update.timezone is not None:
+        if not tenant_time.valid_timezone(tenant_update.timezone):
+            raise HTTPException(status_code=400, detail="Unknown timezone")
+        tenant.timezone = tenant_update.timezone
+        tenant_time.forget_tenant(tenant.id)
 
     db.commit()
     db.refresh(tenant)
     return tenant
 
 
+@app.post("/admin/storage/gc")
+def run_storage_gc(
+    dry_run: bool = True,
+    current_user: models.User = Depends(get_current_user),
+):
+    if current_user.role != "super_admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return storage_gc.collect_garbage(dry_run=dry_run)
+
+
 @app.delete("/admin/tenants/{tenant_id}")
 def delete_tenant(
     tenant_id: int,
@@ -905,10 +1138,14 @@ def search_patients(
 def read_patients(
     skip: int = 0,
     limit: int = 100,
+    has_balance: bool = False,
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(get_current_user),
 ):
-    return crud.get_patients(db, current_user.tenant_id, skip=skip, limit=limit)
+    """has_balance=true: only patients who owe money, largest debt first."""
+    return crud.get_patients(
+        db, current_user.tenant_id, skip=skip, limit=limit, has_balance=has_balance
+    )
 
 
 @app.get("/patients/{patient_id}", response_model=schemas.Patient)
@@ -925,6 +1162,40 @@ def read_patient(
     return db_patient
 
 
+@app.get("/patients/{patient_id}/bundle", response_model=schemas.PatientBundle)
+def read_patient_bundle(
+    patient_id: int,
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user),
+):
+    """
+    The whole patient page in one request (instead of patient, tooth_status,
+    treatments, payments, attachments, prescriptions and procedures separately).
+    """
+    db_patient = crud.get_patient_bundle(db, patient_id, current_user.tenant_id)
+    if db_patient is None:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    attachments = sorted(db_patient.attachments, key=lambda a: a.id)
+    thumbnail_service.backfill(attachments)
+    treatments = sorted(db_patient.treatments, key=lambda t: t.id)
+    payments = sorted(db_patient.payments, key=lambda p: p.id)
+    return {
+        "patient": db_patient,
+        "tooth_status": sorted(db_patient.tooth_statuses, key=lambda t: t.id),
+        "treatments": treatments,
+        "payments": payments,
+        "attachments": attachments,
+        "prescriptions": sorted(
+            db_patient.prescriptions,
+            key=lambda p: p.date or datetime.min,
+            reverse=True,
+        ),
+        "procedures": crud.get_procedures(db, current_user.tenant_id),
+        "balance": crud.patient_balance(db_patient, treatments),
+    }
+
+
 @app.put("/patients/{patient_id}", response_model=schemas.Patient)
 def update_patient(
     patient_id: int,
@@ -965,7 +1236,9 @@ def create_appointment(
     patient = crud.get_patient(db, appointment.patient_id, current_user.tenant_id)
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
-    return crud.create_appointment(db=db, appointment=appointment)
+    return crud.create_appointment(
+        db=db, appointment=appointment, tenant_id=current_user.tenant_id
+    )
 
 
 @app.get("/appointments/", response_model=List[schemas.Appointment])
@@ -978,6 +1251,50 @@ def read_appointments(
     return crud.get_appointments(db, current_user.tenant_id, skip=skip, limit=limit)
 
 
+# Widest window one calendar request may cover (a month view plus padding fits)
+CALENDAR_MAX_DAYS = 62
+
+
+@app.get("/appointments/calendar", response_model=schemas.AppointmentCalendar)
+def read_appointment_calendar(
+    from_date: date = Query(..., alias="from"),
+    to_date: date = Query(..., alias="to"),  # inclusive
+    summary: bool = False,
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user),
+):
+    """
+    The appointments of a calendar window, in the clinic's wall-clock time.
+    With summary=true only per-day counts are returned (month views).
+    """
+    if to_date < from_date:
+        raise HTTPException(status_code=400, detail="'to' is before 'from'")
+    if (to_date - from_date).days >= CALENDAR_MAX_DAYS:
+        raise HTTPException(
+            status_code=400, detail=f"At most {CALENDAR_MAX_DAYS} days per request"
+        )
+
+    start = datetime.combine(from_date, datetime.min.time())
+    end = datetime.combine(to_date + timedelta(days=1), datetime.min.time())
+    if summary:
+        days = crud.get_appointment_day_counts(db, current_user.tenant_id, start, end)
+        return {
+            "from_date": from_date,
+            "to_date": to_date,
+            "days": [
+                {"date": day, "count": count, "cancelled": cancelled}
+                for day, count, cancelled in days
+            ],
+        }
+    return {
+        "from_date": from_date,
+        "to_date": to_date,
+        "appointments": crud.get_appointment_calendar(
+            db, current_user.tenant_id, start, end
+        ),
+    }
+
+
 @app.put("/appointments/{appointment_id}/status")
 def update_appt_status(
     appointment_id: int,
@@ -1124,40 +1441,150 @@ def delete_payment(
     return crud.delete_payment(db, payment_id, current_user.tenant_id)
 
 
-# --- Backup ---
-@app.get("/backup/download")
-def download_backup(
+# --- Reports ---
+@app.get("/reports/debtors", response_model=schemas.DebtorsPage)
+def report_debtors(
+    min_balance: float = 0.0,
+    min_days_since_visit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: int = reports.DEFAULT_PAGE_SIZE,
+    format: str = "json",
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(get_current_user),
 ):
-    if current_user.role not in ["admin", "super_admin"]:
-        raise HTTPException(status_code=403, detail="Not authorized")
+    """
+    Patients who owe more than min_balance, largest debt first. Optionally
+    only those not treated in min_days_since_visit days. Paginated with
+    next_cursor; format=csv streams the whole list as a CSV download.
+    """
+    tenant_id = current_user.tenant_id
 
-    # Generate Tenant-Specific Dump
-    try:
-        dump_data = backup_service.create_json_dump(
-            db, tenant_id=current_user.tenant_id
+    if format == "csv":
+
+        def stream_csv():
+            # Own session: request dependencies are closed before the body streams
+            stream_db = database.SessionLocal()
+            try:
+                yield from reports.iter_debtors_csv(
+                    stream_db, tenant_id, min_balance, min_days_since_visit
+                )
+            finally:
+                stream_db.close()
+
+        filename = f"debtors_{datetime.now().strftime('%Y%m%d')}.csv"
+        return StreamingResponse(
+            stream_csv(),
+            media_type="text/csv; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
         )
 
-        # Save to temp file
-        filename = f"backup_clinic_{current_user.tenant_id}_{datetime.now().strftime('%Y%m%d')}.json"
-        filepath = os.path.join("temp", filename)
-        os.makedirs("temp", exist_ok=True)
+    try:
+        return reports.debtors_page(
+            db, tenant_id, min_balance, min_days_since_visit, cursor=cursor, limit=limit
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(dump_data, f, ensure_ascii=False, indent=2)
 
-        return FileResponse(
-            path=filepath, filename=filename, media_type="application/json"
+@app.get("/reports/timeseries", response_model=schemas.TimeseriesReport)
+def report_timeseries(
+    granularity: str = "month",
+    from_date: Optional[date] = Query(None, alias="from"),
+    to_date: Optional[date] = Query(None, alias="to"),
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user),
+):
+    """
+    Revenue, discounts, payments received and expenses per day, week
+    (from Monday) or month between from and to (inclusive, whole buckets).
+    Defaults to the last 12 months / 12 weeks / 30 days.
+    """
+    to_date = to_date or reports.utc_today()
+    if from_date is None:
+        default_span = {"day": 29, "week": 7 * 11, "month": 335}
+        from_date = to_date - timedelta(days=default_span.get(granularity, 335))
+    try:
+        buckets = reports.timeseries(
+            db, current_user.tenant_id, granularity, from_date, to_date
         )
-    except Exception as e:
-        raise HTTPException(
-            status_code=500, detail=f"Backup generation failed: {str(e)}"
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "granularity": granularity,
+        "from_date": from_date,
+        "to_date": to_date,
+        "buckets": buckets,
+    }
+
+
+@app.get("/reports/procedures", response_model=schemas.ProceduresReport)
+def report_procedures(
+    from_date: Optional[date] = Query(None, alias="from"),
+    to_date: Optional[date] = Query(None, alias="to"),
+    by_tooth: bool = False,
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user),
+):
+    """
+    Which procedures bring the revenue: treatments per procedure (and
+    tooth) between from and to (inclusive, default the last 12 months),
+    with the average price charged against the price list.
+    """
+    to_date = to_date or reports.utc_today()
+    from_date = from_date or to_date - timedelta(days=365)
+    try:
+        rows = reports.procedures(
+            db, current_user.tenant_id, from_date, to_date, by_tooth=by_tooth
         )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "from_date": from_date,
+        "to_date": to_date,
+        "by_tooth": by_tooth,
+        "procedures": rows,
+    }
+
+
+# --- Backup ---
+@app.get("/backup/download")
+def download_backup(
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user),
+):
+    if current_user.role not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    tenant_id = current_user.tenant_id
+
+    def stream_dump():
+        # Own session: request dependencies are closed before the body streams
+        stream_db = database.SessionLocal()
+        try:
+            yield from backup_service.iter_json_dump(stream_db, tenant_id=tenant_id)
+        finally:
+            stream_db.close()
+
+    # Stream the Tenant-Specific Dump (no temp file)
+    filename = f"backup_clinic_{tenant_id}_{datetime.now().strftime('%Y%m%d')}.json"
+    return StreamingResponse(
+        stream_dump(),
+        media_type="application/json",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 
 @app.post("/backup/upload")
-async def upload_backup(file: UploadFile = File(...), db: Session = Depends(get_db)):
+def upload_backup(
+    file: UploadFile = File(...),
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user),
+):
+    if current_user.role not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    if current_user.tenant_id is None:
+        raise HTTPException(status_code=400, detail="No clinic to restore into")
+
     file_location = f"temp_restore_{uuid.uuid4()}"
 
     try:
@@ -1173,7 +1600,9 @@ async def upload_backup(file: UploadFile = File(...), db: Session = Depends(get_
                 is_sqlite = True
 
         if is_sqlite:
-            stats = backup_service.import_from_sqlite(db, file_location)
+            stats = backup_service.import_from_sqlite(
+                db, file_location, tenant_id=current_user.tenant_id
+            )
             # Format stats
             lines = ["Restore Report:"]
             for table, counts in stats.items():
@@ -1187,7 +1616,9 @@ async def upload_backup(file: UploadFile = File(...), db: Session = Depends(get_
             with open(file_location, "r", encoding="utf-8") as f:
                 try:
                     data = json.load(f)
-                    stats = backup_service.import_from_json(db, data)
+                    stats = backup_service.import_from_json(
+                        db, data, tenant_id=current_user.tenant_id
+                    )
                     lines = ["Restore Report:"]
                     for table, counts in stats.items():
                         if counts["restored"] > 0 or counts["errors"] > 0:
@@ -1261,78 +1692,112 @@ def delete_procedure(
     return crud.delete_procedure(db, procedure_id, current_user.tenant_id)
 
 
-import uuid
-
-
 # --- Attachments ---
 @app.post("/upload/", response_model=schemas.Attachment)
-@app.post("/upload/", response_model=schemas.Attachment)
 async def upload_file(
     patient_id: int,
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(get_current_user),
 ):
     # Verify patient ownership
-    patient = crud.get_patient(db, patient_id, current_user.tenant_id)
+    patient = await run_in_threadpool(
+        crud.get_patient, db, patient_id, current_user.tenant_id
+    )
     if not patient:
         raise HTTPException(
             status_code=404, detail="Patient not found or access denied"
         )
 
     print(f"DEBUG: Upload request for patient {patient_id}, filename: {file.filename}")
-    # Check if Cloudinary is configured
-    cloudinary_url = os.getenv("CLOUDINARY_URL")
-    if cloudinary_url:
-        try:
-            print("DEBUG: Attempting Cloudinary upload...")
-            result = cloudinary.uploader.upload(
-                file.file, folder="clinic_uploads", resource_type="auto"
-            )
-
-            file_url = result.get("secure_url")
-            print(f"DEBUG: Cloudinary Success: {file_url}")
-
-            attachment_data = schemas.AttachmentCreate(
-                patient_id=patient_id,
-                file_path=file_url,
-                filename=file.filename,
-                file_type=file.content_type or "application/octet-stream",
-            )
-            return crud.create_attachment(db, attachment_data)
-
-        except Exception as e:
-            print(f"DEBUG: Cloudinary upload failed: {e}")
-            # Fallback will happen below if we don't return here
-
-    print("DEBUG: Using Local Storage Fallback...")
-    # Fallback to Local Storage
+    # Always land the file on local storage first (streamed and hashed, off
+    # the event loop). Stored content is addressed by its sha256, so the same
+    # file uploaded twice is kept once.
     try:
-        file_ext = os.path.splitext(file.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_ext}"
-
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        upload_dir = os.path.join(base_dir, "uploads")
-        os.makedirs(upload_dir, exist_ok=True)
+        temp_path, content_hash, size, mime_type = (
+            await attachment_service.receive_upload(file)
+        )
+        ext = attachment_service.file_extension(file.filename, mime_type)
+        blob, is_new = await run_in_threadpool(
+            attachment_service.store_upload, db, temp_path, content_hash, size, ext
+        )
+    except upload_guard.UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except Exception as e:
+        print(f"DEBUG: Local upload failed: {e}")
+        raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
-        file_location = os.path.join(upload_dir, unique_filename)
+    # With Cloudinary configured, new content is created as "uploading" and
+    # served locally until the background push flips file_path to the
+    # Cloudinary URL. Known content reuses wherever the blob already lives.
+    use_cloudinary = attachment_service.cloudinary_enabled()
+    pending = use_cloudinary and attachment_service.is_local(blob.file_path)
+    attachment_data = schemas.AttachmentCreate(
+        patient_id=patient_id,
+        file_path=blob.file_path,
+        filename=file.filename,
+        file_type=mime_type,
+        status="uploading" if pending else "ready",
+        content_hash=content_hash,
+    )
+    attachment = await run_in_threadpool(crud.create_attachment, db, attachment_data)
 
-        with open(file_location, "wb+") as file_object:
-            shutil.copyfileobj(file.file, file_object)
+    if pending:
+        if is_new:
+            background_tasks.add_task(
+                attachment_service.push_to_cloudinary, attachment.id
+            )
+        else:
+            # The first upload of this content is still being pushed and will
+            # flip this row too; the retry job covers it if that push fails
+            await run_in_threadpool(attachment_service.defer_push, db, attachment)
+    else:
+        thumbnail_service.schedule(attachment.id)
+    return attachment
 
-        relative_path = f"/uploads/{unique_filename}"
 
-        attachment_data = schemas.AttachmentCreate(
-            patient_id=patient_id,
-            file_path=relative_path,
-            filename=file.filename,
-            file_type=file.content_type or "application/octet-stream",
+@app.post("/upload/by-hash", response_model=schemas.Attachment)
+def upload_file_by_hash(
+    patient_id: int,
+    sha256: str = Form(...),
+    filename: str = Form(...),
+    file_type: str = Form("application/octet-stream"),
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user),
+):
+    """
+    Attaches already stored content without sending the file again. Only
+    content this clinic has uploaded before can be referenced; anything else
+    is a 404 and the client falls back to a normal upload.
+    """
+    patient = crud.get_patient(db, patient_id, current_user.tenant_id)
+    if not patient:
+        raise HTTPException(
+            status_code=404, detail="Patient not found or access denied"
         )
 
-        return crud.create_attachment(db, attachment_data)
-    except Exception as e:
-        print(f"DEBUG: Local upload failed: {e}")
-        raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
+    sha256 = sha256.lower()
+    known = crud.find_tenant_attachment_by_hash(db, sha256, current_user.tenant_id)
+    blob = crud.get_blob(db, sha256) if known else None
+    if not blob:
+        raise HTTPException(status_code=404, detail="Content not found")
+
+    crud.add_blob_reference(db, sha256)
+    attachment_data = schemas.AttachmentCreate(
+        patient_id=patient_id,
+        file_path=blob.file_path,
+        filename=filename,
+        file_type=file_type,
+        status=known.status,
+        content_hash=sha256,
+    )
+    attachment = crud.create_attachment(db, attachment_data)
+    if attachment.status == "uploading":
+        attachment_service.defer_push(db, attachment)
+    else:
+        thumbnail_service.schedule(attachment.id)
+    return attachment
 
 
 @app.get("/patients/{patient_id}/attachments", response_model=List[schemas.Attachment])
@@ -1341,60 +1806,72 @@ def read_patient_attachments(
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(get_current_user),
 ):
-    return crud.get_patient_attachments(db, patient_id, current_user.tenant_id)
+    attachments = crud.get_patient_attachments(db, patient_id, current_user.tenant_id)
+    thumbnail_service.backfill(attachments)
+    return attachments
+
+
+@app.get("/attachments/{attachment_id}/file")
+def download_attachment(
+    attachment_id: int,
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user),
+):
+    attachment = crud.get_attachment(db, attachment_id, current_user.tenant_id)
+    if not attachment:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+
+    if not attachment_service.is_local(attachment.file_path):
+        return RedirectResponse(attachment.file_path)
+
+    full_path = attachment_service.local_path(attachment.file_path)
+    if not os.path.isfile(full_path):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    # Same response as the uploads mount (streamed from disk, with Range and
+    # caching support), plus the original file name
+    response = uploads_files.file_response(full_path, os.stat(full_path), request.scope)
+    response.headers["content-disposition"] = (
+        f"inline; filename*=utf-8''{quote(attachment.filename or os.path.basename(full_path))}"
+    )
+    return response
 
 
 @app.delete("/attachments/{attachment_id}")
 def delete_attachment(
     attachment_id: int,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(get_current_user),
 ):
     # Restrict finding the attachment to the tenant
-    db_attachment = (
-        db.query(models.Attachment)
-        .join(models.Patient)
-        .filter(
-            models.Attachment.id == attachment_id,
-            models.Patient.tenant_id == current_user.tenant_id,
-        )
-        .first()
-    )
+    db_attachment = crud.get_attachment(db, attachment_id, current_user.tenant_id)
     if not db_attachment:
         raise HTTPException(status_code=404, detail="Attachment not found")
 
-    # Attempt to delete file
-    try:
-        if "cloudinary.com" in db_attachment.file_path:
-            # It's a cloudinary url
-            if os.getenv("CLOUDINARY_URL"):
-                # Extract public_id.
-                # URL is like: https://res.cloudinary.com/demo/image/upload/v1570979139/clinic_uploads/sample.jpg
-                # We need 'clinic_uploads/sample'
-                parts = db_attachment.file_path.split("/")
-                # Find index of 'upload'
-                if "upload" in parts:
-                    idx = parts.index("upload")
-                    # public id is everything after version (v12345) to end, minus extension
-                    # This is tricky without regex, let's try a simpler approach if possible.
-                    # Usually, the last two parts: folder/filename.ext
-                    folder_file = "/".join(parts[idx + 2 :])  # skip 'v123...'
-                    public_id = os.path.splitext(folder_file)[0]
-                    cloudinary.uploader.destroy(public_id)
-        else:
-            # Local file deletion
-            # Note: file_path here is relative /uploads/filename.ext
-            # or full path? In local mode we stored relative.
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-            # Remove leading slash
-            rel_path = db_attachment.file_path.lstrip("/")
-            full_path = os.path.join(base_dir, rel_path)
-            if os.path.exists(full_path):
-                os.remove(full_path)
-    except Exception as e:
-        print(f"Error deleting file: {e}")
+    # Content-addressed files are shared, so they go only with the last
+    # attachment referencing them
+    content_hash = db_attachment.content_hash
+    stored_path = None
+    if content_hash:
+        blob = crud.release_blob(db, content_hash, attachment_id)
+        if blob:
+            stored_path = blob.file_path
+    else:
+        stored_path = db_attachment.file_path
 
-    return crud.delete_attachment(db, attachment_id, current_user.tenant_id)
+    deleted = crud.delete_attachment(db, attachment_id, current_user.tenant_id)
+
+    # Removing the file (a Cloudinary API call once pushed) runs after the
+    # response; whatever fails there is picked up by the storage GC
+    if stored_path and content_hash:
+        background_tasks.add_task(
+            attachment_service.discard_blob_file, content_hash, stored_path
+        )
+    elif stored_path:
+        background_tasks.add_task(attachment_service.discard_stored_file, stored_path)
+    return deleted
 
 
 # --- Expenses ---
@@ -1434,33 +1911,66 @@ class OCRRequest(BaseModel):
 
 
 @app.post("/ocr/")
-async def proxy_ocr(request: OCRRequest):
+async def proxy_ocr(
+    request: OCRRequest,
+    current_user: models.User = Depends(get_current_user),
+):
     """
-    Proxy request to OCR.space to avoid CORS and handle API keys securely.
+    OCR of a scanned image: OCR.space (proxied to avoid CORS and keep the API
+    key on the server) or the local engine, see ocr_service.
     """
     try:
-        import httpx
-    except ImportError:
-        raise HTTPException(
-            status_code=500,
-            detail="Missing dependency 'httpx' on server. Please run 'pip install httpx'.",
-        )
+        return await ocr_service.recognize(request.base64Image)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"OCR API error: {str(e)}")
+
 
-    api_url = "https://api.ocr.space/parse/image"
-    # Using Engine 2 which is more modern and better at handling noise/handwriting.
-    # We specify 'ara' for explicit Arabic support.
-    payload = {
-        "apikey": os.getenv("OCR_API_KEY", "helloworld"),
-        "language": "ara",
-        "base64Image": request.base64Image,
-        "OCREngine": "1",
-        "scale": "true",
-        "detectOrientation": "true",
+@app.post("/ocr/patient-card", response_model=schemas.PatientCardResult)
+async def scan_patient_card(
+    request: OCRRequest,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    """
+    Scan-to-patient in one round-trip: OCR of the card, the patient fields
+    read from it, and existing patients it may belong to (to open instead of
+    creating a duplicate).
+    """
+    try:
+        result = await ocr_service.recognize(request.base64Image)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"OCR API error: {str(e)}")
+    if result.get("IsErroredOnProcessing"):
+        message = result.get("ErrorMessage") or "OCR failed"
+        if isinstance(message, list):
+            message = " ".join(message)
+        raise HTTPException(status_code=502, detail=f"OCR API error: {message}")
+
+    text = (result.get("ParsedResults") or [{}])[0].get("ParsedText") or ""
+    fields = patient_card.parse_card_text(text)
+    candidates = await run_in_threadpool(
+        crud.find_patient_candidates,
+        db,
+        current_user.tenant_id,
+        name=fields["name"],
+        phone=fields["phone"],
+    )
+    return {
+        "fields": fields,
+        "text": text.strip(),
+        "candidates": [
+            {"patient": patient, "score": score, "matched_on": matched_on}
+            for patient, score, matched_on in candidates
+        ],
     }
 
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(api_url, data=payload, timeout=30.0)
-            return response.json()
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"OCR API error: {str(e)}")
+
+@app.get("/admin/ocr/metrics")
+def read_ocr_metrics(current_user: models.User = Depends(get_current_user)):
+    if current_user.role != "super_admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return ocr_service.metrics()
@@ -1,4 +1,5 @@
 from sqlalchemy import (
+    Index,
     Column,
     Integer,
     String,
@@ -9,9 +10,10 @@ from sqlalchemy import (
     Date,
     Boolean,
 )
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, validates
 from datetime import datetime
 from .database import Base
+from .arabic import normalize_arabic
 
 
 class Tenant(Base):
@@ -28,8 +30,21 @@ class Tenant(Base):
 
     # Backup Settings
     backup_frequency = Column(String, default="off")  # off, daily, weekly, monthly
+    backup_target = Column(String, default="drive")  # drive, local, s3
     google_refresh_token = Column(String, nullable=True)
+    google_folder_id = Column(String, nullable=True)  # cached "DentalSaaS Backups" folder
     last_backup_at = Column(DateTime, nullable=True)
+    last_backup_hash = Column(String, nullable=True)  # sha256 of the last uploaded dump
+    backup_verified_at = Column(DateTime, nullable=True)  # last check that found no changes
+    pending_backup = Column(Text, nullable=True)  # JSON: interrupted upload to resume
+    # Retention (grandfather-father-son), all zero = keep everything
+    backup_keep_daily = Column(Integer, default=7)
+    backup_keep_weekly = Column(Integer, default=4)
+    backup_keep_monthly = Column(Integer, default=12)
+
+    # Per-file upload limit, None = server default (MAX_UPLOAD_MB)
+    max_upload_mb = Column(Integer, nullable=True)
+    timezone = Column(String, default="Africa/Cairo")  # IANA name, the clinic's "today"
 
     users = relationship("User", back_populates="tenant")
 
@@ -39,6 +54,9 @@ class Patient(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
+    # normalize_arabic(name), kept in sync below: what search and matching compare.
+    # Matched with %word%, so no btree index (Postgres gets a trigram one)
+    search_name = Column(String, nullable=True)
     age = Column(Integer)
     phone = Column(String)
     address = Column(String, nullable=True)
@@ -49,6 +67,14 @@ class Patient(Base):
         Integer, ForeignKey("tenants.id"), nullable=True
     )  # Nullable for migration, should be non-null eventually
 
+    # Running totals, kept up to date by the treatment/payment CRUD functions
+    # (crud.adjust_patient_balance) and reconciled nightly
+    total_due = Column(Float, default=0.0)  # treatments: cost - discount
+    total_paid = Column(Float, default=0.0)
+    balance = Column(Float, default=0.0)  # due - paid, > 0 means the patient owes
+
+    __table_args__ = (Index("ix_patients_tenant_balance", "tenant_id", "balance"),)
+
     appointments = relationship(
         "Appointment", back_populates="patient", cascade="all, delete-orphan"
     )
@@ -68,6 +94,11 @@ class Patient(Base):
         "Prescription", back_populates="patient", cascade="all, delete-orphan"
     )
 
+    @validates("name")
+    def _set_search_name(self, key, name):
+        self.search_name = normalize_arabic(name)
+        return name
+
 
 class User(Base):
     __tablename__ = "users"
@@ -83,9 +114,11 @@ class User(Base):
 
 class Appointment(Base):
     __tablename__ = "appointments"
+    __table_args__ = (Index("ix_appointments_tenant_date", "tenant_id", "date_time"),)
 
     id = Column(Integer, primary_key=True, index=True)
     patient_id = Column(Integer, ForeignKey("patients.id"), index=True)
+    tenant_id = Column(Integer, ForeignKey("tenants.id"))  # same as the patient's
     date_time = Column(DateTime)
     status = Column(String, default="Scheduled")  # Scheduled, Completed, Cancelled
     notes = Column(Text, nullable=True)
@@ -107,6 +140,11 @@ class ToothStatus(Base):
 
 class Treatment(Base):
     __tablename__ = "treatments"
+    # Last visit per patient (reports)
+    __table_args__ = (
+        Index("ix_treatments_patient_date", "patient_id", "date"),
+        Index("ix_treatments_date", "date"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     patient_id = Column(Integer, ForeignKey("patients.id"), index=True)
@@ -127,6 +165,7 @@ class Treatment(Base):
 
 class Payment(Base):
     __tablename__ = "payments"
+    __table_args__ = (Index("ix_payments_date", "date"),)
 
     id = Column(Integer, primary_key=True, index=True)
     patient_id = Column(Integer, ForeignKey("patients.id"), index=True)
@@ -155,12 +194,33 @@ class Attachment(Base):
     filename = Column(String)
     file_type = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
+    status = Column(String, default="ready")  # uploading, ready
+    upload_attempts = Column(Integer, default=0)  # Cloudinary push attempts
+    next_attempt_at = Column(DateTime, nullable=True)
+    content_hash = Column(String, nullable=True, index=True)  # -> Blob.sha256
+    thumbnail_url = Column(String, nullable=True)  # small gallery image (images only)
+    preview_url = Column(String, nullable=True)  # medium image for the viewer
+    thumbnail_error = Column(String, nullable=True)  # why the image could not be rendered
 
     patient = relationship("Patient", back_populates="attachments")
 
 
+class Blob(Base):
+    """Stored file content, shared by every attachment with the same SHA-256."""
+
+    __tablename__ = "blobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    sha256 = Column(String, unique=True, index=True)
+    size = Column(Integer)
+    file_path = Column(String)  # /uploads/<sha256><ext> or Cloudinary URL
+    ref_count = Column(Integer, default=1)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
 class Expense(Base):
     __tablename__ = "expenses"
+    __table_args__ = (Index("ix_expenses_tenant_date", "tenant_id", "date"),)
 
     id = Column(Integer, primary_key=True, index=True)
     item_name = Column(String)
@@ -0,0 +1,257 @@
+import os
+import time
+import base64
+import shutil
+import asyncio
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from . import ocr_preprocess
+
+# OCR.space (or a compatible server, e.g. a local stub for testing)
+OCR_API_URL = os.getenv("OCR_API_URL", "https://api.ocr.space/parse/image")
+OCR_API_KEY = os.getenv("OCR_API_KEY", "helloworld")
+
+# Connection pool and timeouts of the shared client
+OCR_CONNECT_TIMEOUT = float(os.getenv("OCR_CONNECT_TIMEOUT", "5"))
+OCR_READ_TIMEOUT = float(os.getenv("OCR_READ_TIMEOUT", "30"))
+OCR_POOL_TIMEOUT = float(os.getenv("OCR_POOL_TIMEOUT", "10"))
+OCR_MAX_CONNECTIONS = int(os.getenv("OCR_MAX_CONNECTIONS", "10"))
+OCR_KEEPALIVE_SECONDS = float(os.getenv("OCR_KEEPALIVE_SECONDS", "60"))
+# Requests in flight to the OCR API at once; the rest wait their turn
+OCR_MAX_CONCURRENCY = int(os.getenv("OCR_MAX_CONCURRENCY", "4"))
+
+# Local engine: Tesseract (needs the tesseract binary with the Arabic
+# traineddata, e.g. apt install tesseract-ocr tesseract-ocr-ara)
+OCR_LOCAL_LANG = os.getenv("OCR_LOCAL_LANG", "ara+eng")
+OCR_LOCAL_WORKERS = int(os.getenv("OCR_LOCAL_WORKERS", "2"))
+
+LATENCY_SAMPLES = 500
+
+
+def ocr_space_result(text: str, engine: str, elapsed: float) -> dict:
+    """A result shaped like OCR.space's, which is what PatientScanner reads."""
+    return {
+        "ParsedResults": [
+            {
+                "TextOverlay": None,
+                "FileParseExitCode": 1,
+                "ParsedText": text,
+                "ErrorMessage": "",
+                "ErrorDetails": "",
+            }
+        ],
+        "OCRExitCode": 1,
+        "IsErroredOnProcessing": False,
+        "ProcessingTimeInMilliseconds": str(int(elapsed * 1000)),
+        "OCREngine": engine,
+    }
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return round(values[index] * 1000, 1)
+
+
+class OCRBackend:
+    """
+    An OCR engine. recognize() takes image bytes and returns an
+    OCR.space-style dict (see ocr_space_result).
+    """
+
+    name = None
+
+    def __init__(self):
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.stats = {"requests": 0, "errors": 0, "in_flight": 0, "waiting": 0}
+
+    def available(self) -> bool:
+        return True
+
+    def busy(self) -> bool:
+        """True when a new request would have to queue."""
+        return False
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def recognize(self, image: bytes, mime_type: str) -> dict:
+        raise NotImplementedError
+
+    async def _timed(self, work):
+        self.stats["in_flight"] += 1
+        started = time.perf_counter()
+        try:
+            return await work()
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self.stats["in_flight"] -= 1
+            self.stats["requests"] += 1
+            self.latencies.append(time.perf_counter() - started)
+
+    def metrics(self) -> dict:
+        """Counters and latency (ms) over the last LATENCY_SAMPLES calls."""
+        samples = sorted(self.latencies)
+        return {
+            "available": self.available(),
+            **self.stats,
+            "latency_ms": {
+                "samples": len(samples),
+                "avg": round(sum(samples) / len(samples) * 1000, 1) if samples else None,
+                "p50": _percentile(samples, 0.50),
+                "p95": _percentile(samples, 0.95),
+                "max": _percentile(samples, 1.0),
+            },
+        }
+
+
+class OCRSpaceBackend(OCRBackend):
+    """
+    OCR.space over one pooled keep-alive client for the app's lifetime, with
+    a bound on concurrent requests.
+    """
+
+    name = "ocrspace"
+
+    def __init__(self):
+        super().__init__()
+        self.client = None
+        self.semaphore = None
+
+    @staticmethod
+    def _make_client():
+        try:
+            import httpx
+        except ImportError:
+            raise Exception(
+                "Missing dependency 'httpx' on server. Please run 'pip install httpx'."
+            )
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                OCR_READ_TIMEOUT, connect=OCR_CONNECT_TIMEOUT, pool=OCR_POOL_TIMEOUT
+            ),
+            limits=httpx.Limits(
+                max_connections=OCR_MAX_CONNECTIONS,
+                max_keepalive_connections=OCR_MAX_CONNECTIONS,
+                keepalive_expiry=OCR_KEEPALIVE_SECONDS,
+            ),
+        )
+
+    async def start(self):
+        if self.client is None:
+            self.client = self._make_client()
+        self.semaphore = asyncio.Semaphore(OCR_MAX_CONCURRENCY)
+
+    async def stop(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def busy(self):
+        return self.stats["in_flight"] >= OCR_MAX_CONCURRENCY
+
+    async def recognize(self, image, mime_type):
+        # Used without the startup hook (scripts, tests)
+        if self.client is None or self.semaphore is None:
+            await self.start()
+
+        encoded = base64.b64encode(image).decode("ascii")
+        # Using Engine 2 which is more modern and better at handling noise/handwriting.
+        # We specify 'ara' for explicit Arabic support.
+        payload = {
+            "apikey": OCR_API_KEY,
+            "language": "ara",
+            "base64Image": f"data:{mime_type};base64,{encoded}",
+            "OCREngine": "1",
+            "scale": "true",
+            "detectOrientation": "true",
+        }
+
+        async def post():
+            response = await self.client.post(OCR_API_URL, data=payload)
+            response.raise_for_status()
+            return response.json()
+
+        self.stats["waiting"] += 1
+        async with self.semaphore:
+            self.stats["waiting"] -= 1
+            return await self._timed(post)
+
+
+class TesseractBackend(OCRBackend):
+    """Local Tesseract in worker processes: works without network."""
+
+    name = "tesseract"
+
+    def __init__(self):
+        super().__init__()
+        self.pool = None
+        self._available = None
+
+    def available(self):
+        """pytesseract, the binary and every OCR_LOCAL_LANG language (e.g. ara) installed."""
+        if self._available is None:
+            try:
+                import pytesseract
+
+                if not shutil.which(pytesseract.pytesseract.tesseract_cmd):
+                    self._available = False
+                else:
+                    # tesseract --list-langs
+                    installed = set(pytesseract.get_languages(config=""))
+                    missing = set(OCR_LOCAL_LANG.split("+")) - installed
+                    if missing:
+                        print(
+                            f"Tesseract is missing language data: {', '.join(sorted(missing))}"
+                        )
+                    self._available = not missing
+            except ImportError:
+                self._available = False
+            except Exception as e:
+                print(f"Tesseract check failed: {e}")
+                self._available = False
+        return self._available
+
+    def busy(self):
+        return self.stats["in_flight"] >= OCR_LOCAL_WORKERS
+
+    async def stop(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    async def recognize(self, image, mime_type):
+        if not self.available():
+            raise Exception(
+                "Missing dependency 'pytesseract', the tesseract binary or its "
+                f"language data ({OCR_LOCAL_LANG}) on server."
+            )
+        if self.pool is None:
+            # Spawned, not forked: the app process runs scheduler and pool threads
+            self.pool = ProcessPoolExecutor(
+                max_workers=OCR_LOCAL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+        started = time.perf_counter()
+
+        async def run():
+            return await asyncio.get_running_loop().run_in_executor(
+                self.pool, ocr_preprocess.tesseract_text, image, OCR_LOCAL_LANG
+            )
+
+        text = await self._timed(run)
+        return ocr_space_result(text, self.name, time.perf_counter() - started)
+
+
+BACKENDS = {
+    OCRSpaceBackend.name: OCRSpaceBackend(),
+    TesseractBackend.name: TesseractBackend(),
+}
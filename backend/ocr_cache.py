@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# OCR results by image content hash: a small in-memory LRU in front of a
+# SQLite file that survives restarts
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", "256"))
+# Results hold ID-card text (names, phones, addresses): kept for a day, in a
+# data directory readable by the app user only, not the working directory
+OCR_CACHE_TTL_SECONDS = int(os.getenv("OCR_CACHE_TTL_SECONDS", str(24 * 3600)))
+OCR_CACHE_DIR = os.getenv(
+    "OCR_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+)
+OCR_CACHE_PATH = os.getenv(
+    "OCR_CACHE_PATH", os.path.join(OCR_CACHE_DIR, "ocr_cache.sqlite3")
+)
+
+_memory = OrderedDict()  # key -> (expires_at, result)
+_memory_lock = threading.Lock()
+_disk = None
+_disk_lock = threading.Lock()
+_stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+
+
+def _connection():
+    global _disk
+    if _disk is None:
+        directory = os.path.dirname(os.path.abspath(OCR_CACHE_PATH))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        _disk = sqlite3.connect(OCR_CACHE_PATH, check_same_thread=False)
+        try:
+            os.chmod(OCR_CACHE_PATH, 0o600)
+        except OSError as e:
+            print(f"OCR cache permissions not set: {e}")
+        _disk.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_results ("
+            "key TEXT PRIMARY KEY, result TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        _disk.commit()
+    return _disk
+
+
+def _remember(key: str, expires_at: float, result: dict):
+    with _memory_lock:
+        _memory[key] = (expires_at, result)
+        _memory.move_to_end(key)
+        while len(_memory) > OCR_CACHE_SIZE:
+            _memory.popitem(last=False)
+
+
+def get(key: str):
+    """Cached OCR result for the key, or None. Blocking (disk), run off the event loop."""
+    now = time.time()
+    with _memory_lock:
+        entry = _memory.get(key)
+        if entry and entry[0] > now:
+            _memory.move_to_end(key)
+            _stats["memory_hits"] += 1
+            return entry[1]
+        if entry:
+            del _memory[key]
+
+    try:
+        with _disk_lock:
+            row = (
+                _connection()
+                .execute(
+                    "SELECT result, expires_at FROM ocr_results WHERE key = ?", (key,)
+                )
+                .fetchone()
+            )
+    except sqlite3.Error as e:
+        print(f"OCR cache read failed: {e}")
+        row = None
+
+    if row and row[1] > now:
+        result = json.loads(row[0])
+        _remember(key, row[1], result)
+        _stats["disk_hits"] += 1
+        return result
+
+    _stats["misses"] += 1
+    return None
+
+
+def put(key: str, result: dict):
+    expires_at = time.time() + OCR_CACHE_TTL_SECONDS
+    _remember(key, expires_at, result)
+    try:
+        with _disk_lock:
+            db = _connection()
+            db.execute(
+                "INSERT OR REPLACE INTO ocr_results (key, result, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(result), expires_at),
+            )
+            db.commit()
+        _stats["stores"] += 1
+    except sqlite3.Error as e:
+        print(f"OCR cache write failed: {e}")
+
+
+def purge_expired():
+    """Scheduler job: drops expired entries from the disk cache."""
+    try:
+        with _disk_lock:
+            db = _connection()
+            deleted = db.execute(
+                "DELETE FROM ocr_results WHERE expires_at <= ?", (time.time(),)
+            ).rowcount
+            db.commit()
+        if deleted:
+            print(f"OCR cache: purged {deleted} expired results")
+    except sqlite3.Error as e:
+        print(f"OCR cache purge failed: {e}")
+
+
+def metrics() -> dict:
+    hits = _stats["memory_hits"] + _stats["disk_hits"]
+    lookups = hits + _stats["misses"]
+    return {
+        **_stats,
+        "memory_entries": len(_memory),
+        "hit_rate": round(hits / lookups, 3) if lookups else None,
+    }
@@ -0,0 +1,93 @@
+import io
+import os
+
+# Runs in worker processes (see ocr_service): keep this module free of app,
+# database and network imports.
+
+# Longest side sent to OCR. Phone photos (4-12 MP) carry far more pixels than
+# text recognition needs; ~2000 px keeps ID card and prescription text sharp.
+OCR_MAX_SIDE = int(os.getenv("OCR_MAX_SIDE", "2000"))
+# OCR.space rejects files above 1 MB on the free tier
+OCR_MAX_BYTES = int(os.getenv("OCR_MAX_BYTES", str(1024 * 1024)))
+# Black and white output; turn off for badly lit photos if it loses text
+OCR_BINARIZE = os.getenv("OCR_BINARIZE", "true").lower() in ("1", "true", "yes")
+
+
+def otsu_threshold(histogram: list) -> int:
+    """Gray level that best separates ink from paper (Otsu's method)."""
+    total = sum(histogram)
+    sum_all = sum(level * count for level, count in enumerate(histogram))
+    sum_background = weight_background = 0
+    best_level, best_variance = 127, 0.0
+    for level, count in enumerate(histogram):
+        weight_background += count
+        if weight_background == 0:
+            continue
+        weight_foreground = total - weight_background
+        if weight_foreground == 0:
+            break
+        sum_background += level * count
+        mean_background = sum_background / weight_background
+        mean_foreground = (sum_all - sum_background) / weight_foreground
+        variance = (
+            weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+        )
+        if variance > best_variance:
+            best_level, best_variance = level, variance
+    return best_level
+
+
+def _encode(img, binarize: bool):
+    buffer = io.BytesIO()
+    if binarize:
+        # 1-bit PNG: text on a clean background compresses very well
+        img.save(buffer, "PNG", optimize=True)
+        return buffer.getvalue(), "image/png"
+    img.save(buffer, "JPEG", quality=85, optimize=True)
+    return buffer.getvalue(), "image/jpeg"
+
+
+def preprocess(image: bytes, max_side: int = None, binarize: bool = None):
+    """
+    Prepares a photo for OCR: decode, apply the EXIF orientation, downscale
+    to max_side, grayscale, stretch contrast and (optionally) binarize, then
+    re-encode compactly. Returns (bytes, mime_type).
+    """
+    from PIL import Image, ImageOps
+
+    max_side = max_side or OCR_MAX_SIDE
+    binarize = OCR_BINARIZE if binarize is None else binarize
+
+    with Image.open(io.BytesIO(image)) as img:
+        # 1. Decode (JPEG straight at reduced scale) and auto-orient
+        img.draft("L", (max_side, max_side))
+        img = ImageOps.exif_transpose(img)
+
+        # 2. Grayscale and downscale
+        img = img.convert("L")
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        # 3. Contrast, then threshold
+        img = ImageOps.autocontrast(img, cutoff=1)
+        if binarize:
+            level = otsu_threshold(img.histogram())
+            img = img.point(lambda value: 255 if value > level else 0, mode="1")
+
+        # 4. Re-encode, shrinking further if still over the API's size limit
+        data, mime_type = _encode(img, binarize)
+        while len(data) > OCR_MAX_BYTES and max(img.size) > 800:
+            img = img.resize(
+                (int(img.width * 0.8), int(img.height * 0.8)),
+                Image.NEAREST if binarize else Image.LANCZOS,
+            )
+            data, mime_type = _encode(img, binarize)
+    return data, mime_type
+
+
+def tesseract_text(image: bytes, languages: str) -> str:
+    """Local OCR of one image with Tesseract."""
+    import pytesseract
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image)) as img:
+        return pytesseract.image_to_string(img, lang=languages)
@@ -0,0 +1,189 @@
+import os
+import base64
+import binascii
+import hashlib
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from starlette.concurrency import run_in_threadpool
+from . import ocr_cache, ocr_preprocess, ocr_backends
+
+# Which engine reads the images:
+# - "ocrspace": OCR.space only
+# - "tesseract": local Tesseract only, works fully offline
+# - "auto": OCR.space, with Tesseract taking small images while OCR.space is
+#   saturated and standing in whenever OCR.space can't be reached
+OCR_BACKEND = os.getenv("OCR_BACKEND", "auto")
+# Prepared images above this go to OCR.space even when it is busy: Tesseract
+# gets slow on big images
+OCR_LOCAL_MAX_BYTES = int(os.getenv("OCR_LOCAL_MAX_BYTES", str(300 * 1024)))
+
+# Image preprocessing is CPU-bound: worker processes keep it off the event
+# loop and out of the GIL
+OCR_PREPROCESS = os.getenv("OCR_PREPROCESS", "true").lower() in ("1", "true", "yes")
+OCR_PREPROCESS_WORKERS = int(os.getenv("OCR_PREPROCESS_WORKERS", "2"))
+
+# Part of the cache key: bump when the request sent for an image changes
+# (engine, language, preprocessing), so older results are not reused
+OCR_PIPELINE_VERSION = f"{OCR_BACKEND}-ara-{'pp1' if OCR_PREPROCESS else 'raw'}"
+
+_process_pool = None
+_stats = {"shared": 0, "fallbacks": 0}
+# Identical images being recognized right now: key -> Future of the result
+_pending = {}
+
+
+async def start():
+    """App startup: OCR engines (the OCR.space connection pool) for the app's lifetime."""
+    for backend in ocr_backends.BACKENDS.values():
+        await backend.start()
+
+
+async def stop():
+    """App shutdown: closes pooled connections and worker processes."""
+    global _process_pool
+    for backend in ocr_backends.BACKENDS.values():
+        await backend.stop()
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+
+def _get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        # Spawned, not forked: the app process runs scheduler and pool threads
+        _process_pool = ProcessPoolExecutor(
+            max_workers=OCR_PREPROCESS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _process_pool
+
+
+async def prepare_image(image: bytes, mime_type: str):
+    """
+    The image to send as (bytes, mime_type): downscaled and cleaned up in a
+    worker process, or the original if preprocessing is off or fails.
+    """
+    if not OCR_PREPROCESS:
+        return image, mime_type
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            _get_process_pool(), ocr_preprocess.preprocess, image
+        )
+    except Exception as e:
+        print(f"OCR preprocessing failed, sending the original image: {e}")
+        return image, mime_type
+
+
+def preferred_backend() -> str:
+    """The engine whose results the cache holds (see OCR_PIPELINE_VERSION)."""
+    return "tesseract" if OCR_BACKEND == "tesseract" else "ocrspace"
+
+
+def choose_backends(size: int) -> list:
+    """Backends to try for an image of `size` bytes, in order."""
+    remote = ocr_backends.BACKENDS["ocrspace"]
+    local = ocr_backends.BACKENDS["tesseract"]
+    if OCR_BACKEND == "ocrspace":
+        return [remote]
+    if OCR_BACKEND == "tesseract":
+        return [local]
+    if not local.available():
+        return [remote]
+    if size <= OCR_LOCAL_MAX_BYTES and remote.busy() and not local.busy():
+        return [local, remote]
+    return [remote, local]
+
+
+def decode_image(base64_image: str):
+    """(bytes, mime_type) of a base64 string or data URL (ValueError if invalid)."""
+    data, mime_type = base64_image, "image/jpeg"
+    if data.startswith("data:"):
+        header, _, data = data.partition(",")
+        mime_type = header[5:].split(";")[0] or mime_type
+    try:
+        return base64.b64decode(data, validate=False), mime_type
+    except (binascii.Error, ValueError):
+        raise ValueError("Invalid base64 image")
+
+
+async def run_backends(image: bytes, mime_type: str):
+    """
+    OCR with the first backend that succeeds. Returns (result, cacheable):
+    only results of the preferred engine are cacheable. Results of a
+    stand-in engine (the preferred one failed, or was busy in auto mode) are
+    not, so the cache never mixes engines under one key.
+    """
+    backends = choose_backends(len(image))
+    last_error = None
+    for attempt, backend in enumerate(backends):
+        try:
+            result = await backend.recognize(image, mime_type)
+        except Exception as e:
+            print(f"OCR backend {backend.name} failed: {e}")
+            last_error = e
+            continue
+        if result.get("IsErroredOnProcessing") and attempt < len(backends) - 1:
+            # e.g. OCR.space rate limit or key problem: try the next engine
+            print(f"OCR backend {backend.name} errored: {result.get('ErrorMessage')}")
+            continue
+        if attempt:
+            _stats["fallbacks"] += 1
+        cacheable = backend.name == preferred_backend() and not result.get(
+            "IsErroredOnProcessing"
+        )
+        return result, cacheable
+    raise last_error or Exception("No OCR backend could read the image")
+
+
+async def recognize(base64_image: str) -> dict:
+    """
+    OCR of one image, cached by the image's content hash: re-scans and
+    retries of the same picture are answered without calling the API, and
+    identical requests arriving together share one call.
+    """
+    image, mime_type = decode_image(base64_image)
+    if not image:
+        raise ValueError("Empty image")
+    key = f"{OCR_PIPELINE_VERSION}:{hashlib.sha256(image).hexdigest()}"
+
+    # 1. Same image already on its way
+    if key in _pending:
+        _stats["shared"] += 1
+        return await asyncio.shield(_pending[key])
+
+    future = asyncio.get_running_loop().create_future()
+    _pending[key] = future
+    try:
+        # 2. Cache
+        result = await run_in_threadpool(ocr_cache.get, key)
+        if result is None:
+            # 3. Preprocess and read with the chosen engine
+            prepared, prepared_type = await prepare_image(image, mime_type)
+            result, cacheable = await run_backends(prepared, prepared_type)
+            if cacheable:
+                await run_in_threadpool(ocr_cache.put, key, result)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        # Waiting duplicates get the same error (or a plain one if cancelled)
+        if not isinstance(e, Exception):
+            e = Exception("OCR request cancelled")
+        future.set_exception(e)
+        # Nobody else may be waiting, don't warn about an unretrieved exception
+        future.exception()
+        raise
+    finally:
+        del _pending[key]
+
+
+def metrics() -> dict:
+    return {
+        **_stats,
+        "backend": OCR_BACKEND,
+        "cache": ocr_cache.metrics(),
+        "backends": {
+            name: backend.metrics() for name, backend in ocr_backends.BACKENDS.items()
+        },
+    }
@@ -0,0 +1,92 @@
+import re
+from .arabic import to_ascii_digits
+
+# Reads patient fields out of the OCR text of a clinic card or prescription
+# header. Labels are matched on the raw text, so every spelling OCR tends to
+# produce is listed.
+
+# Lines of the clinic's own header, not patient data
+HEADER_MARKERS = ("إسلام عمارة", "Eslam Emara", "عيادة", "دكتور", "مركز")
+
+NAME_LABELS = ("المريض", "الاسم", "اسم", "مريض")
+AGE_LABELS = ("السن", "السم", "سنة", "سنه", "عمر", "عام")
+PHONE_LABELS = ("تليفون", "موبايل", "هاتف", "محمول", "جوال", "ت:", "م:")
+ADDRESS_LABELS = ("العنوان", "عنوان", "شارع", "بجوار", "حي", "قرية", "مركز")
+ALL_LABELS = NAME_LABELS + AGE_LABELS + PHONE_LABELS + ADDRESS_LABELS
+
+PHONE_PATTERN = re.compile(r"01[0125]\d{8}")
+AGE_PATTERN = re.compile(r"\b([1-9][0-9]?)\b")
+NUMBER_PATTERN = re.compile(r"\b\d{1,2}\b")
+
+
+def _labelled_value(lines: list, index: int, labels: tuple) -> str:
+    """Text after a label on the line, or the next line if that isn't a label itself."""
+    line = lines[index]
+    label = next((label for label in labels if label in line), None)
+    if not label:
+        return ""
+    value = re.sub(r"[:\-]", "", line.split(label, 1)[1]).strip()
+    if not value and index + 1 < len(lines):
+        next_line = lines[index + 1]
+        if not any(other in next_line for other in ALL_LABELS):
+            value = next_line
+    return value
+
+
+def parse_card_text(text: str) -> dict:
+    """Patient fields (name, age, phone, address) found in the OCR text; missing ones are ""."""
+    lines = [line.strip() for line in (text or "").replace("\r\n", "\n").split("\n")]
+    lines = [
+        line
+        for line in lines
+        if line and not any(marker in line for marker in HEADER_MARKERS)
+    ]
+    fields = {"name": "", "age": "", "phone": "", "address": ""}
+
+    for index, line in enumerate(lines):
+        digits_line = to_ascii_digits(line)
+
+        # 1. Phone
+        if not fields["phone"]:
+            match = PHONE_PATTERN.search(digits_line)
+            if match:
+                fields["phone"] = match.group(0)
+
+        # 2. Name
+        if not fields["name"]:
+            value = _labelled_value(lines, index, NAME_LABELS)
+            if len(value) > 3:
+                fields["name"] = value
+
+        # 3. Age (a number on a line with an age label)
+        if not fields["age"] and any(label in line for label in AGE_LABELS):
+            match = AGE_PATTERN.search(digits_line)
+            if match:
+                fields["age"] = match.group(1)
+
+        # 4. Address
+        if not fields["address"]:
+            value = _labelled_value(lines, index, ADDRESS_LABELS)
+            if len(value) > 4:
+                fields["address"] = value
+
+    # Fallbacks: first text-only line as the name, any plausible age
+    if not fields["name"]:
+        fields["name"] = next(
+            (
+                line
+                for line in lines
+                if len(line) > 5 and not re.search(r"\d", line) and "شارع" not in line
+            ),
+            "",
+        )
+    if not fields["age"]:
+        fields["age"] = next(
+            (
+                number
+                for number in NUMBER_PATTERN.findall(to_ascii_digits(text or ""))
+                if 4 < int(number) < 100
+            ),
+            "",
+        )
+    return fields
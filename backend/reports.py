@@ -0,0 +1,485 @@
+import io
+import os
+import csv
+import json
+import time
+import base64
+import threading
+from datetime import datetime, date, timedelta
+from sqlalchemy import func, or_, and_
+from sqlalchemy.orm import Session
+from . import models
+
+# Rows per page of a report, and per batch when streaming CSV
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+CSV_BATCH_SIZE = 500
+
+GRANULARITIES = ("day", "week", "month")
+MAX_BUCKETS = 1000
+
+# Figures of closed periods (ended before today) are cached. Writes that
+# touch a closed period drop the affected entries (invalidate); the TTL
+# bounds staleness across worker processes, which don't share the cache.
+# Buckets are UTC calendar dates (treatments and payments are stored in
+# UTC), so "today" for open/closed is the UTC date as well (utc_today).
+REPORT_CACHE_TTL_SECONDS = int(os.getenv("REPORT_CACHE_TTL_SECONDS", "3600"))
+REPORT_CACHE_SIZE = 20000
+_cache = {}  # (tenant_id, report, params, start, end) -> (expires_at, value)
+_cache_lock = threading.Lock()
+
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> list:
+    """ValueError if the cursor wasn't made by encode_cursor."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+# --- Debtors ---
+def _debtors_query(
+    db: Session, tenant_id: int, min_balance: float = 0.0, min_days_since_visit: int = None
+):
+    """
+    Patients owing more than min_balance, from the running balances on
+    Patient, with their last treatment date. Ordered by balance (largest
+    first), then id: the keyset the cursor continues from.
+    """
+    last_visits = (
+        db.query(
+            models.Treatment.patient_id.label("patient_id"),
+            func.max(models.Treatment.date).label("last_visit"),
+        )
+        .join(models.Patient, models.Patient.id == models.Treatment.patient_id)
+        .filter(models.Patient.tenant_id == tenant_id, models.Patient.balance > min_balance)
+        .group_by(models.Treatment.patient_id)
+        .subquery()
+    )
+    query = (
+        db.query(models.Patient, last_visits.c.last_visit)
+        .outerjoin(last_visits, last_visits.c.patient_id == models.Patient.id)
+        .filter(models.Patient.tenant_id == tenant_id, models.Patient.balance > min_balance)
+    )
+    if min_days_since_visit:
+        # Not seen for that long (or never treated: an opening balance)
+        cutoff = datetime.utcnow() - timedelta(days=min_days_since_visit)
+        query = query.filter(
+            or_(last_visits.c.last_visit.is_(None), last_visits.c.last_visit <= cutoff)
+        )
+    return query.order_by(models.Patient.balance.desc(), models.Patient.id)
+
+
+def _after(query, balance: float, patient_id: int):
+    return query.filter(
+        or_(
+            models.Patient.balance < balance,
+            and_(models.Patient.balance == balance, models.Patient.id > patient_id),
+        )
+    )
+
+
+def _debtor_row(patient, last_visit) -> dict:
+    return {
+        "id": patient.id,
+        "name": patient.name,
+        "phone": patient.phone,
+        "total_due": patient.total_due or 0.0,
+        "total_paid": patient.total_paid or 0.0,
+        "balance": patient.balance or 0.0,
+        "last_visit": last_visit,
+    }
+
+
+def debtors_page(
+    db: Session,
+    tenant_id: int,
+    min_balance: float = 0.0,
+    min_days_since_visit: int = None,
+    cursor: str = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+) -> dict:
+    """One page of debtors and the cursor of the next page (None on the last page)."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    query = _debtors_query(db, tenant_id, min_balance, min_days_since_visit)
+    if cursor:
+        balance, patient_id = decode_cursor(cursor)
+        query = _after(query, balance, patient_id)
+
+    rows = query.limit(limit + 1).all()
+    items = [_debtor_row(patient, last_visit) for patient, last_visit in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = encode_cursor([last["balance"], last["id"]])
+    return {"items": items, "next_cursor": next_cursor}
+
+
+DEBTOR_CSV_COLUMNS = ("id", "name", "phone", "total_due", "total_paid", "balance", "last_visit")
+
+
+def iter_debtors_csv(
+    db: Session, tenant_id: int, min_balance: float = 0.0, min_days_since_visit: int = None
+):
+    """All debtors as CSV text chunks, read in keyset batches (constant memory)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM so Excel opens the Arabic names as UTF-8
+    buffer.write("\ufeff")
+    writer.writerow(DEBTOR_CSV_COLUMNS)
+
+    query = _debtors_query(db, tenant_id, min_balance, min_days_since_visit)
+    position = None
+    while True:
+        batch_query = _after(query, *position) if position else query
+        rows = batch_query.limit(CSV_BATCH_SIZE).all()
+        for patient, last_visit in rows:
+            row = _debtor_row(patient, last_visit)
+            if row["last_visit"]:
+                row["last_visit"] = row["last_visit"].strftime("%Y-%m-%d")
+            writer.writerow([row[column] for column in DEBTOR_CSV_COLUMNS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        if len(rows) < CSV_BATCH_SIZE:
+            return
+        position = (rows[-1][0].balance, rows[-1][0].id)
+        # Rows already written are not needed in the identity map
+        db.expunge_all()
+
+
+# --- Closed-period cache ---
+def _cache_get(key):
+    with _cache_lock:
+        entry = _cache.get(key)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+
+def _cache_put(key, value):
+    with _cache_lock:
+        if len(_cache) >= REPORT_CACHE_SIZE:
+            _cache.clear()
+        _cache[key] = (time.monotonic() + REPORT_CACHE_TTL_SECONDS, value)
+
+
+def utc_today() -> date:
+    return datetime.utcnow().date()
+
+
+def invalidate(tenant_id: int, when=None):
+    """
+    Drops cached report figures of a tenant after a financial write: the
+    periods containing `when` (a date or datetime), or all of them.
+    """
+    if when is not None:
+        when = when.date() if isinstance(when, datetime) else when
+        if when >= utc_today():
+            return  # Only open periods, which are never cached
+    with _cache_lock:
+        for key in list(_cache):
+            if key[0] != tenant_id:
+                continue
+            if when is None or key[3] <= when < key[4]:
+                del _cache[key]
+
+
+# --- Date buckets ---
+def bucket_start(day: date, granularity: str) -> date:
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())  # Monday
+    if granularity == "month":
+        return day.replace(day=1)
+    return day
+
+
+def next_bucket(start: date, granularity: str) -> date:
+    if granularity == "week":
+        return start + timedelta(days=7)
+    if granularity == "month":
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def bucket_ranges(start: date, end: date, granularity: str) -> list:
+    """[(bucket_start, bucket_end)] covering start..end (inclusive), bucket_end exclusive."""
+    ranges = []
+    current = bucket_start(start, granularity)
+    while current <= end:
+        following = next_bucket(current, granularity)
+        ranges.append((current, following))
+        current = following
+    return ranges
+
+
+def bucket_expression(db: Session, column, granularity: str):
+    """SQL for the start of the column's bucket: date_trunc on Postgres, date functions on SQLite."""
+    if db.get_bind().dialect.name == "postgresql":
+        return func.date_trunc(granularity, column)
+    if granularity == "week":
+        # Next Sunday (or the day itself), back to that week's Monday
+        return func.date(column, "weekday 0", "-6 days")
+    if granularity == "month":
+        return func.strftime("%Y-%m-01", column)
+    return func.date(column)
+
+
+def _as_date(value) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _as_datetime(day: date) -> datetime:
+    return datetime.combine(day, datetime.min.time())
+
+
+# --- Time series ---
+def _timeseries_rows(db: Session, tenant_id: int, granularity: str, start: date, end: date):
+    """{bucket_start: figures} for [start, end), one grouped query per source."""
+    figures = {}
+
+    def add(rows, *names):
+        for row in rows:
+            bucket = figures.setdefault(
+                _as_date(row[0]),
+                {"gross": 0.0, "discounts": 0.0, "received": 0.0, "expenses": 0.0},
+            )
+            for name, value in zip(names, row[1:]):
+                bucket[name] += value or 0.0
+
+    # 1. Treatments: gross and discounts
+    bucket = bucket_expression(db, models.Treatment.date, granularity)
+    add(
+        db.query(bucket, func.sum(models.Treatment.cost), func.sum(models.Treatment.discount))
+        .join(models.Patient)
+        .filter(
+            models.Patient.tenant_id == tenant_id,
+            models.Treatment.date >= _as_datetime(start),
+            models.Treatment.date < _as_datetime(end),
+        )
+        .group_by(bucket)
+        .all(),
+        "gross",
+        "discounts",
+    )
+
+    # 2. Payments received
+    bucket = bucket_expression(db, models.Payment.date, granularity)
+    add(
+        db.query(bucket, func.sum(models.Payment.amount))
+        .join(models.Patient)
+        .filter(
+            models.Patient.tenant_id == tenant_id,
+            models.Payment.date >= _as_datetime(start),
+            models.Payment.date < _as_datetime(end),
+        )
+        .group_by(bucket)
+        .all(),
+        "received",
+    )
+
+    # 3. Expenses (dated by day)
+    bucket = bucket_expression(db, models.Expense.date, granularity)
+    add(
+        db.query(bucket, func.sum(models.Expense.cost))
+        .filter(
+            models.Expense.tenant_id == tenant_id,
+            models.Expense.date >= start,
+            models.Expense.date < end,
+        )
+        .group_by(bucket)
+        .all(),
+        "expenses",
+    )
+    return figures
+
+
+def timeseries(
+    db: Session, tenant_id: int, granularity: str, start: date, end: date
+) -> list:
+    """
+    Gross, discounts, revenue (gross - discounts), received and expenses per
+    bucket from start to end (inclusive), empty buckets included.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+    if end < start:
+        raise ValueError("'to' is before 'from'")
+    ranges = bucket_ranges(start, end, granularity)
+    if len(ranges) > MAX_BUCKETS:
+        raise ValueError(f"Too many buckets (max {MAX_BUCKETS}), use a coarser granularity")
+
+    # 1. Closed buckets from the cache
+    today = utc_today()
+    results = {}
+    for bucket_from, bucket_to in ranges:
+        if bucket_to <= today:
+            cached = _cache_get((tenant_id, "timeseries", granularity, bucket_from, bucket_to))
+            if cached is not None:
+                results[bucket_from] = cached
+
+    # 2. The rest in one pass over the span they cover
+    missing = [r for r in ranges if r[0] not in results]
+    if missing:
+        computed = _timeseries_rows(
+            db, tenant_id, granularity, missing[0][0], missing[-1][1]
+        )
+        for bucket_from, bucket_to in missing:
+            figures = computed.get(
+                bucket_from,
+                {"gross": 0.0, "discounts": 0.0, "received": 0.0, "expenses": 0.0},
+            )
+            results[bucket_from] = figures
+            if bucket_to <= today:
+                _cache_put(
+                    (tenant_id, "timeseries", granularity, bucket_from, bucket_to), figures
+                )
+
+    return [
+        {
+            "start": bucket_from,
+            **results[bucket_from],
+            "revenue": results[bucket_from]["gross"] - results[bucket_from]["discounts"],
+        }
+        for bucket_from, _ in ranges
+    ]
+
+
+# --- Procedures ---
+def _month_segments(start: date, end: date) -> list:
+    """
+    [(segment_start, segment_end, is_whole_month)] covering start..end
+    (inclusive); only the first and last can be partial months.
+    """
+    stop = end + timedelta(days=1)
+    return [
+        (max(month_from, start), min(month_to, stop), month_from >= start and month_to <= stop)
+        for month_from, month_to in bucket_ranges(start, end, "month")
+    ]
+
+
+def _procedure_rows(
+    db: Session, tenant_id: int, start: date, stop: date, by_tooth: bool
+) -> dict:
+    """
+    {month_start: {(procedure, tooth): [count, gross, discounts]}} for
+    [start, stop), in one grouped query.
+    """
+    month = bucket_expression(db, models.Treatment.date, "month")
+    procedure = func.trim(models.Treatment.procedure)
+    columns = [month, procedure]
+    if by_tooth:
+        columns.append(models.Treatment.tooth_number)
+    rows = (
+        db.query(
+            *columns,
+            func.count(models.Treatment.id),
+            func.sum(models.Treatment.cost),
+            func.sum(models.Treatment.discount),
+        )
+        .join(models.Patient)
+        .filter(
+            models.Patient.tenant_id == tenant_id,
+            models.Treatment.date >= _as_datetime(start),
+            models.Treatment.date < _as_datetime(stop),
+        )
+        .group_by(*columns)
+        .all()
+    )
+    months = {}
+    for row in rows:
+        tooth = row[2] if by_tooth else None
+        count, gross, discounts = row[-3:]
+        months.setdefault(_as_date(row[0]), {})[(row[1] or "", tooth)] = [
+            count,
+            gross or 0.0,
+            discounts or 0.0,
+        ]
+    return months
+
+
+def procedures(
+    db: Session, tenant_id: int, start: date, end: date, by_tooth: bool = False
+) -> list:
+    """
+    Treatments grouped by procedure (and tooth) from start to end
+    (inclusive), highest revenue first: count, gross, discounts, revenue,
+    average price charged and its deviation from the price list.
+    """
+    if end < start:
+        raise ValueError("'to' is before 'from'")
+    segments = _month_segments(start, end)
+    if len(segments) > MAX_BUCKETS:
+        raise ValueError(f"Range too long (max {MAX_BUCKETS} months)")
+
+    # 1. Whole closed months from the cache
+    today = utc_today()
+    per_segment = {}
+    for segment_from, segment_to, whole in segments:
+        if whole and segment_to <= today:
+            cached = _cache_get((tenant_id, "procedures", by_tooth, segment_from, segment_to))
+            if cached is not None:
+                per_segment[segment_from] = cached
+
+    # 2. The rest in one grouped query over the span they cover
+    missing = [segment for segment in segments if segment[0] not in per_segment]
+    if missing:
+        computed = _procedure_rows(db, tenant_id, missing[0][0], missing[-1][1], by_tooth)
+        for segment_from, segment_to, whole in missing:
+            rows = computed.get(bucket_start(segment_from, "month"), {})
+            per_segment[segment_from] = rows
+            if whole and segment_to <= today:
+                _cache_put((tenant_id, "procedures", by_tooth, segment_from, segment_to), rows)
+
+    # 3. Combine the months, compare with the current price list
+    totals = {}
+    for rows in per_segment.values():
+        for key, (count, gross, discounts) in rows.items():
+            total = totals.setdefault(key, [0, 0.0, 0.0])
+            total[0] += count
+            total[1] += gross
+            total[2] += discounts
+
+    price_list = {
+        (name or "").strip().lower(): price
+        for name, price in db.query(models.Procedure.name, models.Procedure.price)
+        .filter(models.Procedure.tenant_id == tenant_id)
+        .all()
+    }
+
+    report = []
+    for (procedure, tooth), (count, gross, discounts) in totals.items():
+        average = gross / count if count else 0.0
+        list_price = price_list.get(procedure.lower())
+        deviation = average - list_price if list_price is not None else None
+        report.append(
+            {
+                "procedure": procedure,
+                "tooth_number": tooth,
+                "count": count,
+                "gross": gross,
+                "discounts": discounts,
+                "revenue": gross - discounts,
+                "average_price": round(average, 2),
+                "list_price": list_price,
+                "average_deviation": round(deviation, 2) if deviation is not None else None,
+                "deviation_percent": (
+                    round(deviation / list_price * 100, 1)
+                    if deviation is not None and list_price
+                    else None
+                ),
+            }
+        )
+    report.sort(key=lambda row: (-row["revenue"], row["procedure"], row["tooth_number"] or 0))
+    return report
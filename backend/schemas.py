@@ -1,6 +1,7 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, model_validator
 from typing import List, Optional, TYPE_CHECKING
 from datetime import datetime, date
+from . import auth
 
 
 # --- Patient Schemas ---
@@ -20,11 +21,34 @@ class PatientCreate(PatientBase):
 class Patient(PatientBase):
     id: int
     created_at: datetime
+    total_due: float = 0.0
+    total_paid: float = 0.0
+    balance: float = 0.0
 
     class Config:
         from_attributes = True
 
 
+# --- Patient Card Scan Schemas ---
+class PatientCardFields(BaseModel):
+    name: str = ""
+    age: str = ""
+    phone: str = ""
+    address: str = ""
+
+
+class PatientCandidate(BaseModel):
+    patient: Patient
+    score: float  # 0..1
+    matched_on: List[str]  # "phone", "name"
+
+
+class PatientCardResult(BaseModel):
+    fields: PatientCardFields
+    text: str  # OCR text the fields were read from
+    candidates: List[PatientCandidate]
+
+
 # --- Appointment Schemas ---
 class AppointmentBase(BaseModel):
     patient_id: int
@@ -45,6 +69,31 @@ class Appointment(AppointmentBase):
         from_attributes = True
 
 
+class CalendarAppointment(BaseModel):
+    id: int
+    patient_id: int
+    date_time: datetime
+    status: str
+    notes: Optional[str] = None
+    patient_name: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
+
+class CalendarDay(BaseModel):
+    date: date
+    count: int
+    cancelled: int  # Cancelled and No Show, included in count
+
+
+class AppointmentCalendar(BaseModel):
+    from_date: date
+    to_date: date
+    appointments: List[CalendarAppointment] = []
+    days: Optional[List[CalendarDay]] = None  # only with summary=true
+
+
 # --- Tooth Status Schemas ---
 class ToothStatusBase(BaseModel):
     patient_id: int
@@ -142,6 +191,58 @@ class DashboardStats(BaseModel):
     today_expenses: float = 0.0
 
 
+# --- Report Schemas ---
+class DebtorRow(BaseModel):
+    id: int
+    name: str
+    phone: Optional[str] = None
+    total_due: float
+    total_paid: float
+    balance: float
+    last_visit: Optional[datetime] = None  # last treatment
+
+
+class DebtorsPage(BaseModel):
+    items: List[DebtorRow]
+    next_cursor: Optional[str] = None  # pass back as ?cursor= for the next page
+
+
+class TimeseriesBucket(BaseModel):
+    start: date  # first day of the day/week/month
+    gross: float
+    discounts: float
+    revenue: float  # gross - discounts
+    received: float
+    expenses: float
+
+
+class TimeseriesReport(BaseModel):
+    granularity: str
+    from_date: date
+    to_date: date
+    buckets: List[TimeseriesBucket]
+
+
+class ProcedureStats(BaseModel):
+    procedure: str
+    tooth_number: Optional[int] = None  # only when grouped by tooth
+    count: int
+    gross: float
+    discounts: float
+    revenue: float
+    average_price: float  # average cost charged, before discount
+    list_price: Optional[float] = None  # Procedure.price, if the name is in the list
+    average_deviation: Optional[float] = None  # average_price - list_price
+    deviation_percent: Optional[float] = None
+
+
+class ProceduresReport(BaseModel):
+    from_date: date
+    to_date: date
+    by_tooth: bool
+    procedures: List[ProcedureStats]
+
+
 # --- Auth Schemas ---
 class Token(BaseModel):
     access_token: str
@@ -191,12 +292,29 @@ class AttachmentBase(BaseModel):
 
 class AttachmentCreate(AttachmentBase):
     file_path: str
+    status: str = "ready"
+    content_hash: Optional[str] = None
 
 
 class Attachment(AttachmentBase):
     id: int
     created_at: datetime
     file_path: str
+    status: Optional[str] = "ready"  # "uploading" while the Cloudinary push runs
+    content_hash: Optional[str] = None
+    # Resized copies of image attachments, None until generated
+    thumbnail_url: Optional[str] = None
+    preview_url: Optional[str] = None
+    # Where to load the file from: a signed /uploads URL or the Cloudinary URL
+    url: Optional[str] = None
+
+    @model_validator(mode="after")
+    def sign_urls(self):
+        # Local files are only served with a signature (see SignedStaticFiles)
+        self.url = auth.sign_upload_url(self.file_path)
+        self.thumbnail_url = auth.sign_upload_url(self.thumbnail_url)
+        self.preview_url = auth.sign_upload_url(self.preview_url)
+        return self
 
     class Config:
         from_attributes = True
@@ -236,12 +354,34 @@ class PrescriptionCreate(PrescriptionBase):
 
 class Prescription(PrescriptionBase):
     id: int
-    date: datetime
+    date: Optional[datetime] = None  # nullable column (old rows, restores)
 
     class Config:
         from_attributes = True
 
 
+# --- Patient Bundle Schemas ---
+class PatientBalance(BaseModel):
+    total_cost: float
+    total_discount: float
+    total_due: float  # cost - discount
+    total_paid: float
+    balance: float  # due - paid, > 0 means the patient owes
+
+
+class PatientBundle(BaseModel):
+    """Everything the patient page shows, in one response."""
+
+    patient: Patient
+    tooth_status: List[ToothStatus]
+    treatments: List[Treatment]
+    payments: List[Payment]
+    attachments: List[Attachment]
+    prescriptions: List[Prescription]
+    procedures: List[Procedure]
+    balance: PatientBalance
+
+
 # --- Tenant Schemas ---
 class TenantBase(BaseModel):
     name: str
@@ -253,7 +393,14 @@ class TenantBase(BaseModel):
     # Backup Fields
     google_refresh_token: Optional[str] = None
     backup_frequency: Optional[str] = "off"
+    backup_target: Optional[str] = "drive"
     last_backup_at: Optional[datetime] = None
+    backup_verified_at: Optional[datetime] = None
+    backup_keep_daily: Optional[int] = 7
+    backup_keep_weekly: Optional[int] = 4
+    backup_keep_monthly: Optional[int] = 12
+    max_upload_mb: Optional[int] = None
+    timezone: Optional[str] = "Africa/Cairo"
 
 
 class TenantCreate(TenantBase):
@@ -264,6 +411,8 @@ class TenantUpdate(BaseModel):
     plan: Optional[str] = None
     is_active: Optional[bool] = None
     subscription_end_date: Optional[datetime] = None
+    max_upload_mb: Optional[int] = None
+    timezone: Optional[str] = None
 
 
 class Tenant(TenantBase):
@@ -0,0 +1,195 @@
+import os
+import re
+import mimetypes
+import anyio
+from starlette.datastructures import Headers, QueryParams
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from . import auth
+
+# Uploaded files are written once under a unique name (<uuid>.<ext>, or
+# <sha256>.<ext> plus its _thumb/_preview derivatives) and never change, so
+# browsers may keep them for good
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Content-addressed names carry their own strong validator
+CONTENT_HASH_NAME = re.compile(r"^([0-9a-f]{64})(_[a-z]+)?\.")
+
+# Served instead of the original when the client accepts the encoding
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))
+
+# Uploads are patient data, never active content: no MIME sniffing, and
+# anything opened directly runs sandboxed without scripts. PDFs are left
+# out of the sandbox since browsers refuse to render them inside one.
+NO_SCRIPT_POLICY = "default-src 'none'; img-src 'self'; style-src 'unsafe-inline'; sandbox"
+
+RANGE_HEADER = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeFileResponse(FileResponse):
+    """FileResponse for one byte range of the file (206 Partial Content)."""
+
+    def __init__(self, path, start: int, end: int, stat_result, **kwargs):
+        super().__init__(path, status_code=206, stat_result=stat_result, **kwargs)
+        self.start = start
+        self.end = end
+        self.headers["content-length"] = str(end - start + 1)
+        self.headers["content-range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+
+    async def __call__(self, scope, receive, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if scope["method"].upper() == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        remaining = self.end - self.start + 1
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            await file.seek(self.start)
+            while remaining > 0:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": remaining > 0,
+                    }
+                )
+        if remaining > 0:
+            # File shrank under us, end the response anyway
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def parse_range(value: str, size: int):
+    """
+    Parses a single "bytes=" range. Returns (start, end) inclusive, None to
+    ignore the header (multiple or malformed ranges: send the whole file), or
+    raises ValueError when the range can't be satisfied.
+    """
+    match = RANGE_HEADER.match(value.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("empty suffix range")
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("range not satisfiable")
+    return start, end
+
+
+class CachedStaticFiles(StaticFiles):
+    """
+    StaticFiles for the uploads directory:
+    - long-lived immutable Cache-Control,
+    - strong ETags from the content hash in the file name,
+    - single Range requests answered with 206,
+    - precompressed .br / .gz siblings served when accepted.
+    """
+
+    cache_control = IMMUTABLE_CACHE_CONTROL
+
+    def lookup_path(self, path):
+        # Uploads in progress (.incoming-*) and partial writes are not served
+        name = os.path.basename(path)
+        if name.startswith(".") or name.endswith(".part"):
+            return "", None
+        return super().lookup_path(path)
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        name = os.path.basename(full_path)
+        match = CONTENT_HASH_NAME.match(name)
+        range_header = request_headers.get("range")
+
+        # 1. Pick the representation (precompressed variants only for full responses)
+        encoding = None
+        if not range_header:
+            accepted = request_headers.get("accept-encoding", "")
+            for candidate, suffix in PRECOMPRESSED:
+                if candidate in accepted and os.path.isfile(full_path + suffix):
+                    encoding = candidate
+                    media_type = mimetypes.guess_type(full_path)[0] or "text/plain"
+                    full_path = full_path + suffix
+                    stat_result = os.stat(full_path)
+                    break
+
+        headers = {
+            "cache-control": self.cache_control,
+            "accept-ranges": "bytes",
+            "vary": "Accept-Encoding",
+            "x-content-type-options": "nosniff",
+        }
+        if mimetypes.guess_type(name)[0] != "application/pdf":
+            headers["content-security-policy"] = NO_SCRIPT_POLICY
+        if match:
+            etag = match.group(1) + (match.group(2) or "")
+            headers["etag"] = f'"{etag}-{encoding}"' if encoding else f'"{etag}"'
+        if encoding:
+            headers["content-encoding"] = encoding
+
+        kwargs = {"headers": headers, "stat_result": stat_result}
+        if encoding:
+            kwargs["media_type"] = media_type
+        response = FileResponse(full_path, status_code=status_code, **kwargs)
+
+        # 2. Conditional request
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+
+        # 3. Range request
+        if range_header and status_code == 200:
+            if_range = request_headers.get("if-range")
+            if if_range and if_range != response.headers.get("etag"):
+                # The client's copy is outdated: send the whole file
+                return response
+            try:
+                byte_range = parse_range(range_header, stat_result.st_size)
+            except ValueError:
+                return Response(
+                    status_code=416,
+                    headers={"content-range": f"bytes */{stat_result.st_size}"},
+                )
+            if byte_range:
+                return RangeFileResponse(
+                    full_path, *byte_range, stat_result=stat_result, headers=headers
+                )
+
+        return response
+
+
+class SignedStaticFiles(CachedStaticFiles):
+    """
+    CachedStaticFiles that only serves URLs signed with auth.sign_upload_url.
+    The signature is handed out with the attachment to users of its tenant,
+    so serving needs no database lookup.
+    """
+
+    # Patient files: browser cache only, never shared caches
+    cache_control = "private, max-age=31536000, immutable"
+
+    def __init__(self, *args, mount_path: str = "/uploads", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mount_path = mount_path
+
+    async def get_response(self, path, scope):
+        params = QueryParams(scope.get("query_string", b""))
+        url_path = f"{self.mount_path}/{path.lstrip('/')}"
+        if not auth.verify_upload_signature(url_path, params.get("exp"), params.get("sig")):
+            return Response("Invalid or expired link", status_code=403)
+        return await super().get_response(path, scope)
@@ -0,0 +1,240 @@
+import os
+import re
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import func
+import cloudinary
+import cloudinary.api
+from . import models, database, attachment_service
+
+# Files younger than this are left alone: an upload may have written its file
+# but not yet committed the row that references it
+GC_GRACE_SECONDS = int(os.getenv("STORAGE_GC_GRACE_SECONDS", str(6 * 3600)))
+
+# Cloudinary's delete_resources takes at most 100 public IDs per call
+CLOUDINARY_DELETE_BATCH_SIZE = 100
+CLOUDINARY_FOLDER = "clinic_uploads"
+CLOUDINARY_RESOURCE_TYPES = ("image", "raw", "video")
+# The Cloudinary account may be shared with other databases (staging, a
+# restored copy, a second deployment) whose files this one can't see, so the
+# daily job only reports Cloudinary orphans unless explicitly told to delete
+CLOUDINARY_GC_ENABLED = os.getenv("STORAGE_GC_CLOUDINARY_DELETE", "").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+# Only names the upload code creates are ever collected:
+# <uuid><ext> (legacy), <sha256><ext>, their _thumb/_preview derivatives,
+# .br/.gz precompressed copies, and abandoned .incoming-<uuid> temp files
+UPLOAD_NAME_PATTERN = re.compile(
+    r"^(?P<stem>[0-9a-f]{64}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})"
+    r"(_(thumb|preview))?(\.[A-Za-z0-9]+)?(\.(br|gz))?$"
+)
+TEMP_NAME_PATTERN = re.compile(r"^\.incoming-[0-9a-f-]{36}$")
+
+
+def recount_blob_references(db):
+    """
+    Sets every blob's ref_count to the number of attachments using it.
+    Cascade deletes of patients and tenants remove attachment rows without
+    releasing their blobs; blobs nobody references any more are deleted here
+    (their files become orphans and are collected below).
+    Returns (recounted, deleted).
+    """
+    counts = dict(
+        db.query(models.Attachment.content_hash, func.count(models.Attachment.id))
+        .filter(models.Attachment.content_hash.isnot(None))
+        .group_by(models.Attachment.content_hash)
+        .all()
+    )
+    recounted = deleted = 0
+    cutoff = datetime.utcnow() - timedelta(seconds=GC_GRACE_SECONDS)
+    for blob in db.query(models.Blob).all():
+        actual = counts.get(blob.sha256, 0)
+        if actual == blob.ref_count:
+            continue
+        if actual == 0:
+            if blob.created_at and blob.created_at > cutoff:
+                continue  # Its attachment may still be on the way
+            db.delete(blob)
+            deleted += 1
+        else:
+            blob.ref_count = actual
+            recounted += 1
+    db.commit()
+    return recounted, deleted
+
+
+def referenced_paths(db):
+    """
+    Every stored file path still in use, local or Cloudinary: the files of
+    all attachments, plus blobs created within the grace period (their
+    attachment row may not be committed yet).
+    """
+    paths = set()
+    for (file_path,) in db.query(models.Attachment.file_path).yield_per(1000):
+        if file_path:
+            paths.add(file_path)
+    cutoff = datetime.utcnow() - timedelta(seconds=GC_GRACE_SECONDS)
+    for (file_path,) in db.query(models.Blob.file_path).filter(
+        models.Blob.created_at > cutoff
+    ):
+        paths.add(file_path)
+    return paths
+
+
+def collect_local(referenced: set, dry_run: bool = False):
+    """Deletes orphaned files in the uploads directory. Returns (count, bytes)."""
+    stems = {
+        os.path.splitext(os.path.basename(p))[0]
+        for p in referenced
+        if attachment_service.is_local(p)
+    }
+    cutoff = time.time() - GC_GRACE_SECONDS
+    count = reclaimed = 0
+    if not os.path.isdir(attachment_service.UPLOAD_DIR):
+        return count, reclaimed
+
+    for entry in os.scandir(attachment_service.UPLOAD_DIR):
+        if not entry.is_file():
+            continue
+        match = UPLOAD_NAME_PATTERN.match(entry.name)
+        if match:
+            if match.group("stem") in stems:
+                continue
+        elif not TEMP_NAME_PATTERN.match(entry.name):
+            continue  # Not ours
+        stat = entry.stat()
+        if stat.st_mtime > cutoff:
+            continue
+        if not dry_run:
+            try:
+                os.remove(entry.path)
+            except OSError as e:
+                print(f"GC: could not delete {entry.name}: {e}")
+                continue
+        count += 1
+        reclaimed += stat.st_size
+    return count, reclaimed
+
+
+def _cloudinary_resources(resource_type: str):
+    cursor = None
+    while True:
+        options = {
+            "type": "upload",
+            "prefix": f"{CLOUDINARY_FOLDER}/",
+            "max_results": 500,
+            "resource_type": resource_type,
+        }
+        if cursor:
+            options["next_cursor"] = cursor
+        page = cloudinary.api.resources(**options)
+        yield from page.get("resources", [])
+        cursor = page.get("next_cursor")
+        if not cursor:
+            return
+
+
+def collect_cloudinary(referenced: set, dry_run: bool = False):
+    """Deletes orphaned assets of the uploads folder. Returns (count, bytes)."""
+    if not attachment_service.cloudinary_enabled():
+        return 0, 0
+
+    public_ids = set()
+    for path in referenced:
+        if "cloudinary.com" in path:
+            public_id = attachment_service.cloudinary_public_id(path)
+            if public_id:
+                # Raw assets keep their extension in the public ID
+                public_ids.add(public_id)
+                public_ids.add(public_id + os.path.splitext(path)[1])
+
+    cutoff = datetime.utcnow() - timedelta(seconds=GC_GRACE_SECONDS)
+    count = reclaimed = 0
+    for resource_type in CLOUDINARY_RESOURCE_TYPES:
+        orphans = []
+        for resource in _cloudinary_resources(resource_type):
+            if resource["public_id"] in public_ids:
+                continue
+            created = datetime.strptime(resource["created_at"], "%Y-%m-%dT%H:%M:%SZ")
+            if created > cutoff:
+                continue
+            orphans.append(resource)
+
+        for i in range(0, len(orphans), CLOUDINARY_DELETE_BATCH_SIZE):
+            batch = orphans[i : i + CLOUDINARY_DELETE_BATCH_SIZE]
+            if dry_run:
+                deleted_ids = {r["public_id"] for r in batch}
+            else:
+                result = cloudinary.api.delete_resources(
+                    [r["public_id"] for r in batch], resource_type=resource_type
+                )
+                deleted_ids = {
+                    pid
+                    for pid, state in result.get("deleted", {}).items()
+                    if state == "deleted"
+                }
+            for resource in batch:
+                if resource["public_id"] in deleted_ids:
+                    count += 1
+                    reclaimed += resource.get("bytes", 0)
+    return count, reclaimed
+
+
+def collect_garbage(dry_run: bool = False, cloudinary_dry_run: bool = None):
+    """
+    Reconciles stored files with the attachments table and removes what no
+    attachment uses any more. Admin action; returns a report of what was
+    (or, with dry_run, would be) reclaimed. `cloudinary_dry_run` defaults to
+    `dry_run`.
+    """
+    if cloudinary_dry_run is None:
+        cloudinary_dry_run = dry_run
+    report = {
+        "dry_run": dry_run,
+        "cloudinary_dry_run": cloudinary_dry_run,
+        "blobs_recounted": 0,
+        "blobs_deleted": 0,
+        "local_files_deleted": 0,
+        "local_bytes_reclaimed": 0,
+        "cloudinary_assets_deleted": 0,
+        "cloudinary_bytes_reclaimed": 0,
+    }
+    db = database.SessionLocal()
+    try:
+        # 1. Fix reference counts (skipped on dry runs)
+        if not dry_run:
+            recounted, deleted = recount_blob_references(db)
+            report["blobs_recounted"] = recounted
+            report["blobs_deleted"] = deleted
+
+        # 2. Snapshot what is still referenced
+        referenced = referenced_paths(db)
+    finally:
+        db.close()
+
+    # 3. Sweep storage
+    count, reclaimed = collect_local(referenced, dry_run)
+    report["local_files_deleted"] = count
+    report["local_bytes_reclaimed"] = reclaimed
+
+    try:
+        count, reclaimed = collect_cloudinary(referenced, cloudinary_dry_run)
+        report["cloudinary_assets_deleted"] = count
+        report["cloudinary_bytes_reclaimed"] = reclaimed
+    except Exception as e:
+        print(f"GC: Cloudinary sweep failed: {e}")
+        report["cloudinary_error"] = str(e)
+
+    report["bytes_reclaimed"] = (
+        report["local_bytes_reclaimed"] + report["cloudinary_bytes_reclaimed"]
+    )
+    print(f"Storage GC finished: {report}")
+    return report
+
+
+def scheduled_collect_garbage():
+    """Daily job: Cloudinary is only reported unless STORAGE_GC_CLOUDINARY_DELETE is set."""
+    return collect_garbage(cloudinary_dry_run=not CLOUDINARY_GC_ENABLED)
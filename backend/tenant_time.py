@@ -0,0 +1,87 @@
+import os
+import threading
+from datetime import datetime, date, timedelta
+from typing import NamedTuple
+import pytz
+from sqlalchemy.orm import Session
+from . import models
+
+# "Today" is the clinic's day, not the server's. Treatments and payments are
+# stored as naive UTC, appointments as the clinic's wall-clock time and
+# expenses as plain dates, so a day has a bound for each.
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Africa/Cairo")
+# Timezone changes made through another worker take effect within this long
+TIMEZONE_CACHE_SECONDS = 60
+
+
+class DayBounds(NamedTuple):
+    day: date  # the clinic's calendar date (Expense.date)
+    utc_start: datetime  # half-open [utc_start, utc_end): Treatment/Payment.date
+    utc_end: datetime
+    local_start: datetime  # half-open [local_start, local_end): Appointment.date_time
+    local_end: datetime
+
+
+# tenant_id -> (re-read timezone after, DayBounds of today)
+_today_cache = {}
+_today_cache_lock = threading.Lock()
+
+
+def valid_timezone(name: str) -> bool:
+    return name in pytz.all_timezones_set
+
+
+def _zone(name: str):
+    try:
+        return pytz.timezone(name or DEFAULT_TIMEZONE)
+    except pytz.UnknownTimeZoneError:
+        return pytz.timezone(DEFAULT_TIMEZONE)
+
+
+def _midnight_utc(zone, day: date) -> datetime:
+    # is_dst=False: where DST starts at midnight (Egypt) the day begins at 01:00
+    # summer time, which is the same instant as 00:00 standard time
+    local = zone.localize(datetime(day.year, day.month, day.day), is_dst=False)
+    return local.astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def day_bounds(timezone: str, day: date) -> DayBounds:
+    """Bounds of one calendar day in the given timezone."""
+    zone = _zone(timezone)
+    next_day = day + timedelta(days=1)
+    return DayBounds(
+        day=day,
+        utc_start=_midnight_utc(zone, day),
+        utc_end=_midnight_utc(zone, next_day),
+        local_start=datetime(day.year, day.month, day.day),
+        local_end=datetime(next_day.year, next_day.month, next_day.day),
+    )
+
+
+def local_today(timezone: str) -> date:
+    return datetime.now(_zone(timezone)).date()
+
+
+def tenant_today(db: Session, tenant_id: int) -> DayBounds:
+    """Bounds of the tenant's today (cached per tenant until the day or the cache ends)."""
+    now = datetime.utcnow()
+    with _today_cache_lock:
+        cached = _today_cache.get(tenant_id)
+    if cached and cached[0] > now and cached[1].utc_end > now:
+        return cached[1]
+
+    timezone = (
+        db.query(models.Tenant.timezone).filter(models.Tenant.id == tenant_id).scalar()
+    )
+    bounds = day_bounds(timezone, local_today(timezone))
+    with _today_cache_lock:
+        _today_cache[tenant_id] = (
+            now + timedelta(seconds=TIMEZONE_CACHE_SECONDS),
+            bounds,
+        )
+    return bounds
+
+
+def forget_tenant(tenant_id: int):
+    with _today_cache_lock:
+        _today_cache.pop(tenant_id, None)
@@ -0,0 +1,206 @@
+import os
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import models, database, attachment_service
+
+# Derived images: a small gallery thumbnail and a medium preview for the viewer
+THUMBNAIL_WIDTH = 256
+PREVIEW_WIDTH = 1024
+SIZES = {"thumb": THUMBNAIL_WIDTH, "preview": PREVIEW_WIDTH}
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff")
+
+# Resizing runs in its own small pool, not in request handlers or the
+# scheduler (decoding a large X-ray photo takes a while)
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+_pool = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix="thumbs")
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+
+
+def is_image(attachment: models.Attachment):
+    if (attachment.file_type or "").startswith("image/"):
+        return True
+    return os.path.splitext(attachment.filename or "")[1].lower() in IMAGE_EXTENSIONS
+
+
+def cloudinary_variant(url: str, width: int):
+    # Cloudinary resizes on the fly from URL transformations:
+    # .../image/upload/v1/x.png -> .../image/upload/c_limit,w_256,f_auto,q_auto/v1/x.png
+    if "/image/upload/" not in url:
+        return None
+    return url.replace(
+        "/image/upload/", f"/image/upload/c_limit,w_{width},f_auto,q_auto/", 1
+    )
+
+
+def derivative_paths(file_path: str, ext: str):
+    # Stored alongside the original: /uploads/<stem>_thumb.webp, ..._preview.webp
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    return {name: f"/uploads/{stem}_{name}{ext}" for name in SIZES}
+
+
+def remove_derivatives(file_path: str):
+    """Deletes the local thumbnail/preview files of a stored original."""
+    for ext in (".webp", ".jpg"):
+        for path in derivative_paths(file_path, ext).values():
+            full_path = attachment_service.local_path(path)
+            if os.path.exists(full_path):
+                os.remove(full_path)
+
+
+class UndecodableImage(Exception):
+    """The stored file can't be read as an image; retrying won't help."""
+
+
+def _render(source: str, file_path: str):
+    """Writes the derivatives of a local image. Returns {"thumb": url, "preview": url}."""
+    try:
+        from PIL import Image, ImageOps, features
+    except ImportError:
+        raise Exception(
+            "Missing dependency 'Pillow' on server. Please run 'pip install Pillow'."
+        )
+
+    use_webp = features.check("webp")
+    ext = ".webp" if use_webp else ".jpg"
+    targets = derivative_paths(file_path, ext)
+    if all(os.path.exists(attachment_service.local_path(p)) for p in targets.values()):
+        # Same content (dedup) was already rendered
+        return targets
+
+    try:
+        img = Image.open(source)
+        # JPEG can decode at a reduced scale directly, much cheaper for big photos
+        img.draft("RGB", (PREVIEW_WIDTH, PREVIEW_WIDTH * 4))
+        img.load()
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        raise UndecodableImage(str(e))
+
+    with img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "RGBA", "L"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        if not use_webp and img.mode == "RGBA":
+            img = img.convert("RGB")
+
+        # Largest first, each smaller one is resized from the previous result
+        for name, width in sorted(SIZES.items(), key=lambda s: -s[1]):
+            img.thumbnail((width, width * 4))
+            full_path = attachment_service.local_path(targets[name])
+            # Attachments sharing the content render concurrently to the same
+            # targets: each writes its own temp file, the last rename wins
+            tmp_path = f"{full_path}.{uuid.uuid4().hex}.part"
+            try:
+                if use_webp:
+                    img.save(tmp_path, "WEBP", quality=80, method=4)
+                else:
+                    img.save(
+                        tmp_path, "JPEG", quality=85, optimize=True, progressive=True
+                    )
+                os.replace(tmp_path, full_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    return targets
+
+
+def _same_content(db, attachment: models.Attachment):
+    """The attachment and every other one stored as the same file."""
+    query = db.query(models.Attachment)
+    if attachment.content_hash:
+        return query.filter(
+            models.Attachment.content_hash == attachment.content_hash,
+            models.Attachment.file_path == attachment.file_path,
+        )
+    return query.filter(models.Attachment.id == attachment.id)
+
+
+def generate(attachment_id: int):
+    """
+    Fills thumbnail_url / preview_url of an image attachment (and of every
+    attachment sharing its content). Cloudinary originals get transformation
+    URLs, local originals get resized copies next to them.
+    """
+    db = database.SessionLocal()
+    try:
+        attachment = (
+            db.query(models.Attachment)
+            .filter(models.Attachment.id == attachment_id)
+            .first()
+        )
+        if not attachment or not is_image(attachment):
+            return
+
+        # 1. Work out the URLs
+        if attachment_service.is_local(attachment.file_path):
+            source = attachment_service.local_path(attachment.file_path)
+            if not os.path.exists(source):
+                # Moved to Cloudinary meanwhile, the push sets the URLs
+                return
+            urls = _render(source, attachment.file_path)
+        else:
+            urls = {
+                name: cloudinary_variant(attachment.file_path, width)
+                for name, width in SIZES.items()
+            }
+            if not urls["thumb"]:
+                return
+
+        # 2. Save them on the attachment(s)
+        _same_content(db, attachment).update(
+            {
+                models.Attachment.thumbnail_url: urls["thumb"],
+                models.Attachment.preview_url: urls["preview"],
+                models.Attachment.thumbnail_error: None,
+            },
+            synchronize_session=False,
+        )
+        db.commit()
+    except UndecodableImage as e:
+        # Recorded so the lazy backfill stops retrying it on every listing
+        print(f"Attachment {attachment_id} is not a readable image: {e}")
+        db.rollback()
+        _same_content(db, attachment).update(
+            {models.Attachment.thumbnail_error: str(e)[:255] or "undecodable"},
+            synchronize_session=False,
+        )
+        db.commit()
+    except Exception as e:
+        print(f"Thumbnail generation failed for attachment {attachment_id}: {e}")
+    finally:
+        db.close()
+
+
+def schedule(attachment_id: int):
+    """Queues generation on the thumbnail pool, once per attachment at a time."""
+    with _in_flight_lock:
+        if attachment_id in _in_flight:
+            return
+        _in_flight.add(attachment_id)
+
+    def run():
+        try:
+            generate(attachment_id)
+        finally:
+            with _in_flight_lock:
+                _in_flight.discard(attachment_id)
+
+    _pool.submit(run)
+
+
+def backfill(attachments: list):
+    """
+    Lazy backfill: attachments uploaded before thumbnails existed get them
+    the first time they are listed. Files that failed to decode are skipped.
+    """
+    for attachment in attachments:
+        if (
+            not attachment.thumbnail_url
+            and not attachment.thumbnail_error
+            and attachment.status != "uploading"
+            and is_image(attachment)
+        ):
+            schedule(attachment.id)
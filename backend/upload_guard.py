@@ -0,0 +1,268 @@
+import os
+import re
+import json
+import time
+import threading
+from jose import JWTError, jwt
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from . import models, database, auth
+
+# Default per-file limits; a tenant can get its own with Tenant.max_upload_mb
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "25"))
+LOGO_MAX_MB = int(os.getenv("LOGO_MAX_MB", "2"))
+
+# Endpoints whose bodies are checked, and what they may contain
+GUARDED_UPLOADS = {
+    "/upload/": "attachment",
+    "/auth/register_clinic": "logo",
+}
+ALLOWED_TYPES = {
+    "attachment": ("image/", "application/pdf", "application/dicom"),
+    "logo": ("image/",),
+}
+# Image types that can carry script (stored XSS when opened from /uploads)
+BLOCKED_TYPES = ("image/svg+xml",)
+
+# Bytes looked at to detect the real file type
+SNIFF_BYTES = 2048
+# The file part must start within this many bytes of the body to be sniffed
+# while streaming; otherwise the endpoint's own check applies
+SNIFF_WINDOW = 64 * 1024
+
+# Tenant limits are looked up once a minute at most, not per request
+LIMIT_CACHE_SECONDS = 60
+_limit_cache = {}
+_limit_cache_lock = threading.Lock()
+
+# Fallback signatures when libmagic is not available on the host
+_SIGNATURES = (
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (0, b"BM", "image/bmp"),
+    (0, b"II*\x00", "image/tiff"),
+    (0, b"MM\x00*", "image/tiff"),
+    (0, b"%PDF-", "application/pdf"),
+    (128, b"DICM", "application/dicom"),
+)
+
+
+class UploadRejected(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def sniff_mime(head: bytes) -> str:
+    """MIME type from the file's first bytes (not from the client's claims)."""
+    try:
+        import magic
+
+        return magic.from_buffer(head[:SNIFF_BYTES], mime=True)
+    except ImportError:
+        pass
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for offset, signature, mime in _SIGNATURES:
+        if head[offset : offset + len(signature)] == signature:
+            return mime
+    return "application/octet-stream"
+
+
+def is_allowed(mime: str, kind: str) -> bool:
+    if mime in BLOCKED_TYPES:
+        return False
+    return any(mime.startswith(allowed) for allowed in ALLOWED_TYPES[kind])
+
+
+def check_file_type(head: bytes, kind: str) -> str:
+    """Returns the sniffed MIME type, raises UploadRejected if not allowed."""
+    mime = sniff_mime(head)
+    if not is_allowed(mime, kind):
+        raise UploadRejected(415, f"Unsupported file type: {mime}")
+    return mime
+
+
+def tenant_upload_limit(tenant_id: int) -> int:
+    """Upload limit in bytes for a tenant (cached)."""
+    now = time.monotonic()
+    with _limit_cache_lock:
+        cached = _limit_cache.get(tenant_id)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    db = database.SessionLocal()
+    try:
+        max_mb = (
+            db.query(models.Tenant.max_upload_mb)
+            .filter(models.Tenant.id == tenant_id)
+            .scalar()
+        )
+    finally:
+        db.close()
+
+    limit = (max_mb or MAX_UPLOAD_MB) * 1024 * 1024
+    with _limit_cache_lock:
+        _limit_cache[tenant_id] = (now + LIMIT_CACHE_SECONDS, limit)
+    return limit
+
+
+def forget_tenant_limit(tenant_id: int):
+    with _limit_cache_lock:
+        _limit_cache.pop(tenant_id, None)
+
+
+def _token_tenant_id(headers: Headers):
+    authorization = headers.get("authorization", "")
+    if not authorization.lower().startswith("bearer "):
+        return None
+    try:
+        payload = jwt.decode(
+            authorization[7:], auth.SECRET_KEY, algorithms=[auth.ALGORITHM]
+        )
+    except JWTError:
+        return None  # The endpoint rejects it anyway
+    return payload.get("tenant_id")
+
+
+def upload_limit(headers: Headers, kind: str) -> int:
+    if kind == "logo":
+        return LOGO_MAX_MB * 1024 * 1024
+    tenant_id = _token_tenant_id(headers)
+    if tenant_id is None:
+        return MAX_UPLOAD_MB * 1024 * 1024
+    return tenant_upload_limit(tenant_id)
+
+
+class _MultipartSniffer:
+    """Finds the first file part of a multipart body and collects its first bytes."""
+
+    def __init__(self, content_type: str):
+        match = re.search(r'boundary="?([^";]+)"?', content_type or "")
+        self.boundary = b"--" + match.group(1).encode("latin-1") if match else None
+        self.buffer = bytearray()
+        self.done = self.boundary is None
+
+    def feed(self, chunk: bytes):
+        """Returns the file's first bytes once known, else None."""
+        if self.done:
+            return None
+        self.buffer.extend(chunk)
+        position = 0
+        while True:
+            start = self.buffer.find(self.boundary, position)
+            if start < 0:
+                break
+            headers_end = self.buffer.find(b"\r\n\r\n", start)
+            if headers_end < 0:
+                break
+            part_headers = bytes(self.buffer[start:headers_end]).lower()
+            data_start = headers_end + 4
+            if b"filename=" not in part_headers:
+                position = data_start
+                continue
+            data = self.buffer[data_start:]
+            end = data.find(b"\r\n" + self.boundary)
+            if end >= 0:
+                data = data[:end]  # Small file, entirely in the buffer
+            elif len(data) < SNIFF_BYTES:
+                return None  # Wait for more
+            self.done = True
+            return bytes(data[:SNIFF_BYTES])
+        if len(self.buffer) > SNIFF_WINDOW:
+            self.done = True  # File part too far in, leave it to the endpoint
+        return None
+
+
+class UploadGuardMiddleware:
+    """
+    Rejects oversized or wrongly typed uploads while the body streams in:
+    - Content-Length above the limit is refused before reading anything,
+    - the body is counted as it is received and the upload aborted (413)
+      as soon as it passes the limit (chunked or lying clients),
+    - the file part's first bytes are sniffed and a disallowed type is
+      refused (415) without reading the rest.
+    The limit is per tenant (Tenant.max_upload_mb, via the token's tenant_id).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        kind = GUARDED_UPLOADS.get(scope.get("path")) if scope["type"] == "http" else None
+        if not kind or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        limit = await run_in_threadpool(upload_limit, headers, kind)
+        limit_mb = limit // (1024 * 1024)
+
+        content_length = headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            await self._reject(send, UploadRejected(413, f"File too large (max {limit_mb} MB)"))
+            return
+
+        sniffer = _MultipartSniffer(headers.get("content-type"))
+        state = {"received": 0, "rejected": None, "responded": False}
+
+        async def guarded_receive():
+            if state["rejected"]:
+                raise state["rejected"]
+            message = await receive()
+            if message["type"] != "http.request":
+                return message
+
+            body = message.get("body", b"")
+            state["received"] += len(body)
+            if state["received"] > limit:
+                state["rejected"] = UploadRejected(
+                    413, f"File too large (max {limit_mb} MB)"
+                )
+                raise state["rejected"]
+
+            head = sniffer.feed(body)
+            if head is not None:
+                try:
+                    check_file_type(head, kind)
+                except UploadRejected as e:
+                    state["rejected"] = e
+                    raise
+            return message
+
+        async def guarded_send(message):
+            # Whatever the app makes of the aborted body (FastAPI turns it
+            # into a 400), the client gets the real reason
+            if state["rejected"]:
+                if not state["responded"]:
+                    state["responded"] = True
+                    await self._reject(send, state["rejected"])
+                return
+            await send(message)
+
+        try:
+            await self.app(scope, guarded_receive, guarded_send)
+        except UploadRejected:
+            pass
+        if state["rejected"] and not state["responded"]:
+            state["responded"] = True
+            await self._reject(send, state["rejected"])
+
+    @staticmethod
+    async def _reject(send, error: UploadRejected):
+        body = json.dumps({"detail": error.detail}).encode("utf-8")
+        await send(
+            {
+                "type": "http.response.start",
+                "status": error.status_code,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode("latin-1")),
+                    (b"connection", b"close"),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
@@ -67,13 +67,22 @@ api.interceptors.response.use(
 // Patients
 export const searchPatients = (query) => api.get(`/patients/search?q=${query}`);
 export const getPatients = () => api.get('/patients/');
+// Patients who owe money, largest balance first
+export const getDebtors = (limit = 20) => api.get(`/patients/?has_balance=true&limit=${limit}`);
+export const getDebtorsReport = (params = {}) => api.get('/reports/debtors', { params });
+export const downloadDebtorsCsv = (params = {}) => api.get('/reports/debtors', { params: { ...params, format: 'csv' }, responseType: 'blob' });
 export const getPatient = (id) => api.get(`/patients/${id}`);
+// Patient page data (chart, treatments, payments, files, procedures, balance) in one request
+export const getPatientBundle = (id) => api.get(`/patients/${id}/bundle`);
 export const createPatient = (data) => api.post('/patients/', data);
 export const updatePatient = (id, data) => api.put(`/patients/${id}`, data);
 export const deletePatient = (id) => api.delete(`/patients/${id}`);
 
 // Appointments
 export const getAppointments = () => api.get('/appointments/');
+// Calendar window (from/to are inclusive YYYY-MM-DD), summary = per-day counts only
+export const getAppointmentCalendar = (from, to, summary = false) =>
+    api.get('/appointments/calendar', { params: { from, to, summary } });
 export const createAppointment = (data) => api.post('/appointments/', data);
 export const updateAppointmentStatus = (id, status) => api.put(`/appointments/${id}/status?status=${status}`);
 export const deleteAppointment = (id) => api.delete(`/appointments/${id}`);
@@ -94,6 +103,9 @@ export const getAllPayments = () => api.get('/payments/');
 export const getPatientPayments = (patientId) => api.get(`/patients/${patientId}/payments`);
 export const getFinancialStats = () => api.get('/finance/stats');
 export const getDashboardStats = () => api.get('/stats/dashboard');
+// Revenue / received / expenses per bucket: granularity = day | week | month
+export const getProcedureReport = (params = {}) => api.get('/reports/procedures', { params });
+export const getTimeseries = (granularity = 'month', params = {}) => api.get('/reports/timeseries', { params: { granularity, ...params } });
 export const deletePayment = (id) => api.delete(`/payments/${id}`);
 
 // Backup
@@ -115,6 +127,11 @@ export const updateBackupSchedule = (frequency) => {
     return api.put('/settings/backup/schedule', formData);
 };
 export const getBackupStatus = () => api.get('/settings/backup/status');
+export const updateTimezone = (timezone) => {
+    const formData = new FormData();
+    formData.append('timezone', timezone);
+    return api.put('/settings/timezone', formData);
+};
 export const triggerManualBackup = () => api.post('/settings/backup/now');
 
 // Procedures
@@ -124,7 +141,26 @@ export const updateProcedure = (id, data) => api.put(`/procedures/${id}`, data);
 export const deleteProcedure = (id) => api.delete(`/procedures/${id}`);
 
 // Attachments
-export const uploadAttachment = (patientId, file) => {
+const sha256Hex = async (file) => {
+    // crypto.subtle only exists in secure contexts (https / localhost)
+    if (!window.crypto?.subtle || !file.arrayBuffer) return null;
+    const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+};
+export const uploadAttachment = async (patientId, file) => {
+    // Content the clinic already uploaded is attached by hash, without re-sending it
+    const hash = await sha256Hex(file).catch(() => null);
+    if (hash) {
+        const hashData = new FormData();
+        hashData.append('sha256', hash);
+        hashData.append('filename', file.name);
+        hashData.append('file_type', file.type || 'application/octet-stream');
+        try {
+            return await api.post(`/upload/by-hash?patient_id=${patientId}`, hashData);
+        } catch (err) {
+            if (err.response?.status !== 404) throw err;
+        }
+    }
     const formData = new FormData();
     formData.append('file', file);
     return api.post(`/upload/?patient_id=${patientId}`, formData, {
@@ -151,3 +187,5 @@ export const deletePrescription = (id) => api.delete(`/prescriptions/${id}`);
 
 // OCR
 export const performOCR = (base64Image) => api.post('/ocr/', { base64Image }, { timeout: 60000 });
+// OCR + parsed patient fields + existing patients that may match, in one call
+export const scanPatientCard = (base64Image) => api.post('/ocr/patient-card', { base64Image }, { timeout: 60000 });
@@ -1,6 +1,7 @@
 import React, { useState, useRef, useEffect } from 'react';
-import { Camera, X, RefreshCw, Check, Loader2, Info, Scan } from 'lucide-react';
-import { performOCR } from '../api';
+import { Camera, X, RefreshCw, Check, Loader2, Info, Scan, ArrowLeft } from 'lucide-react';
+import { Link } from 'react-router-dom';
+import { scanPatientCard } from '../api';
 
 export default function PatientScanner({ onScanComplete, onClose }) {
     const [isReady, setIsReady] = useState(false);
@@ -12,6 +13,7 @@ export default function PatientScanner({ onScanComplete, onClose }) {
     const [rawOcrText, setRawOcrText] = useState('');
     const [showRaw, setShowRaw] = useState(false);
     const [extractedData, setExtractedData] = useState({ name: '', age: '', address: '', phone: '' });
+    const [candidates, setCandidates] = useState([]);
     const [errorHeader, setErrorHeader] = useState('');
     const videoRef = useRef(null);
     const canvasRef = useRef(null);
@@ -61,6 +63,7 @@ export default function PatientScanner({ onScanComplete, onClose }) {
     const retake = () => {
         setCapturedImage(null);
         setIsReviewing(false);
+        setCandidates([]);
         setErrorHeader('');
         startCamera();
     };
@@ -116,20 +119,19 @@ export default function PatientScanner({ onScanComplete, onClose }) {
                 imageToProcess = canvas.toDataURL('image/jpeg', 0.80);
             }
 
-            const response = await performOCR(imageToProcess);
-            if (response.data.IsErroredOnProcessing) throw new Error(response.data.ErrorMessage[0]);
-
-            const rawText = response.data.ParsedResults?.[0]?.ParsedText || "";
-            const text = sanitizeText(rawText);
-            setRawOcrText(text);
-            const parsed = parseText(text);
-            setExtractedData(parsed);
+            // Fields are parsed and matched against existing patients on the server
+            const response = await scanPatientCard(imageToProcess);
+            setRawOcrText(response.data.text);
+            setExtractedData(response.data.fields);
+            setCandidates(response.data.candidates);
             setIsReviewing(true);
         } catch (err) {
             console.error("OCR Error:", err);
             let msg = "فشل الاتصال بمحرك القراءة.";
             if (err.code === 'ECONNABORTED') {
                 msg = "انتهى وقت المحاولة (Timeout)";
+            } else if (err.response?.data?.detail) {
+                msg = `خطأ: ${err.response.data.detail}`;
             } else if (err.message) {
                 msg = `خطأ: ${err.message}`;
             }
@@ -140,110 +142,6 @@ export default function PatientScanner({ onScanComplete, onClose }) {
         }
     };
 
-    const sanitizeText = (text) => {
-        if (!text) return '';
-        return text.trim().replace(/\r\n/g, '\n');
-    };
-
-    const parseText = (text) => {
-        const hindiToEn = (s) => s.replace(/[٠١٢٣٤٥٦٧٨٩]/g, d => "٠١٢٣٤٥٦٧٨٩".indexOf(d));
-        const lines = text.split('\n').map(l => l.trim()).filter(l => l.length > 0);
-
-        // Filter out clinic headers to reduce noise
-        const cleanLines = lines.filter(l =>
-            !l.includes('إسلام عمارة') &&
-            !l.includes('Eslam Emara') &&
-            !l.includes('عيادة') &&
-            !l.includes('دكتور') &&
-            !l.includes('مركز')
-        );
-
-        const data = { name: '', age: '', phone: '', address: '' };
-
-        const phoneRegex = /(01[0125]\d{8})/;
-        const ageRegex = /\b([1-9][0-9]?)\b/;
-
-        // Keyword lists for fuzzy matching
-        const nameKeywords = ['المريض', 'الاسم', 'اسم', 'مريض'];
-        const ageKeywords = ['السن', 'السم', 'سنة', 'سنه', 'عمر', 'عام'];
-        const phoneKeywords = ['تليفون', 'موبايل', 'هاتف', 'محمول', 'جوال', 'ت:', 'م:'];
-        const addressKeywords = ['العنوان', 'عنوان', 'شارع', 'بجوار', 'حي', 'قرية', 'مركز'];
-
-        cleanLines.forEach((line, index) => {
-            const normalizedLine = hindiToEn(line);
-
-            // Helper: Get value after label or from next line
-            const extractValue = (lineContent, keywords) => {
-                let val = '';
-                const matchedKeyword = keywords.find(k => lineContent.includes(k));
-                if (matchedKeyword) {
-                    const parts = lineContent.split(matchedKeyword);
-                    // Take what's after the keyword on the same line
-                    val = parts[1] ? parts[1].replace(/[:\-]/g, '').trim() : '';
-
-                    // If same line empty, check next line
-                    if (!val && cleanLines[index + 1]) {
-                        const nextLine = cleanLines[index + 1];
-                        // Ensure next line isn't another label
-                        const isNextLabel = [...nameKeywords, ...ageKeywords, ...phoneKeywords, ...addressKeywords]
-                            .some(k => nextLine.includes(k));
-                        if (!isNextLabel) val = nextLine;
-                    }
-                }
-                return val;
-            };
-
-            // 1. Phone (Priority: High Regex Match)
-            const phoneMatch = normalizedLine.match(phoneRegex);
-            if (phoneMatch && !data.phone) data.phone = phoneMatch[0];
-
-            // 2. Name
-            if (!data.name) {
-                const nameVal = extractValue(line, nameKeywords);
-                if (nameVal && nameVal.length > 3) data.name = nameVal;
-            }
-
-            // 3. Age
-            if (!data.age) {
-                const ageMatch = normalizedLine.match(ageRegex);
-                const hasAgeKeyword = ageKeywords.some(k => line.includes(k));
-                if (hasAgeKeyword && ageMatch) {
-                    data.age = ageMatch[0];
-                }
-            }
-
-            // 4. Address
-            if (!data.address) {
-                const addrVal = extractValue(line, addressKeywords);
-                if (addrVal && addrVal.length > 4) data.address = addrVal;
-            }
-        });
-
-        // --- Final Fallbacks (If still empty) ---
-
-        // Name Fallback: Usually the first line after doctor info
-        if (!data.name && cleanLines.length > 0) {
-            data.name = cleanLines.find(l => l.length > 5 && !l.match(/\d/) && !l.includes('شارع')) || '';
-        }
-
-        // Phone Fallback: Any 11-digit number starting with 01
-        if (!data.phone) {
-            const anyPhone = hindiToEn(text).match(phoneRegex);
-            if (anyPhone) data.phone = anyPhone[0];
-        }
-
-        // Age Fallback: Any 2-digit number 5-95
-        if (!data.age) {
-            const possibleAges = hindiToEn(text).match(/\b\d{1,2}\b/g);
-            if (possibleAges) {
-                const age = possibleAges.find(n => parseInt(n) > 4 && parseInt(n) < 100);
-                if (age) data.age = age;
-            }
-        }
-
-        return data;
-    };
-
     return (
         <div className="fixed inset-0 bg-slate-900/95 backdrop-blur-md z-[200] flex items-center justify-center p-4">
             <div className="bg-white dark:bg-slate-800 w-full max-w-xl rounded-[2.5rem] shadow-2xl overflow-hidden relative">
@@ -300,6 +198,29 @@ export default function PatientScanner({ onScanComplete, onClose }) {
                                 </div>
                             )}
 
+                            {candidates.length > 0 && (
+                                <div className="mb-6 p-4 bg-amber-50 dark:bg-amber-500/10 rounded-2xl border border-amber-200 dark:border-amber-500/20">
+                                    <label className="text-xs font-black text-amber-700 dark:text-amber-400 block mb-2">مرضى مسجلين قد يكونوا نفس الشخص:</label>
+                                    <div className="space-y-2">
+                                        {candidates.map(({ patient, matched_on }) => (
+                                            <Link
+                                                key={patient.id}
+                                                to={`/patients/${patient.id}`}
+                                                onClick={onClose}
+                                                className="flex items-center justify-between p-3 bg-white dark:bg-slate-800 rounded-xl hover:ring-2 hover:ring-primary/20 transition-all"
+                                            >
+                                                <span className="font-bold dark:text-white">{patient.name}</span>
+                                                <span className="flex items-center gap-2 text-xs text-slate-500 dark:text-slate-400" dir="ltr">
+                                                    {patient.phone}
+                                                    {matched_on.includes('phone') && <span className="text-amber-600 font-black">✓</span>}
+                                                    <ArrowLeft size={14} />
+                                                </span>
+                                            </Link>
+                                        ))}
+                                    </div>
+                                </div>
+                            )}
+
                             <div className="space-y-4">
                                 <div><label className="text-xs font-bold text-slate-400 block mb-1">الاسم</label>
                                     <input type="text" value={extractedData.name} onChange={e => setExtractedData({ ...extractedData, name: e.target.value })} className="w-full p-4 bg-slate-50 dark:bg-slate-800 border-none rounded-2xl font-bold dark:text-white focus:ring-2 focus:ring-primary/20 transition-all" /></div>
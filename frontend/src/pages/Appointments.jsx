@@ -1,24 +1,49 @@
 import React, { useState, useEffect } from 'react';
-import { Calendar, Clock, Plus, User, CheckCircle, XCircle, Trash2, LayoutGrid, List as ListIcon } from 'lucide-react';
-import { getAppointments, createAppointment, updateAppointmentStatus, deleteAppointment, getPatients } from '../api';
+import { Calendar, Clock, Plus, User, CheckCircle, XCircle, Trash2, LayoutGrid, List as ListIcon, ChevronRight, ChevronLeft } from 'lucide-react';
+import { getAppointmentCalendar, createAppointment, updateAppointmentStatus, deleteAppointment, getPatients } from '../api';
 import { getTodayDateTimeStr } from '../utils/toothUtils';
 
+// Days are local YYYY-MM-DD strings, like the stored appointment times
+const toDayStr = (d) => `${d.getFullYear()}-${String(d.getMonth() + 1).padStart(2, '0')}-${String(d.getDate()).padStart(2, '0')}`;
+const shiftDay = (day, days) => {
+    const d = new Date(`${day}T00:00`);
+    d.setDate(d.getDate() + days);
+    return toDayStr(d);
+};
+const monthRange = (day) => {
+    const d = new Date(`${day}T00:00`);
+    return [toDayStr(new Date(d.getFullYear(), d.getMonth(), 1)), toDayStr(new Date(d.getFullYear(), d.getMonth() + 1, 0))];
+};
+
 export default function Appointments() {
     const [viewMode, setViewMode] = useState('board'); // 'list' | 'board'
     const [appointments, setAppointments] = useState([]);
+    const [selectedDay, setSelectedDay] = useState(getTodayDateTimeStr().slice(0, 10));
+    const [monthDays, setMonthDays] = useState([]); // [{date, count, cancelled}]
     const [patients, setPatients] = useState([]);
     const [isModalOpen, setIsModalOpen] = useState(false);
     const [newAppt, setNewAppt] = useState({ patient_id: '', date_time: getTodayDateTimeStr(), notes: '' });
 
     useEffect(() => {
-        loadData();
+        getPatients()
+            .then(res => setPatients(res.data))
+            .catch(err => console.error("Failed to load patients", err));
     }, []);
 
+    useEffect(() => {
+        loadData();
+    }, [selectedDay]);
+
+    // Only the visible window: the selected day, plus per-day counts of its month
     const loadData = async () => {
         try {
-            const [aRes, pRes] = await Promise.all([getAppointments(), getPatients()]);
-            setAppointments(aRes.data);
-            setPatients(pRes.data);
+            const [monthStart, monthEnd] = monthRange(selectedDay);
+            const [aRes, mRes] = await Promise.all([
+                getAppointmentCalendar(selectedDay, selectedDay),
+                getAppointmentCalendar(monthStart, monthEnd, true)
+            ]);
+            setAppointments(aRes.data.appointments);
+            setMonthDays(mRes.data.days || []);
         } catch (err) {
             console.error("Failed to load appointments", err);
         }
@@ -32,8 +57,11 @@ export default function Appointments() {
                 patient_id: parseInt(newAppt.patient_id)
             });
             setIsModalOpen(false);
+            // Show the day the appointment was booked on
+            const day = newAppt.date_time.slice(0, 10);
             setNewAppt({ patient_id: '', date_time: getTodayDateTimeStr(), notes: '' });
-            loadData();
+            if (day !== selectedDay) setSelectedDay(day);
+            else loadData();
         } catch (err) {
             alert('فشل في حجز الموعد');
         }
@@ -52,7 +80,7 @@ export default function Appointments() {
         if (!window.confirm("هل أنت متأكد من حذف هذا الموعد نهائياً؟")) return;
         try {
             await deleteAppointment(id);
-            setAppointments(prev => prev.filter(a => a.id !== id));
+            loadData();
         } catch (err) {
             alert("فشل حذف الموعد");
             console.error(err);
@@ -107,6 +135,40 @@ export default function Appointments() {
                 </div>
             </div>
 
+            {/* Day navigation and the month's appointment counts */}
+            <div className="bg-white dark:bg-slate-800/50 rounded-[2rem] p-4 shadow-sm border border-slate-100 dark:border-white/5 space-y-4">
+                <div className="flex items-center justify-center gap-3">
+                    <button onClick={() => setSelectedDay(shiftDay(selectedDay, -1))} className="p-2 rounded-xl hover:bg-slate-100 dark:hover:bg-white/5 text-slate-500">
+                        <ChevronRight size={20} />
+                    </button>
+                    <input
+                        type="date"
+                        value={selectedDay}
+                        onChange={e => e.target.value && setSelectedDay(e.target.value)}
+                        className="p-2 bg-slate-50 dark:bg-slate-900 rounded-xl border border-slate-200 dark:border-white/5 outline-none focus:border-primary text-slate-800 dark:text-white font-bold"
+                    />
+                    <button onClick={() => setSelectedDay(shiftDay(selectedDay, 1))} className="p-2 rounded-xl hover:bg-slate-100 dark:hover:bg-white/5 text-slate-500">
+                        <ChevronLeft size={20} />
+                    </button>
+                    <button onClick={() => setSelectedDay(getTodayDateTimeStr().slice(0, 10))} className="px-4 py-2 rounded-xl text-primary font-black hover:bg-primary/5">
+                        اليوم
+                    </button>
+                </div>
+                {monthDays.length > 0 && (
+                    <div className="flex flex-wrap gap-2 justify-center">
+                        {monthDays.map(d => (
+                            <button
+                                key={d.date}
+                                onClick={() => setSelectedDay(d.date)}
+                                className={`px-3 py-1 rounded-lg text-xs font-bold border transition-all ${d.date === selectedDay ? 'bg-primary text-white border-primary' : 'bg-slate-50 dark:bg-slate-900 text-slate-600 dark:text-slate-300 border-slate-200 dark:border-white/5 hover:border-primary'}`}
+                            >
+                                {Number(d.date.slice(8))} • {d.count - d.cancelled}
+                            </button>
+                        ))}
+                    </div>
+                )}
+            </div>
+
             {viewMode === 'list' ? (
                 // List View
                 <div className="bg-white dark:bg-slate-800/50 dark:backdrop-blur-xl rounded-[2rem] shadow-sm border border-slate-100 dark:border-white/5 overflow-hidden">
@@ -123,7 +185,6 @@ export default function Appointments() {
                             </thead>
                             <tbody className="divide-y divide-slate-50 dark:divide-white/5">
                                 {appointments.map(appt => {
-                                    const patient = patients.find(p => p.id === appt.patient_id);
                                     return (
                                         <tr key={appt.id} className="hover:bg-slate-50 dark:hover:bg-white/5 transition-all group">
                                             <td className="p-6 whitespace-nowrap">
@@ -132,7 +193,7 @@ export default function Appointments() {
                                                         <User size={20} />
                                                     </div>
                                                     <span className="font-black text-lg text-slate-800 dark:text-white group-hover:text-primary transition-colors">
-                                                        {patient ? patient.name : 'Unknown'}
+                                                        {appt.patient_name || 'Unknown'}
                                                     </span>
                                                 </div>
                                             </td>
@@ -200,11 +261,10 @@ export default function Appointments() {
 
                             <div className="flex flex-col gap-3 min-h-[100px]">
                                 {getColumnAppointments(col.id).map(appt => {
-                                    const patient = patients.find(p => p.id === appt.patient_id);
                                     return (
                                         <div key={appt.id} className="bg-white dark:bg-slate-800 p-4 rounded-2xl shadow-sm border border-slate-100 dark:border-white/5 hover:shadow-md transition-all group relative">
                                             <div className="flex justify-between items-start mb-3">
-                                                <h4 className="font-black text-slate-800 dark:text-white">{patient?.name || 'Unknown'}</h4>
+                                                <h4 className="font-black text-slate-800 dark:text-white">{appt.patient_name || 'Unknown'}</h4>
                                                 <div className="group-hover:opacity-100 opacity-0 transition-opacity absolute top-2 right-2">
                                                     <select
                                                         className="text-xs p-1 bg-slate-100 rounded-lg border-none outline-none cursor-pointer"
@@ -1,10 +1,13 @@
 import React, { useState, useEffect } from 'react';
-import { Banknote, TrendingUp, TrendingDown, DollarSign } from 'lucide-react';
-import { getFinancialStats, getAllPayments } from '../api';
+import { Link } from 'react-router-dom';
+import { Banknote, TrendingUp, TrendingDown, DollarSign, Download } from 'lucide-react';
+import { getFinancialStats, getAllPayments, getDebtors, downloadDebtorsCsv, getTimeseries } from '../api';
 
 export default function Billing() {
     const [stats, setStats] = useState(null);
     const [payments, setPayments] = useState([]);
+    const [debtors, setDebtors] = useState([]);
+    const [months, setMonths] = useState([]);
     const [loading, setLoading] = useState(true);
 
     useEffect(() => {
@@ -13,9 +16,11 @@ export default function Billing() {
 
     const loadData = async () => {
         try {
-            const [sRes, pRes] = await Promise.all([getFinancialStats(), getAllPayments()]);
+            const [sRes, pRes, dRes, tRes] = await Promise.all([getFinancialStats(), getAllPayments(), getDebtors(), getTimeseries('month')]);
             setStats(sRes.data);
             setPayments(pRes.data);
+            setDebtors(dRes.data);
+            setMonths(tRes.data.buckets);
         } catch (err) {
             console.error(err);
         } finally {
@@ -23,6 +28,23 @@ export default function Billing() {
         }
     };
 
+    const handleExportDebtors = async () => {
+        try {
+            const response = await downloadDebtorsCsv();
+            const url = window.URL.createObjectURL(new Blob([response.data], { type: 'text/csv' }));
+            const link = document.createElement('a');
+            link.href = url;
+            link.setAttribute('download', 'debtors.csv');
+            document.body.appendChild(link);
+            link.click();
+            link.remove();
+            window.URL.revokeObjectURL(url);
+        } catch (err) {
+            console.error(err);
+            alert('فشل تصدير قائمة المدينين');
+        }
+    };
+
     if (loading) return (
         <div className="flex items-center justify-center min-h-[400px]">
             <div className="animate-spin rounded-full h-12 w-12 border-4 border-primary border-t-transparent"></div>
@@ -73,6 +95,67 @@ export default function Billing() {
                 </div>
             </div>
 
+            {months.length > 0 && (() => {
+                const peak = Math.max(1, ...months.map(m => Math.max(m.revenue, m.received, m.expenses)));
+                return (
+                    <div className="bg-white dark:bg-slate-800/50 dark:backdrop-blur-xl rounded-[2rem] border border-slate-100 dark:border-white/5 p-8 shadow-sm">
+                        <div className="flex items-center gap-4 mb-8">
+                            <div className="w-2.5 h-8 bg-emerald-500 rounded-full"></div>
+                            <h3 className="font-black text-2xl text-slate-800 dark:text-white">آخر 12 شهر</h3>
+                            <div className="mr-auto flex gap-4 text-xs font-bold text-slate-500">
+                                <span className="flex items-center gap-1"><span className="w-3 h-3 rounded bg-emerald-500"></span>الإيرادات</span>
+                                <span className="flex items-center gap-1"><span className="w-3 h-3 rounded bg-blue-500"></span>المحصل</span>
+                                <span className="flex items-center gap-1"><span className="w-3 h-3 rounded bg-red-400"></span>المصروفات</span>
+                            </div>
+                        </div>
+                        <div className="flex items-end gap-2 h-48" dir="ltr">
+                            {months.map(m => (
+                                <div key={m.start} className="flex-1 flex flex-col items-center gap-2 h-full" title={`${m.start}: ${m.revenue} / ${m.received} / ${m.expenses}`}>
+                                    <div className="flex-1 w-full flex items-end justify-center gap-0.5">
+                                        <div className="w-1/4 bg-emerald-500 rounded-t" style={{ height: `${(m.revenue / peak) * 100}%` }}></div>
+                                        <div className="w-1/4 bg-blue-500 rounded-t" style={{ height: `${(m.received / peak) * 100}%` }}></div>
+                                        <div className="w-1/4 bg-red-400 rounded-t" style={{ height: `${(m.expenses / peak) * 100}%` }}></div>
+                                    </div>
+                                    <span className="text-[10px] font-bold text-slate-400">{new Date(m.start).toLocaleDateString('ar-EG', { month: 'short' })}</span>
+                                </div>
+                            ))}
+                        </div>
+                    </div>
+                );
+            })()}
+
+            {debtors.length > 0 && (
+                <div className="bg-white dark:bg-slate-800/50 dark:backdrop-blur-xl rounded-[2rem] border border-slate-100 dark:border-white/5 overflow-hidden shadow-sm">
+                    <div className="p-8 border-b dark:border-white/5 flex items-center gap-4">
+                        <div className="w-2.5 h-8 bg-orange-500 rounded-full"></div>
+                        <h3 className="font-black text-2xl text-slate-800 dark:text-white">المرضى المدينون</h3>
+                        <button
+                            onClick={handleExportDebtors}
+                            className="mr-auto flex items-center gap-2 px-4 py-2 text-sm font-black text-slate-600 dark:text-slate-300 bg-slate-100 dark:bg-white/5 rounded-xl hover:bg-slate-200 dark:hover:bg-white/10 transition-all"
+                        >
+                            <Download size={16} /> تصدير CSV
+                        </button>
+                    </div>
+                    <div className="divide-y divide-slate-50 dark:divide-white/5">
+                        {debtors.map(patient => (
+                            <Link
+                                key={patient.id}
+                                to={`/patients/${patient.id}`}
+                                className="flex items-center justify-between p-6 hover:bg-slate-50 dark:hover:bg-white/5 transition-all"
+                            >
+                                <div className="flex flex-col">
+                                    <span className="font-black text-slate-800 dark:text-white">{patient.name}</span>
+                                    <span className="text-xs text-slate-400 font-bold" dir="ltr">{patient.phone}</span>
+                                </div>
+                                <span className="font-black text-xl text-orange-600 dark:text-orange-400">
+                                    {patient.balance} <span className="text-sm">ج.م</span>
+                                </span>
+                            </Link>
+                        ))}
+                    </div>
+                </div>
+            )}
+
             <div className="bg-white dark:bg-slate-800/50 dark:backdrop-blur-xl rounded-[2rem] border border-slate-100 dark:border-white/5 overflow-hidden shadow-sm">
                 <div className="p-8 border-b dark:border-white/5 flex items-center gap-4">
                     <div className="w-2.5 h-8 bg-primary rounded-full"></div>
@@ -1,7 +1,8 @@
 import React, { useEffect, useState } from 'react';
 import { Users, Calendar, Banknote, Activity, Plus, Clock, ChevronLeft } from 'lucide-react';
 import { useNavigate } from 'react-router-dom';
-import { getPatients, getAppointments, getFinancialStats, getMe, getDashboardStats } from '../api';
+import { getPatients, getAppointmentCalendar, getFinancialStats, getMe, getDashboardStats } from '../api';
+import { getTodayDateTimeStr } from '../utils/toothUtils';
 
 const StatCard = ({ icon: Icon, label, value, subtext, color, onClick }) => (
     <div
@@ -39,9 +40,10 @@ export default function Dashboard() {
             try {
                 setLoading(true);
                 // Parallel fetch: Stats for cards, Appointments for list
+                const today = getTodayDateTimeStr().slice(0, 10);
                 const [statsRes, apptsRes, userRes] = await Promise.all([
                     getDashboardStats(),
-                    getAppointments(),
+                    getAppointmentCalendar(today, today),
                     getMe()
                 ]);
                 
@@ -55,9 +57,8 @@ export default function Dashboard() {
                     outstanding: statsRes.data.today_outstanding.toLocaleString() + ' ج.م'
                 });
 
-                // Schedule List (Client-side filter of the recent 100 appts)
-                const today = new Date().toISOString().split('T')[0];
-                const todaysAppts = apptsRes.data.filter(app => app.date_time.startsWith(today) && app.status !== 'Cancelled');
+                // Schedule List (today's window only)
+                const todaysAppts = apptsRes.data.appointments.filter(app => app.status !== 'Cancelled');
                 setTodaysAppointments(todaysAppts.slice(0, 5));
             } catch (err) {
                 console.error("Dashboard Load Error", err);
@@ -4,12 +4,14 @@ import DentalChartSVG from '../components/DentalChartSVG';
 import { Edit2, Trash2, Plus, X, Save, Printer, FileText, Baby, User as UserIcon, File as FileIcon, Upload, RefreshCw } from 'lucide-react';
 import { toothToNumber, fdiToPalmer, palmerToFdi, getTodayStr, toothToDisplay, universalToPalmer } from '../utils/toothUtils';
 import {
-    getPatient, updatePatient, getPatientTeeth, updateToothStatus,
-    getPatientTreatments, deletePatient, getPatientPayments,
+    getPatientBundle, updatePatient, updateToothStatus, deletePatient,
     createTreatment, createPayment, deleteTreatment, deletePayment,
-    getProcedures, uploadAttachment, getAttachments, deleteAttachment, updateTreatment
+    uploadAttachment, getAttachments, deleteAttachment, updateTreatment
 } from '../api';
 
+// Local uploads are served by the API (signed /uploads/... URLs), Cloudinary URLs are absolute
+const fileUrl = (path) => path.startsWith('http') ? path : `http://${window.location.hostname}:8000${path}`;
+
 export default function PatientDetails() {
     const { id } = useParams();
     const [activeTab, setActiveTab] = useState('chart');
@@ -24,6 +26,7 @@ export default function PatientDetails() {
     const [payments, setPayments] = useState([]);
     const [procedures, setProcedures] = useState([]);
     const [attachments, setAttachments] = useState([]);
+    const [balance, setBalance] = useState({ total_due: 0, total_paid: 0, balance: 0 });
 
     // Modals
     const [isEditPatientOpen, setIsEditPatientOpen] = useState(false);
@@ -49,25 +52,19 @@ export default function PatientDetails() {
     const loadData = async () => {
         try {
             setLoading(true);
-            const [pRes, tRes, hRes, payRes, procRes, aRes] = await Promise.all([
-                getPatient(id),
-                getPatientTeeth(id),
-                getPatientTreatments(id),
-                getPatientPayments(id),
-                getProcedures(),
-                getAttachments(id)
-            ]);
+            const { data } = await getPatientBundle(id);
 
-            setPatient(pRes.data);
+            setPatient(data.patient);
 
             const tMap = {};
-            tRes.data.forEach(t => { tMap[t.tooth_number] = t; });
+            data.tooth_status.forEach(t => { tMap[t.tooth_number] = t; });
             setTeethStatus(tMap);
 
-            setHistory(hRes.data);
-            setAttachments(aRes.data);
-            setPayments(payRes.data);
-            setProcedures(procRes.data);
+            setHistory(data.treatments);
+            setAttachments(data.attachments);
+            setPayments(data.payments);
+            setProcedures(data.procedures);
+            setBalance(data.balance);
         } catch (err) {
             console.error("Failed to load patient data", err);
         } finally {
@@ -457,10 +454,11 @@ export default function PatientDetails() {
                                 <div key={file.id} className="group relative aspect-square bg-slate-100 rounded-xl overflow-hidden border border-slate-200 shadow-sm">
                                     {file.file_type.includes('image') ? (
                                         <img
-                                            src={`http://${window.location.hostname}:8000${file.file_path}`}
+                                            src={fileUrl(file.thumbnail_url || file.url)}
                                             alt={file.filename}
+                                            loading="lazy"
                                             className="w-full h-full object-cover transition-transform group-hover:scale-105"
-                                            onClick={() => window.open(`http://${window.location.hostname}:8000${file.file_path}`, '_blank')}
+                                            onClick={() => window.open(fileUrl(file.preview_url || file.url), '_blank')}
                                         />
                                     ) : (
                                         <div className="w-full h-full flex flex-col items-center justify-center text-slate-400 p-4 text-center">
@@ -471,7 +469,7 @@ export default function PatientDetails() {
 
                                     <div className="absolute inset-0 bg-black/40 opacity-0 group-hover:opacity-100 transition-opacity flex items-center justify-center gap-2">
                                         <button
-                                            onClick={() => window.open(`http://${window.location.hostname}:8000${file.file_path}`, '_blank')}
+                                            onClick={() => window.open(fileUrl(file.url), '_blank')}
                                             className="p-2 bg-white rounded-full text-slate-700 hover:text-primary hover:scale-110 transition-all"
                                         >
                                             <Edit2 size={16} />
@@ -509,17 +507,17 @@ export default function PatientDetails() {
                             <div className="bg-white p-4 rounded-xl border border-slate-100 shadow-sm">
                                 <p className="text-xs text-slate-500 font-bold uppercase mb-1">إجمالي العلاجات</p>
                                 <p className="text-2xl font-bold text-slate-800">
-                                    {history.reduce((acc, curr) => acc + (curr.cost - (curr.discount || 0)), 0)} <span className="text-xs text-slate-400">ج.م</span>
+                                    {balance.total_due} <span className="text-xs text-slate-400">ج.م</span>
                                 </p>
                             </div>
                             <div className="bg-white p-4 rounded-xl border border-slate-100 shadow-sm">
                                 <p className="text-xs text-slate-500 font-bold uppercase mb-1">المدفوع</p>
-                                <p className="text-2xl font-bold text-emerald-600">{payments.reduce((acc, curr) => acc + curr.amount, 0)} <span className="text-xs text-slate-400">ج.م</span></p>
+                                <p className="text-2xl font-bold text-emerald-600">{balance.total_paid} <span className="text-xs text-slate-400">ج.م</span></p>
                             </div>
                             <div className="bg-white p-4 rounded-xl border border-slate-100 shadow-sm">
                                 <p className="text-xs text-slate-500 font-bold uppercase mb-1">المتبقي</p>
                                 <p className="text-2xl font-bold text-slate-400">
-                                    {(history.reduce((acc, curr) => acc + (curr.cost - (curr.discount || 0)), 0) - payments.reduce((acc, curr) => acc + curr.amount, 0))} <span className="text-xs text-slate-400">ج.م</span>
+                                    {balance.balance} <span className="text-xs text-slate-400">ج.م</span>
                                 </p>
                             </div>
                         </div>
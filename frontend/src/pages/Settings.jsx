@@ -343,6 +343,43 @@ export default function Settings() {
                     </form>
                 </div>
 
+                {/* Clinic Timezone Section */}
+                <div className="bg-white dark:bg-slate-800 p-8 rounded-2xl shadow-sm border border-slate-100 dark:border-white/5 md:col-span-2">
+                    <div className="flex items-start gap-4 mb-6">
+                        <div className="p-3 bg-amber-100 dark:bg-amber-900/30 text-amber-600 rounded-xl">
+                            <Clock size={32} />
+                        </div>
+                        <div>
+                            <h3 className="text-lg font-bold text-slate-800 dark:text-white">المنطقة الزمنية للعيادة</h3>
+                            <p className="text-slate-500 dark:text-slate-400 text-sm mt-1">تحدد بداية ونهاية "اليوم" في إحصائيات اليوم والمواعيد</p>
+                        </div>
+                    </div>
+                    {currentUser && (
+                        <select
+                            defaultValue={currentUser.tenant?.timezone || 'Africa/Cairo'}
+                            onChange={async (e) => {
+                                try {
+                                    await api.updateTimezone(e.target.value);
+                                    setMessage({type: 'success', text: 'تم تحديث المنطقة الزمنية'});
+                                    loadUserInfo();
+                                } catch(err) {
+                                    setMessage({type: 'error', text: 'فشل التحديث'});
+                                }
+                            }}
+                            className="w-full p-3 rounded-xl border border-slate-200 dark:border-slate-700 bg-slate-50 dark:bg-slate-900 outline-none focus:border-indigo-500"
+                        >
+                            <option value="Africa/Cairo">القاهرة (Africa/Cairo)</option>
+                            <option value="Asia/Riyadh">الرياض (Asia/Riyadh)</option>
+                            <option value="Asia/Kuwait">الكويت (Asia/Kuwait)</option>
+                            <option value="Asia/Dubai">دبي (Asia/Dubai)</option>
+                            <option value="Asia/Amman">عمّان (Asia/Amman)</option>
+                            <option value="Africa/Tripoli">طرابلس (Africa/Tripoli)</option>
+                            <option value="Europe/London">لندن (Europe/London)</option>
+                            <option value="UTC">UTC</option>
+                        </select>
+                    )}
+                </div>
+
                 {/* Cloud Backup Section */}
                 <div className="bg-white p-8 rounded-2xl shadow-sm border border-slate-100">
                     <div className="flex items-start gap-4 mb-6">
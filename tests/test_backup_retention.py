@@ -0,0 +1,180 @@
+from datetime import datetime, timedelta
+import pytest
+from backend import backup_service, backup_targets, models
+from backend.backup_retention import select_backups_to_prune
+
+
+def backup(tenant_name, ts, manual=False):
+    name = f"{'manual_' if manual else ''}backup_{tenant_name}_{ts.strftime('%Y%m%d_%H%M')}.json"
+    return {"id": name, "name": name, "createdTime": ts.isoformat() + "Z"}
+
+
+def daily_backups(tenant_name, first, last):
+    files = []
+    day = first
+    while day <= last:
+        files.append(backup(tenant_name, day))
+        day += timedelta(days=1)
+    return files
+
+
+def kept(files, pruned):
+    pruned_ids = {f["id"] for f in pruned}
+    return {f["id"] for f in files} - pruned_ids
+
+
+def test_keeps_newest_of_each_day_week_and_month():
+    files = daily_backups(
+        "Clinic", datetime(2026, 1, 1, 2, 0), datetime(2026, 3, 31, 2, 0)
+    )
+
+    pruned = select_backups_to_prune(
+        files, "Clinic", keep_daily=2, keep_weekly=2, keep_monthly=2
+    )
+
+    assert kept(files, pruned) == {
+        "backup_Clinic_20260331_0200.json",  # day, week (Mon 30th) and month
+        "backup_Clinic_20260330_0200.json",  # second day
+        "backup_Clinic_20260329_0200.json",  # Sunday: newest of the week before
+        "backup_Clinic_20260228_0200.json",  # newest of February
+    }
+
+
+def test_keeps_only_newest_backup_of_a_day():
+    files = [
+        backup("Clinic", datetime(2026, 3, 31, 2, 0)),
+        backup("Clinic", datetime(2026, 3, 31, 9, 30), manual=True),
+        backup("Clinic", datetime(2026, 3, 30, 2, 0)),
+    ]
+
+    pruned = select_backups_to_prune(
+        files, "Clinic", keep_daily=1, keep_weekly=0, keep_monthly=0
+    )
+
+    assert kept(files, pruned) == {"manual_backup_Clinic_20260331_0930.json"}
+
+
+@pytest.mark.parametrize(
+    "policy", [(1, 0, 0), (0, 1, 0), (0, 0, 1), (0, 0, 12), (7, 4, 12)]
+)
+def test_newest_backup_is_always_kept(policy):
+    keep_daily, keep_weekly, keep_monthly = policy
+    files = daily_backups(
+        "Clinic", datetime(2026, 3, 1, 2, 0), datetime(2026, 3, 10, 2, 0)
+    )
+    files.append(backup("Clinic", datetime(2026, 3, 10, 23, 59), manual=True))
+
+    pruned = select_backups_to_prune(
+        files,
+        "Clinic",
+        keep_daily=keep_daily,
+        keep_weekly=keep_weekly,
+        keep_monthly=keep_monthly,
+    )
+
+    assert "manual_backup_Clinic_20260310_2359.json" in kept(files, pruned)
+    assert "backup_Clinic_20260310_0200.json" not in kept(files, pruned)
+
+
+def test_all_zero_policy_keeps_everything():
+    files = daily_backups(
+        "Clinic", datetime(2026, 1, 1, 2, 0), datetime(2026, 3, 31, 2, 0)
+    )
+
+    assert (
+        select_backups_to_prune(
+            files, "Clinic", keep_daily=0, keep_weekly=0, keep_monthly=0
+        )
+        == []
+    )
+
+
+def test_only_the_tenants_own_backups_are_considered():
+    # Two clinics linked to one Google account share the backups folder
+    ours = daily_backups(
+        "Dr_Clinic", datetime(2026, 3, 1, 2, 0), datetime(2026, 3, 5, 2, 0)
+    )
+    theirs = daily_backups(
+        "Dr_Clinic_2", datetime(2026, 2, 1, 2, 0), datetime(2026, 2, 5, 2, 0)
+    )
+    unrelated = [
+        {"id": "notes", "name": "notes.txt", "createdTime": "2020-01-01T00:00:00Z"}
+    ]
+
+    pruned = select_backups_to_prune(
+        ours + theirs + unrelated,
+        "Dr Clinic",  # spaces were made path-safe in the file names
+        keep_daily=2,
+        keep_weekly=0,
+        keep_monthly=0,
+    )
+
+    assert {f["id"] for f in pruned} == {
+        "backup_Dr_Clinic_20260301_0200.json",
+        "backup_Dr_Clinic_20260302_0200.json",
+        "backup_Dr_Clinic_20260303_0200.json",
+    }
+
+
+class FakeDrive:
+    """Stands in for GoogleDriveClient: one shared backups folder."""
+
+    def __init__(self, files):
+        self.files = {f["id"]: f for f in files}
+        self.deleted = []
+
+    def list_folder_files(self, refresh_token, folder_id):
+        return list(self.files.values())
+
+    def delete_files(self, refresh_token, ids):
+        for file_id in ids:
+            self.files.pop(file_id)
+        self.deleted.extend(ids)
+        return list(ids)
+
+
+def test_enforce_retention_deletes_pruned_files_from_drive():
+    tenant = models.Tenant(
+        id=1,
+        name="Clinic",
+        google_refresh_token="token",
+        google_folder_id="folder",
+        backup_keep_daily=3,
+        backup_keep_weekly=0,
+        backup_keep_monthly=0,
+    )
+    ours = daily_backups(
+        "Clinic", datetime(2026, 3, 1, 2, 0), datetime(2026, 3, 6, 2, 0)
+    )
+    theirs = daily_backups(
+        "Other", datetime(2026, 1, 1, 2, 0), datetime(2026, 1, 3, 2, 0)
+    )
+    drive = FakeDrive(ours + theirs)
+    target = backup_targets.DriveTarget(None, tenant)
+    target.client = drive
+
+    assert backup_service.enforce_retention(tenant, target) == 3
+    assert sorted(drive.deleted) == [
+        "backup_Clinic_20260301_0200.json",
+        "backup_Clinic_20260302_0200.json",
+        "backup_Clinic_20260303_0200.json",
+    ]
+    assert {f["id"] for f in theirs} <= set(drive.files)
+
+
+def test_enforce_retention_without_policy_deletes_nothing():
+    tenant = models.Tenant(
+        id=1,
+        name="Clinic",
+        backup_keep_daily=0,
+        backup_keep_weekly=0,
+        backup_keep_monthly=0,
+    )
+    drive = FakeDrive(
+        daily_backups("Clinic", datetime(2026, 3, 1, 2, 0), datetime(2026, 3, 6, 2, 0))
+    )
+    target = backup_targets.DriveTarget(None, tenant)
+    target.client = drive
+
+    assert backup_service.enforce_retention(tenant, target) == 0
+    assert drive.deleted == []